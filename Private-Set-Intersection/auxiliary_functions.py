@@ -1,31 +1,26 @@
+from functools import lru_cache
+from itertools import islice
+from math import ceil
+from multiprocessing import get_context
 import pickle
-from random import randint
 import socket
-from typing import Any, List, Optional, Tuple, TypeVar
+import struct
+from typing import Any, Callable, Iterable, List, Optional, Tuple, TypeVar
+
+import numpy as np
 
 from constants import *
+from tracing import record_message
 
 Multiplicable = TypeVar("Multiplicable", bound="MultiplicableBase")
 
+# state shared with the workers of fork_map
+_fork_map_state = None
+
 class MultiplicableBase:
     def __mul__(self, other: "Multiplicable") -> "Multiplicable":
         pass
 
-def get_random_distinct_integer(bound: int, i: int) -> int:
-    '''
-    Generates a uniform random integer in the range [0, bound-1] that is distinct from i.
-
-    :param bound: an integer representing the upper bound of the range
-    :param i: an integer less than bound
-    :return: a uniformly random integer in the range [0, bound-1] that is distinct from i.
-    '''
-
-    value = randint(0, bound - 1)
-    while (value == i):
-        value = randint(0, bound - 1)
-        
-    return value
-
 def split_int_into_base_digits(n: int, b: int) -> List[int]:
     '''
     Converts an integer n to a list representing its digits in another base b.
@@ -85,29 +80,157 @@ def reconstruct_power(matrix: List[List[int]], exponent: int) -> int:
     return fast_multiply_items(needed_powers)
 
 
-def windowing(y: int, bound: int, mod: int) -> List[List[Optional[int]]]:
+def windowed_exponents(base: int, log_b_ell: int, bound: int) -> List[int]:
+    '''
+    The exponents of y the client sends in the windowed query, i.e. the exponents
+    i * base ** j (1 <= i < base, 0 <= j < log_b_ell) that are at most bound.
+
+    :param base: the windowing base
+    :param log_b_ell: number of elements in each row of the windowing matrix
+    :param bound: an integer that bounds the exponents of y
+    :return: sorted list of the exponents of y available in the query
+    '''
+
+    return sorted({i * base ** j for i in range(1, base) for j in range(log_b_ell) if i * base ** j <= bound})
+
+
+def plan_power_computation(targets: Iterable[int], sources: Iterable[int]) -> List[Tuple[int, int, int]]:
+    '''
+    Plans how to compute the powers y ** t (t in targets) from the powers y ** s
+    (s in sources) with multiplications. Every power is computed with the smallest
+    possible multiplicative depth, and every intermediate power is computed once and
+    reused, so a plan costs one multiplication per power that is not a source. Plans
+    are memoized.
+
+    :param targets: exponents of the powers to compute
+    :param sources: exponents of the powers available (depth 0)
+    :return: list of steps (e, a, b) meaning y ** e = y ** a * y ** b, in an order where
+             y ** a and y ** b are always available when the step is reached
+    '''
+
+    return list(_plan_power_computation(tuple(sorted(set(targets))), tuple(sorted(set(sources)))))
+
+@lru_cache(maxsize=None)
+def _plan_power_computation(targets: Tuple[int, ...], sources: Tuple[int, ...]) -> Tuple[Tuple[int, int, int], ...]:
+    '''
+    See plan_power_computation (targets and sources are sorted tuples, so they can be
+    memoized).
+    '''
+
+    if not targets:
+        return ()
+
+    top = targets[-1]
+    wanted = set(targets) | set(sources)
+
+    # depth[e]: smallest multiplicative depth at which y ** e can be computed
+    depth = {s: 0 for s in sources if s <= top}
+    split = {}
+
+    for e in range(1, top + 1):
+        if e in depth:
+            continue
+
+        best = None
+        for a in range(1, e // 2 + 1):
+            b = e - a
+            if a in depth and b in depth:
+                # smallest depth first, then prefer operands that are needed anyway
+                key = (max(depth[a], depth[b]) + 1, (a not in wanted) + (b not in wanted))
+                if best is None or key < best[0]:
+                    best = (key, a, b)
+
+        if best is not None:
+            depth[e] = best[0][0]
+            split[e] = (best[1], best[2])
+
+    # keep only the steps the targets depend on
+    needed = set()
+    stack = list(targets)
+    while stack:
+        e = stack.pop()
+        if e in needed or e in sources:
+            continue
+        if e not in split:
+            raise ValueError("y ** {} cannot be computed from the powers {}".format(e, list(sources)))
+        needed.add(e)
+        stack.extend(split[e])
+
+    return tuple((e, *split[e]) for e in sorted(needed))
+
+
+def plan_paterson_stockmeyer(degree: int, partitions: int, sources: Iterable[int],
+                             baby_steps: int = 0) -> Tuple[int, List[Tuple[int, int, int]]]:
+    '''
+    Plans the Paterson-Stockmeyer evaluation of partitions polynomials of the given
+    degree: with k baby steps, P(y) = sum_g (sum_b c_{gk+b} y ** b) * y ** (gk), so only
+    the powers y, ..., y ** (k-1) and y ** k, y ** (2k), ... are needed, at the price of
+    one ciphertext multiplication per giant step and polynomial.
+
+    :param degree: the degree of the polynomials
+    :param partitions: the number of polynomials evaluated on the same powers
+    :param sources: exponents of the powers available (depth 0)
+    :param baby_steps: the number k of baby steps; 0 picks the k that needs the fewest
+                       ciphertext multiplications in total
+    :return: the number of baby steps and the plan computing the powers needed
+             (see plan_power_computation)
+    '''
+
+    sources = list(sources)
+
+    def needed_powers(k):
+        giant_steps = ceil((degree + 1) / k)
+        return list(range(1, k)) + [g * k for g in range(1, giant_steps)]
+
+    def multiplications(k):
+        giant_steps = ceil((degree + 1) / k)
+        return len(plan_power_computation(needed_powers(k), sources)) + partitions * (giant_steps - 1)
+
+    if baby_steps == 0:
+        baby_steps = min(range(2, degree + 2), key=lambda k: (multiplications(k), k))
+
+    if not 2 <= baby_steps <= degree + 1:
+        raise ValueError("The number of baby steps must be between 2 and {}".format(degree + 1))
+
+    return baby_steps, plan_power_computation(needed_powers(baby_steps), sources)
+
+
+def windowing_batched(ys: np.ndarray, bound: int, mod: int) -> np.ndarray:
     """
-    Windowing technique to efficiently compute modular exponentiation of an integer y.
-    Returns a matrix of y raised to powers of BASE with exponents up to a specified bound (modulo mod).
+    Windowing technique to efficiently compute modular exponentiation: computes, for all
+    the integers in ys at once, their powers i * BASE ** j (1 <= i < BASE, 0 <= j < LOG_B_ELL).
+    Requires mod < 2 ** 32 so that products of two residues fit in 64-bit integers.
 
-    :param y: an integer we want powers of
+    :param ys: a 1D array of integers we want powers of
     :param bound: an integer that bounds the exponents of y
     :param mod: an integer; the modulus
-    :return: a matrix of y raised to powers of BASE with exponents
-             up to a specified bound (modulo mod)
-    """
-    windowed_y = []
-    for i in range(1, BASE):
-        row = []
-        for j in range(LOG_B_ELL):
-            exp = i * (BASE ** j)
-            if exp <= bound:
-                row.append(pow(y, exp, mod))
-            else:
-                row.append(None)
-        windowed_y.append(row)
+    :return: a C-contiguous int64 array of shape (BASE - 1, LOG_B_ELL, len(ys)) whose entry
+             [i - 1, j, k] is ys[k] ** (i * BASE ** j) modulo mod, or 0 if the exponent is
+             larger than bound; so [i - 1, j] is the slot vector of one query ciphertext
+    """
+
+    mod = np.uint64(mod)
+    ys = np.asarray(ys, dtype=np.uint64) % mod
 
-    return windowed_y
+    windowed = np.zeros((BASE - 1, LOG_B_ELL, len(ys)), dtype=np.uint64)
+
+    # y ** (BASE ** j)
+    base_power = ys
+    for j in range(LOG_B_ELL):
+        if j > 0:
+            previous = base_power
+            for _ in range(BASE - 1):
+                base_power = base_power * previous % mod
+
+        # y ** (i * BASE ** j) = (y ** (BASE ** j)) ** i
+        power = base_power
+        for i in range(1, BASE):
+            if i > 1:
+                power = power * base_power % mod
+            if i * BASE ** j <= bound:
+                windowed[i - 1, j] = power
+
+    return windowed.astype(np.int64)
 
 
 def compute_coefficients_from_roots(roots: List[int], mod: int) -> List[int]:
@@ -137,36 +260,120 @@ def compute_coefficients_from_roots(roots: List[int], mod: int) -> List[int]:
     return coefficients
 
 
+def compute_coefficients_from_roots_batched(roots: np.ndarray, mod: int) -> np.ndarray:
+    '''
+    Batched version of compute_coefficients_from_roots: row i of the result holds the
+    coefficients (highest degree first) of the polynomial vanishing at the roots in row i
+    of roots. All rows are processed at once, one root column at a time. Requires
+    mod < 2 ** 30 so that products of two residues fit in 64-bit integers.
+
+    :param roots: a 2D array of integers, one set of roots per row
+    :param mod: an integer
+    :return: a 2D uint64 array with len(roots[0]) + 1 coefficients per row, equal to
+             compute_coefficients_from_roots applied to each row
+    '''
+
+    roots = np.asarray(roots, dtype=np.uint64) % np.uint64(mod)
+    num_rows, num_roots = roots.shape
+    mod = np.uint64(mod)
+
+    # multiplying by (mod - r) instead of subtracting r * c keeps everything unsigned
+    neg_roots = (mod - roots) % mod
+
+    coefficients = np.zeros((num_rows, num_roots + 1), dtype=np.uint64)
+    coefficients[:, 0] = 1
+
+    for j in range(num_roots):
+        # convolution with (x - r): new[i + 1] = c[i + 1] - r * c[i]
+        coefficients[:, 1:j + 2] = (coefficients[:, 1:j + 2] + neg_roots[:, j:j + 1] * coefficients[:, :j + 1]) % mod
+
+    return coefficients
+
+
 def read_file_return_list_of_int(filename: str) -> List[int]:
     """
-    :param filename: filename to process
+    :param filename: filename to process, a set file in text or binary format (see SET_FILE_MAGIC)
     :return: list of lines from file with newlines stripped off and everything converted to int
     """
 
+    if is_binary_set_file(filename):
+        # converting the whole array at once is much faster than converting item by item
+        return load_set(filename).tolist()
+
     with open(filename) as f:
-        return [int(line.rstrip()) for line in f]
+        # int() ignores the trailing newline
+        return list(map(int, f))
 
-def split_list_into_parts(items: List[Any], n: int) -> List[List[Any]]:
+def is_binary_set_file(filename: str) -> bool:
+    """
+    :param filename: filename of a set file
+    :return: whether the set file is in binary format (see SET_FILE_MAGIC)
     """
-    Example: split_list_into_parts([0,1,2,3,4,5,6,7,8,9], 3) is split into [0,1,2], [3,4,5], [6,7,8], [9]
 
-    :param items: object of items to split
-    :param n: the number of lists for the items to be sent into
-    :return: list of n lists containing the objects from items 
+    with open(filename, "rb") as f:
+        return f.read(len(SET_FILE_MAGIC)) == SET_FILE_MAGIC
+
+def load_set(filename: str) -> np.ndarray:
+    """
+    Loads a set file. A binary set file is memory-mapped (read-only), so only the parts
+    of it that are accessed are read from disk; a text set file is parsed.
+
+    :param filename: filename of a set file in text or binary format (see SET_FILE_MAGIC)
+    :return: array (np.uint64) of the items
     """
 
-    split_lists = []
+    if not is_binary_set_file(filename):
+        return np.array(read_file_return_list_of_int(filename), dtype=np.uint64)
+
+    header_size = len(SET_FILE_MAGIC) + 8
 
-    q = int(len(items)/n)
+    with open(filename, "rb") as f:
+        f.seek(len(SET_FILE_MAGIC))
+        count, = struct.unpack("<Q", f.read(8))
+        f.seek(0, 2)
+        file_size = f.tell()
 
-    for i in range(0, int(len(items)/q)):
-        split_lists.append(items[i*q:(i+1)*q])
+    if file_size != header_size + 8 * count:
+        raise ValueError("Set file {} should have {} items, but has {} bytes of items".format(filename, count, file_size - header_size))
 
-    # put remainder in own list
-    if len(items[q*(1+i):]) > 0:
-        split_lists.append(items[q*(1+i):])
+    # an empty file region cannot be memory-mapped
+    if count == 0:
+        return np.empty(0, dtype=np.uint64)
 
-    return split_lists
+    return np.memmap(filename, dtype="<u8", mode="r", offset=header_size, shape=(count,))
+
+def iterate_set_chunks(filename: str, chunk_size: int = SET_CHUNK_SIZE) -> Iterable[List[int]]:
+    """
+    Reads a set file chunk_size items at a time, so that the whole set is never in memory.
+
+    :param filename: filename of a set file in text or binary format (see SET_FILE_MAGIC)
+    :param chunk_size: maximum number of items per chunk
+    :return: iterator over lists of items
+    """
+
+    if is_binary_set_file(filename):
+        items = load_set(filename)
+        for start in range(0, len(items), chunk_size):
+            yield items[start: start + chunk_size].tolist()
+        return
+
+    with open(filename) as f:
+        while True:
+            chunk = list(map(int, islice(f, chunk_size)))
+            if not chunk:
+                return
+            yield chunk
+
+def split_list_into_chunks(items: List[Any], chunk_size: int) -> List[List[Any]]:
+    """
+    Example: split_list_into_chunks([0,1,2,3,4,5,6,7,8,9], 4) is split into [0,1,2,3], [4,5,6,7], [8,9]
+
+    :param items: object of items to split
+    :param chunk_size: the maximum number of items in each list
+    :return: list of lists with at most chunk_size items each, in the original order
+    """
+
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
 
 def unpack_list_of_lists(lists: List[List]) -> List:
     """
@@ -181,16 +388,99 @@ def unpack_list_of_lists(lists: List[List]) -> List:
 
     return unpacked
 
+def fork_map(func: Callable[[Any, Any], Any], items: Iterable[Any], state: Any, processes: int) -> List[Any]:
+    """
+    Computes [func(state, item) for item in items] with up to processes forked worker
+    processes. The workers inherit state from this process when they are forked (shared
+    copy-on-write), so state is never pickled and may hold objects that cannot be, like
+    Pyfhel contexts and ciphertexts. func and the results must be picklable.
+
+    :param func: module-level function taking state and an item
+    :param items: items to apply func to
+    :param state: object passed to every call of func
+    :param processes: maximum number of worker processes; with 1, func runs in this process
+    :return: list of the results, in the order of items
+    """
+
+    global _fork_map_state
+
+    items = list(items)
+
+    if processes <= 1 or len(items) <= 1:
+        return [func(state, item) for item in items]
+
+    _fork_map_state = state
+    try:
+        with get_context("fork").Pool(min(processes, len(items))) as pool:
+            return pool.map(_call_with_fork_map_state, [(func, item) for item in items], chunksize=1)
+    finally:
+        _fork_map_state = None
+
+def _call_with_fork_map_state(func_and_item: Tuple[Callable[[Any, Any], Any], Any]) -> Any:
+    """
+    Runs in a fork_map worker: calls func with the inherited state and item.
+    """
+
+    func, item = func_and_item
+
+    return func(_fork_map_state, item)
+
 
 # functions for sending/receiving data for the online phase
 
-def serialize_and_send_data(socketobj: socket.socket, data: object = None, filename: str = "") -> int:
+FRAME_MAGIC = b"PSI1"
+"""
+The first bytes of every message frame.
+"""
+FRAME_HEADER = struct.Struct("!4sBIQ")
+"""
+Header of a message frame: magic, message type, number of raw blobs and length of the
+encoded body, in network byte order. It is followed by the length of each blob (8 bytes
+each), the body (see encode_message_body), then the blobs themselves.
+"""
+BODY_NONE = b"N"
+"""
+Body tag of None.
+"""
+BODY_INT = b"i"
+"""
+Body tag of an integer, followed by its value (signed 64-bit).
+"""
+BODY_BLOB = b"b"
+"""
+Body tag of a byte string; its bytes are the next raw blob of the frame.
+"""
+BODY_LIST = b"l"
+"""
+Body tag of a list, followed by its length (8 bytes) and its encoded items.
+"""
+BODY_INT_ARRAY = b"a"
+"""
+Body tag of a list of non-negative integers (or of a list of lists of the same length of
+them, e.g. curve points), followed by the width in bytes of an integer (1 byte), the number
+of rows and the number of columns (8 bytes each, 0 columns for a flat list), then the
+integers as big-endian unsigned integers of that width.
+"""
+BODY_ARRAY_HEADER = struct.Struct("!BQQ")
+"""
+Header of an integer array in a message body: width, rows and columns.
+"""
+MAX_BODY_NESTING = 8
+"""
+Deepest nesting of lists accepted in a received message body.
+"""
+
+def serialize_and_send_data(socketobj: socket.socket, data: object = None, filename: str = "",
+                            msg_type: int = MSG_DATA) -> int:
     """
-    Sends data to the other part of the socketobj.
+    Sends data to the other part of the socketobj as a single framed message.
+    Byte strings inside data (ciphertexts, keys, contexts) are not copied into
+    the encoded body; they are sent as raw blobs after it.
 
     :param clientsocket: socket object with a connection to the other party
     :param data: data to send
     :param filename: name of file where data is found (used if data is None)
+    :param msg_type: type of the message (see constants.py)
     :return: length of data sent
     """
 
@@ -201,68 +491,230 @@ def serialize_and_send_data(socketobj: socket.socket, data: object = None, filen
             data = pickle.load(unloaded_set)
         except Exception as e:
             print(e)
-    
-    serialized_data = pickle.dumps(data, protocol=None)
 
-    # send length of data to the other party first
-    length_of_sent_data = send_outgoing_data_length(socketobj, serialized_data)
-    # send the actual data
-    socketobj.sendall(serialized_data)
+    frame = frame_message(data, msg_type)
+
+    for part in frame:
+        socketobj.sendall(part)
+
+    size = sum(memoryview(part).nbytes for part in frame)
+    record_message("sent", msg_type, size)
+
+    return size
+
+def frame_message(data: Any, msg_type: int = MSG_DATA) -> List[Any]:
+    """
+    Serializes data into a message frame (see serialize_and_send_data), without copying
+    the byte strings inside data.
+
+    :param data: data to send (see encode_message_body)
+    :param msg_type: type of the message (see constants.py)
+    :return: list of the bytes-like parts of the frame, to be sent in order
+    """
+
+    body = bytearray()
+    blobs = []
+    encode_message_body(data, body, blobs)
+    blob_views = [memoryview(blob).cast("B") for blob in blobs]
+
+    header = FRAME_HEADER.pack(FRAME_MAGIC, msg_type, len(blob_views), len(body))
+    blob_lengths = struct.pack("!{}Q".format(len(blob_views)), *[blob.nbytes for blob in blob_views])
 
-    return length_of_sent_data
+    return [header + blob_lengths, body] + blob_views
 
+def encode_message_body(data: Any, body: bytearray, blobs: List[Any]) -> None:
+    """
+    Encodes data into a message body. Only plain data can be sent, so that the receiver
+    never runs code to decode a message (unlike with pickle): None, integers, byte strings
+    (bytes, bytearray or memoryview; they are appended to blobs and sent raw, without a
+    copy) and lists or tuples of them. Lists of non-negative integers, and lists of lists
+    of the same length of them, are encoded as integer arrays (see BODY_INT_ARRAY).
+    Tuples are received as lists.
+
+    :param data: data to encode
+    :param body: buffer the encoded body is appended to
+    :param blobs: list the byte strings inside data are appended to, in order
+    """
 
-def get_and_deserialize_data(socketobj: socket.socket) -> Tuple[Any, int]:
+    if data is None:
+        body += BODY_NONE
+    elif isinstance(data, (int, np.integer)) and not isinstance(data, bool):
+        body += BODY_INT + struct.pack("!q", data)
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        body += BODY_BLOB
+        blobs.append(data)
+    elif isinstance(data, (list, tuple)):
+        rows = integer_rows(data)
+        if rows is None:
+            body += BODY_LIST + struct.pack("!Q", len(data))
+            for item in data:
+                encode_message_body(item, body, blobs)
+        else:
+            columns = len(rows[0]) if data and isinstance(data[0], (list, tuple)) else 0
+            values = [value for row in rows for value in row]
+            width = max(1, (max(values, default=0).bit_length() + 7) // 8)
+            body += BODY_INT_ARRAY + BODY_ARRAY_HEADER.pack(width, len(rows), columns)
+            body += b"".join(value.to_bytes(width, "big") for value in values)
+    else:
+        raise TypeError("Cannot send an object of type {}".format(type(data).__name__))
+
+def integer_rows(data: List[Any]) -> Optional[List[List[int]]]:
+    """
+    :param data: list to encode
+    :return: if data is a non-empty list of non-negative integers, or of lists of the same
+             (non-zero) length of them, the rows of the integer array encoding it (one row
+             per integer for a flat list); None otherwise
     """
-    Receives data from the other side of the socket connection.
-    Deserializes the data before returning it.
-    
+
+    def is_integer(value):
+        return isinstance(value, (int, np.integer)) and not isinstance(value, bool) and value >= 0
+
+    if not data:
+        return None
+    if all(is_integer(value) for value in data):
+        return [[int(value)] for value in data]
+    if (all(isinstance(row, (list, tuple)) and len(row) == len(data[0]) for row in data) and len(data[0]) > 0
+            and all(is_integer(value) for row in data for value in row)):
+        return [[int(value) for value in row] for row in data]
+
+    return None
+
+def decode_message_body(body: memoryview, blobs: List[memoryview]) -> Any:
+    """
+    Decodes a message body encoded by encode_message_body. Every length is checked against
+    the received bytes, so a malformed body raises ValueError.
+
+    :param body: the encoded body
+    :param blobs: the raw blobs of the frame, in order
+    :return: the decoded data; byte strings are the blobs themselves
+    """
+
+    offset = 0
+    next_blob = 0
+
+    def take(length):
+        nonlocal offset
+        if length > len(body) - offset:
+            raise ValueError("Received message body is truncated")
+        part = body[offset: offset + length]
+        offset += length
+        return part
+
+    def decode(depth):
+        nonlocal next_blob
+        tag = bytes(take(1))
+
+        if tag == BODY_NONE:
+            return None
+        if tag == BODY_INT:
+            return struct.unpack("!q", take(8))[0]
+        if tag == BODY_BLOB:
+            if next_blob == len(blobs):
+                raise ValueError("Received message body refers to more blobs than were sent")
+            next_blob += 1
+            return blobs[next_blob - 1]
+        if tag == BODY_LIST:
+            if depth == MAX_BODY_NESTING:
+                raise ValueError("Received message body is nested too deeply")
+            length, = struct.unpack("!Q", take(8))
+            # every item takes at least one byte, so a forged length fails here
+            if length > len(body) - offset:
+                raise ValueError("Received message body is truncated")
+            return [decode(depth + 1) for _ in range(length)]
+        if tag == BODY_INT_ARRAY:
+            width, rows, columns = BODY_ARRAY_HEADER.unpack(take(BODY_ARRAY_HEADER.size))
+            if width == 0:
+                raise ValueError("Received message body has an integer array of width 0")
+            data = take(width * rows * max(columns, 1))
+            if width == 8:
+                values = np.frombuffer(data, dtype=">u8").tolist()
+            else:
+                values = [int.from_bytes(data[i: i + width], "big") for i in range(0, len(data), width)]
+            if columns == 0:
+                return values
+            return [values[i: i + columns] for i in range(0, len(values), columns)]
+
+        raise ValueError("Received message body has an unknown tag {!r}".format(tag))
+
+    data = decode(0)
+
+    if offset != len(body) or next_blob != len(blobs):
+        raise ValueError("Received message body does not match its frame")
+
+    return data
+
+def get_and_deserialize_data(socketobj: socket.socket, expected_type: Optional[int] = None) -> Tuple[Any, int]:
+    """
+    Receives one framed message from the other side of the socket connection.
+    The whole message is received into a single preallocated buffer, so it is
+    copied once, however large. The body is decoded without pickle (see
+    decode_message_body), so a message can only carry plain data and never runs
+    code on the receiver. Raw blobs are deserialized as read-only memoryviews
+    into that buffer: forwarding them (e.g. to shards) copies nothing, but Pyfhel
+    only deserializes from bytes, so keys and ciphertexts are copied once more by
+    bytes() where they are used. Frames larger than MAX_FRAME_SIZE are rejected
+    from their header, before their buffer is allocated. An error message
+    (MSG_ERROR) from the other side is raised as a ValueError, unless it is the
+    expected type.
+
     :param clientsocket: client's socket object
+    :param expected_type: if given, the message type the message must have
     :returns:
         deserialized_data: deserialized data
         serialized_data_length: length of the serialized data that was received
     """
 
-    expected_data_length = get_incoming_data_length(socketobj)
+    magic, msg_type, num_of_blobs, body_length = FRAME_HEADER.unpack(receive_exactly(socketobj, FRAME_HEADER.size))
 
-    serialized_data = b""
+    if magic != FRAME_MAGIC:
+        raise ValueError("Received data is not a valid message frame")
+    if expected_type is not None and msg_type not in (expected_type, MSG_ERROR):
+        raise ValueError("Expected message of type {}, received type {}".format(expected_type, msg_type))
+    if FRAME_HEADER.size + 8 * num_of_blobs + body_length > MAX_FRAME_SIZE:
+        raise ValueError("Received frame is larger than MAX_FRAME_SIZE ({} bytes)".format(MAX_FRAME_SIZE))
 
-    while len(serialized_data) < expected_data_length:
-        data = socketobj.recv(65536)
-        if not data: break
-        serialized_data += data
+    blob_lengths = struct.unpack("!{}Q".format(num_of_blobs), receive_exactly(socketobj, 8 * num_of_blobs))
 
-    serialized_data_length = len(serialized_data)
-    deserialized_data = pickle.loads(serialized_data)
+    if FRAME_HEADER.size + 8 * num_of_blobs + body_length + sum(blob_lengths) > MAX_FRAME_SIZE:
+        raise ValueError("Received frame is larger than MAX_FRAME_SIZE ({} bytes)".format(MAX_FRAME_SIZE))
 
-    return deserialized_data, serialized_data_length
+    payload = memoryview(receive_exactly(socketobj, body_length + sum(blob_lengths))).toreadonly()
 
-def send_outgoing_data_length(socketobj: socket.socket, data: bytes) -> int:
-    """
-    Sends the length of the outgoing data to the other side of the socketobj. 
-    Used before the one party sends a larger amount of data. The data will be
-    padded till it reaches 10 bytes before it is sent. I.e. if client sends
-    6 items, it will send '6         ' to the server via this function first.
+    blob_views = []
+    offset = body_length
+    for length in blob_lengths:
+        blob_views.append(payload[offset: offset + length])
+        offset += length
 
-    :param clientsocket: socket object with a connection to the other party
-    :param data: data that party wants to send (client only sends size here)
-    :return: the length of the data the party will send
-    """
+    deserialized_data = decode_message_body(payload[:body_length], blob_views)
+
+    size = FRAME_HEADER.size + 8 * num_of_blobs + len(payload)
+    record_message("received", msg_type, size)
 
-    # prepare size, pad with spaces to reach 10 bytes, send data, return the length
-    msg_length = len(data)
-    padded_msg_length = str(msg_length) + ' ' * (10 - len(str(msg_length)))
-    socketobj.sendall((padded_msg_length).encode())
+    if msg_type == MSG_ERROR and expected_type != MSG_ERROR:
+        reason = bytes(deserialized_data).decode(errors="replace") if isinstance(deserialized_data, memoryview) else "no reason given"
+        raise ValueError("The other side could not serve the request: {}".format(reason))
 
-    return msg_length
+    return deserialized_data, size
 
-def get_incoming_data_length(clientsocket: socket.socket) -> int:
+def receive_exactly(socketobj: socket.socket, length: int) -> bytearray:
     """
-    Receives the length of data to receive from the other side of socketobj.
-    Used before the other party sends a larger amount of data.
+    Receives exactly length bytes from the other side of socketobj, directly into a
+    preallocated buffer.
 
-    :param clientsocket: socket object with a connection to the other party
-    :return: the length of the data that the other party will send
+    :param socketobj: socket object with a connection to the other party
+    :param length: number of bytes to receive
+    :return: buffer holding the received bytes
     """
 
-    return int(clientsocket.recv(10).decode().strip())
\ No newline at end of file
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+
+    while received < length:
+        n = socketobj.recv_into(view[received:], length - received)
+        if n == 0:
+            raise ConnectionError("Connection closed after {} of {} bytes".format(received, length))
+        received += n
+
+    return buffer
@@ -0,0 +1,521 @@
+import argparse
+import json
+from multiprocessing import get_context
+import os
+import platform
+import shutil
+import socket
+import tempfile
+from time import perf_counter, process_time, strftime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from rich.console import Console
+from rich.table import Table
+
+from auxiliary_functions import frame_message
+from constants import *
+from oprf_constants import NUM_OF_PROCESSES
+from set_gen import generate_data_sets
+from tracing import children_cpu_time, current_rss, peak_rss, reset_peak_rss
+
+REGRESSION_THRESHOLD = 0.10
+"""
+Relative slowdown (or growth in bytes on the wire) over the baseline reported as a regression.
+"""
+MIN_REGRESSION_SECONDS = 0.05
+"""
+Slowdowns smaller than this (in seconds) are never reported, since they are within timing noise.
+"""
+
+
+class StageTimer():
+    """
+    Measures the wall time and the CPU time (of this process and of its child processes,
+    including the live workers of the persistent pools) spent inside a with block. The
+    pools are not shut down, so later stages run on them warm, as a server would.
+
+    Attributes:
+        wall (float): wall time in seconds
+        cpu (float): CPU time in seconds
+    """
+
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def __enter__(self):
+        self._wall = perf_counter()
+        self._cpu = process_time() + children_cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall += perf_counter() - self._wall
+        self.cpu += process_time() + children_cpu_time() - self._cpu
+
+
+def message_size(data: Any, msg_type: int = MSG_DATA) -> int:
+    """
+    :return: number of bytes serialize_and_send_data would send for data
+    """
+
+    return sum(memoryview(part).nbytes for part in frame_message(data, msg_type))
+
+
+# stages; each one takes the outputs of the previous ones (state) and a StageTimer, and
+# returns its own outputs and the number of bytes it puts on the wire (None if it does not)
+
+def stage_oprf_server_offline(state, timer):
+    from oprf import get_worker_pool, server_prf_offline_parallel
+    from oprf_constants import BASE_ORDER, G, SERVER_OPRF_KEY
+
+    # the persistent pool is started before timing, as it is in a running server
+    get_worker_pool()
+
+    with timer:
+        key_gen_point = (SERVER_OPRF_KEY % BASE_ORDER) * G
+        PRFed_server_set = set(server_prf_offline_parallel(state["server_set"], key_gen_point))
+
+    return {"PRFed_server_set": PRFed_server_set}, None
+
+def stage_simple_hash_insert(state, timer):
+    from simple_hash import SimpleHash
+
+    with timer:
+        SH = SimpleHash(HASH_SEEDS, compact=True)
+        SH.insert_entries(state["PRFed_server_set"])
+
+    return {"SH": SH}, None
+
+def stage_simple_hash_pad(state, timer):
+    SH = state["SH"]
+
+    with timer:
+        SH.pad_bins()
+
+    return {"SH": SH}, None
+
+def stage_simple_hash_partition(state, timer):
+    with timer:
+        poly_coeffs = state["SH"].partition(ALPHA, MINIBIN_CAP, PLAIN_MOD)
+
+    return {"poly_coeffs": poly_coeffs}, None
+
+def stage_oprf_client_offline(state, timer):
+    from oprf import client_prf_offline
+    from oprf_constants import BASE_ORDER, CLIENT_OPRF_KEY, G
+
+    with timer:
+        client_point_precomputed = (CLIENT_OPRF_KEY % BASE_ORDER) * G
+        encoded_client_set = client_prf_offline((state["client_set"], client_point_precomputed))
+
+    return {"encoded_client_set": encoded_client_set}, None
+
+def stage_oprf_server_online(state, timer):
+    from oprf import get_worker_pool, server_prf_online_parallel
+    from oprf_constants import SERVER_OPRF_KEY
+
+    get_worker_pool()
+
+    with timer:
+        PRFed_encoded_client_set = server_prf_online_parallel(state["encoded_client_set"], SERVER_OPRF_KEY)
+
+    return ({"PRFed_encoded_client_set": PRFed_encoded_client_set},
+            message_size(state["encoded_client_set"], MSG_OPRF_REQUEST) + message_size(PRFed_encoded_client_set, MSG_OPRF_RESPONSE))
+
+def stage_oprf_client_online(state, timer):
+    from oprf import client_prf_online_parallel, get_worker_pool
+    from oprf_constants import BASE_ORDER, CLIENT_OPRF_KEY
+
+    get_worker_pool()
+
+    with timer:
+        key_inverse = pow(CLIENT_OPRF_KEY, -1, BASE_ORDER)
+        PRFed_client_set = client_prf_online_parallel(state["PRFed_encoded_client_set"], key_inverse)
+
+    return {"PRFed_client_set": PRFed_client_set}, None
+
+def stage_cuckoo_insert(state, timer):
+    from cuckoo_hash import CuckooHash
+
+    with timer:
+        CH = CuckooHash(HASH_SEEDS, seed=state["seed"])
+        CH.insert_items(state["PRFed_client_set"])
+        CH.pad(2 ** (SIGMA_MAX - OUTPUT_BITS + LOG_NO_HASHES))
+
+    return {"CH": CH}, None
+
+def stage_windowing(state, timer):
+    with timer:
+        windowed_items = state["CH"].windowing(MINIBIN_CAP, PLAIN_MOD)
+
+    return {"windowed_items": windowed_items}, None
+
+def stage_fhe_keygen(state, timer):
+    from client_online import client_FHE_setup
+
+    with timer:
+        HEctx, s_context, s_public_key, s_relin_key = client_FHE_setup(POLY_MOD, PLAIN_MOD)
+
+    return {"fhe_keys": [s_context, s_public_key, HEctx.to_bytes_secret_key(), s_relin_key]}, None
+
+def stage_query_encryption(state, timer):
+    from client_online import create_and_seralize_batched_query
+
+    HEctx = client_context(state["fhe_keys"])
+    s_context, s_public_key, _, s_relin_key = state["fhe_keys"]
+
+    with timer:
+        enc_query_serialized = create_and_seralize_batched_query(HEctx, state["windowed_items"], LOG_B_ELL, BASE, MINIBIN_CAP)
+
+    query = [s_context, s_public_key, s_relin_key, enc_query_serialized]
+
+    return {"query": query}, message_size(query, MSG_QUERY)
+
+def stage_power_recovery(state, timer):
+    from server_online import get_evaluation_pool, reconstruct_encrypted_query, recover_encrypted_powers, server_FHE_setup
+
+    # the persistent pool is started before timing, as it is in a running server
+    if state["processes"] > 1:
+        get_evaluation_pool(state["processes"])
+
+    with timer:
+        pyfhelobj, serialized_query = server_FHE_setup(state["query"])
+        encrypted_query = reconstruct_encrypted_query(pyfhelobj, serialized_query)
+        all_powers = recover_encrypted_powers(encrypted_query, pyfhelobj, state["processes"])
+
+    return {"powers": [power.to_bytes() for power in all_powers]}, None
+
+def stage_response_evaluation(state, timer):
+    from Pyfhel import PyCtxt
+
+    from server_database import write_server_database
+    from server_online import get_evaluation_pool, load_encoded_server_database, prepare_server_response, server_FHE_setup
+
+    # the database is encoded once per loaded file (see load_encoded_server_database), outside the online phase
+    database = os.path.join(state["workdir"], "server_preprocessed")
+    write_server_database(database, state["poly_coeffs"])
+    load_encoded_server_database(database)
+    if state["processes"] > 1:
+        get_evaluation_pool(state["processes"])
+
+    pyfhelobj, _ = server_FHE_setup(state["query"])
+    all_powers = [PyCtxt(pyfhel=pyfhelobj, bytestring=power) for power in state["powers"]]
+
+    with timer:
+        srv_answer = prepare_server_response(pyfhelobj, all_powers, database, processes=state["processes"])
+
+    return {"answer": srv_answer}, message_size(srv_answer, MSG_RESPONSE)
+
+def stage_decryption(state, timer):
+    from client_online import decrypt_ciphertexts
+
+    HEctx = client_context(state["fhe_keys"])
+
+    with timer:
+        decryptions = decrypt_ciphertexts(HEctx, state["answer"])
+
+    return {"decryptions": decryptions}, None
+
+def stage_decoding(state, timer):
+    from client_online import find_client_intersection
+
+    with timer:
+        PSI_intersection = find_client_intersection(state["decryptions"], state["CH"], state["client_set"])
+
+    if set(PSI_intersection) != set(state["intersection"]):
+        raise Exception("Wrong intersection recovered")
+
+    return {"PSI_intersection": PSI_intersection}, None
+
+def stage_loopback(state, timer):
+    """
+    Full online protocol between a server process and this process over a loopback socket.
+    """
+    import pickle
+
+    from client_online import run_client
+    from server_database import write_server_database
+    from oprf import get_worker_pool
+    from server_online import get_evaluation_pool, load_encoded_server_database, serve_client
+
+    quiet = Console(quiet=True)
+
+    os.chdir(state["workdir"])
+    write_server_database("server_preprocessed", state["poly_coeffs"])
+    with open("client_preprocessed", "wb") as f:
+        pickle.dump(state["encoded_client_set"], f)
+    for filename in ("client_fhe_keys", "client_zero_pool"):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("localhost", 0))
+    listener.listen(1)
+
+    def serve():
+        load_encoded_server_database("server_preprocessed")
+        # like server_daemon.py, the server starts its pools before accepting clients
+        get_worker_pool()
+        if state["processes"] > 1:
+            get_evaluation_pool(state["processes"])
+        conn_socket, _ = listener.accept()
+        serve_client(conn_socket, quiet, "server_preprocessed", state["processes"])
+        conn_socket.close()
+
+    server = get_context("fork").Process(target=serve)
+    server.start()
+
+    with timer:
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        PSI_intersection, _, client_to_server_size, server_to_client_size = run_client(client, quiet, state["client_set"])
+        client.close()
+        server.join()
+
+    listener.close()
+
+    if set(PSI_intersection) != set(state["intersection"]):
+        raise Exception("Wrong intersection recovered")
+
+    return {}, client_to_server_size + server_to_client_size
+
+def client_context(fhe_keys):
+    """
+    :return: the client's Pyfhel object, rebuilt from the serialized context and keys
+    """
+    from Pyfhel import Pyfhel
+
+    s_context, s_public_key, s_secret_key, s_relin_key = fhe_keys
+
+    HEctx = Pyfhel()
+    HEctx.from_bytes_context(s_context)
+    HEctx.from_bytes_public_key(s_public_key)
+    HEctx.from_bytes_secret_key(s_secret_key)
+    HEctx.from_bytes_relin_key(s_relin_key)
+
+    return HEctx
+
+
+STAGES = [
+    ("oprf_server_offline", ("server_set",), stage_oprf_server_offline),
+    ("simple_hash_insert", ("PRFed_server_set",), stage_simple_hash_insert),
+    ("simple_hash_pad", ("SH",), stage_simple_hash_pad),
+    ("simple_hash_partition", ("SH",), stage_simple_hash_partition),
+    ("oprf_client_offline", ("client_set",), stage_oprf_client_offline),
+    ("oprf_server_online", ("encoded_client_set",), stage_oprf_server_online),
+    ("oprf_client_online", ("PRFed_encoded_client_set",), stage_oprf_client_online),
+    ("cuckoo_insert", ("PRFed_client_set",), stage_cuckoo_insert),
+    ("windowing", ("CH",), stage_windowing),
+    ("fhe_keygen", (), stage_fhe_keygen),
+    ("query_encryption", ("fhe_keys", "windowed_items"), stage_query_encryption),
+    ("power_recovery", ("query",), stage_power_recovery),
+    ("response_evaluation", ("query", "powers", "poly_coeffs"), stage_response_evaluation),
+    ("decryption", ("fhe_keys", "answer"), stage_decryption),
+    ("decoding", ("decryptions", "CH"), stage_decoding),
+    ("loopback", ("poly_coeffs", "encoded_client_set"), stage_loopback),
+]
+"""
+Benchmarked stages, in order: name, outputs of earlier stages needed, function.
+"""
+
+
+def run_stage_in_child(stage: Callable, state: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Runs a stage in a forked child process, so that its peak memory is measured on its
+    own and nothing it sets up (worker pools, caches) leaks into the next stages.
+
+    :param stage: stage function
+    :param state: outputs of the previous stages
+    :return: the stage's outputs and its measurements
+    """
+
+    receiver, sender = get_context("fork").Pipe(duplex=False)
+
+    def child():
+        try:
+            # the child starts with the parent's peak, which is not the stage's
+            reset_peak_rss()
+            rss_before = current_rss()
+            timer = StageTimer()
+            outputs, wire_bytes = stage(state, timer)
+            sender.send((outputs, {"wall": timer.wall, "cpu": timer.cpu, "peak_rss": peak_rss(),
+                                   "rss_before": rss_before, "bytes": wire_bytes}))
+        except BaseException as e:
+            sender.send(({}, {"error": "{}: {}".format(type(e).__name__, e)}))
+
+    process = get_context("fork").Process(target=child)
+    process.start()
+    sender.close()
+    try:
+        outputs, measurements = receiver.recv()
+    except EOFError:
+        # the child died without reporting (e.g. killed, or crashed in native code)
+        outputs, measurements = {}, None
+    process.join()
+
+    if measurements is None:
+        measurements = {"error": "stage process exited with code {}".format(process.exitcode)}
+
+    return outputs, measurements
+
+
+def run_benchmarks(server_size: int, client_size: int, seed: int, stages: List[str], repeat: int,
+                   processes: int, console: Console) -> List[Dict[str, Any]]:
+    """
+    Runs the stages for one pair of set sizes on seeded data sets.
+
+    :return: one record per stage (the fastest of repeat runs)
+    """
+
+    intersection_size = min(client_size, server_size, client_size * INTERSECTION_SIZE // CLIENT_SIZE)
+
+    client_set, server_set, intersection = generate_data_sets(server_size, client_size, intersection_size, seed)
+
+    workdir = tempfile.mkdtemp(prefix="psi_benchmark_")
+    state = {"server_set": server_set, "client_set": client_set, "intersection": intersection,
+             "seed": seed, "processes": processes, "workdir": workdir}
+
+    # the parameters are part of the record, so that only comparable runs are compared
+    configuration = {"server_size": server_size, "client_size": client_size, "poly_mod": POLY_MOD, "alpha": ALPHA, "ell": ELL}
+
+    records = []
+    try:
+        for name, requires, stage in STAGES:
+            missing = [key for key in requires if key not in state]
+            if name not in stages or missing:
+                if name in stages:
+                    records.append({**configuration, "stage": name, "error": "skipped, missing {}".format(", ".join(missing))})
+                continue
+
+            best = None
+            for _ in range(repeat):
+                outputs, measurements = run_stage_in_child(stage, state)
+                if "error" in measurements:
+                    best = measurements
+                    break
+                if best is None or measurements["wall"] < best["wall"]:
+                    best = measurements
+            state.update(outputs)
+
+            records.append({**configuration, "stage": name, **best})
+
+            if "error" in best:
+                console.log("[red]{} (server {}, client {}): {}[/red]".format(name, server_size, client_size, best["error"]))
+            else:
+                console.log("[yellow]{} (server {}, client {}): {:.3f}s.[/yellow]".format(name, server_size, client_size, best["wall"]))
+    finally:
+        # the files written by the stages (server database, client keys, ...)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return records
+
+
+def record_key(record: Dict[str, Any]) -> Tuple[Any, ...]:
+    """
+    :param record: benchmark record
+    :return: what a record is matched on with the baseline: set sizes, parameters
+             (POLY_MOD, ALPHA and ELL; None in records written before they were recorded)
+             and stage
+    """
+
+    return (record["server_size"], record["client_size"], record.get("poly_mod"), record.get("alpha"),
+            record.get("ell"), record["stage"])
+
+
+def compare_to_baseline(records: List[Dict[str, Any]], baseline: List[Dict[str, Any]],
+                        threshold: float = REGRESSION_THRESHOLD) -> List[Dict[str, Any]]:
+    """
+    Flags the records that are slower (or put more bytes on the wire) than the matching
+    baseline records (see record_key) by more than threshold. Sets "baseline_wall" and "regression" in the
+    records that have a baseline.
+
+    :param records: benchmark records
+    :param baseline: benchmark records of the baseline
+    :param threshold: relative change reported as a regression
+    :return: the records flagged as regressions
+    """
+
+    reference = {record_key(r): r for r in baseline if "error" not in r}
+
+    regressions = []
+    for record in records:
+        base = reference.get(record_key(record))
+        if base is None or "error" in record:
+            continue
+
+        record["baseline_wall"] = base["wall"]
+        slower = (record["wall"] > base["wall"] * (1 + threshold) and record["wall"] - base["wall"] > MIN_REGRESSION_SECONDS)
+        bigger = (record.get("bytes") is not None and base.get("bytes") is not None
+                  and record["bytes"] > base["bytes"] * (1 + threshold))
+        record["regression"] = slower or bigger
+
+        if record["regression"]:
+            regressions.append(record)
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks the PSI protocol stage by stage.")
+    parser.add_argument("--server-sizes", default=str(SERVER_SIZE), help="comma-separated server set sizes")
+    parser.add_argument("--client-sizes", default=str(CLIENT_SIZE), help="comma-separated client set sizes")
+    parser.add_argument("--stages", default=",".join(name for name, _, _ in STAGES), help="comma-separated stages to run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the data sets")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage (the fastest is kept)")
+    parser.add_argument("--processes", type=int, default=NUM_OF_PROCESSES, help="processes used by the parallel stages")
+    parser.add_argument("--output", default="benchmark_results.json", help="file to write the results to (JSON)")
+    parser.add_argument("--baseline", help="results file (JSON) to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    # for prettier printing
+    console = Console()
+
+    stages = args.stages.split(",")
+    records = []
+    for server_size in [int(size) for size in args.server_sizes.split(",")]:
+        for client_size in [int(size) for size in args.client_sizes.split(",")]:
+            records += run_benchmarks(server_size, client_size, args.seed, stages, args.repeat, args.processes, console)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(records, json.load(f)["results"], args.threshold)
+
+    table = Table(title="Benchmark results")
+    for column in ("server", "client", "stage", "wall (s)", "CPU (s)", "peak RSS (MB)", "wire (MB)", "baseline (s)"):
+        table.add_column(column, justify="right")
+    for record in records:
+        if "error" in record:
+            status = "skipped" if record["error"].startswith("skipped") else "failed"
+            table.add_row(str(record["server_size"]), str(record["client_size"]), record["stage"], "[red]{}[/red]".format(status), "", "", "", "")
+            continue
+        style = "[red]{}[/red]" if record.get("regression") else "{}"
+        table.add_row(str(record["server_size"]), str(record["client_size"]), record["stage"],
+                      style.format("{:.3f}".format(record["wall"])), "{:.3f}".format(record["cpu"]),
+                      "{:.0f}".format(record["peak_rss"] / 2 ** 20),
+                      "" if record["bytes"] is None else "{:.2f}".format(record["bytes"] / 2 ** 20),
+                      "{:.3f}".format(record["baseline_wall"]) if "baseline_wall" in record else "")
+    console.print(table)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "metadata": {
+                "date": strftime("%Y-%m-%d %H:%M:%S"),
+                "machine": platform.machine(),
+                "python": platform.python_version(),
+                "processes": args.processes,
+                "seed": args.seed,
+                "parameters": {"POLY_MOD": POLY_MOD, "PLAIN_MOD": PLAIN_MOD, "NUM_OF_BINS": NUM_OF_BINS,
+                               "BIN_CAP": BIN_CAP, "ALPHA": ALPHA, "MINIBIN_CAP": MINIBIN_CAP, "ELL": ELL},
+            },
+            "results": records,
+        }, f, indent=4)
+
+    if regressions:
+        console.log("[red]{} regressions over the baseline.[/red]".format(len(regressions)))
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
+import os
 import pickle
-from time import time
 
+import numpy as np
 from rich.console import Console
 
 from auxiliary_functions import *
+from client_online import client_FHE_setup, key_fingerprint, zero_pool_lock
 from oprf import client_prf_offline
-from oprf_constants import BASE_ORDER, G, CLIENT_OPRF_KEY
+from oprf_constants import BASE_ORDER, G, CLIENT_OPRF_KEY, NUM_OF_PROCESSES
+import tracing
 
 def main():
     # for prettier printing
@@ -13,20 +16,17 @@ def main():
 
     with console.status("[bold red]Client offline in progress...") as status:
 
-        t0 = time()
+        with tracing.stage("client_oprf_offline") as oprf_stage:
+            # key * generator of elliptic curve
+            client_point_precomputed = (CLIENT_OPRF_KEY % BASE_ORDER) * G
 
-        # key * generator of elliptic curve
-        client_point_precomputed = (CLIENT_OPRF_KEY % BASE_ORDER) * G
+            # store client's set in memory 
+            client_set = read_file_return_list_of_int("client_set")
 
-        # store client's set in memory 
-        client_set = read_file_return_list_of_int("client_set")
+            # Client's items are encoded on the elliptic curve, retrieve the x and y coords of each point (item)
+            encoded_client_set = client_prf_offline((client_set, client_point_precomputed))
 
-        # Client's items are encoded on the elliptic curve, retrieve the x and y coords of each point (item)
-        encoded_client_set = client_prf_offline((client_set, client_point_precomputed))
-
-        t1 = time()
-
-        console.log("[yellow]OPRF preprocessing finished. Time taken: {:.2f}s.[/yellow]".format(t1-t0))
+        console.log("[yellow]OPRF preprocessing finished. Time taken: {:.2f}s.[/yellow]".format(oprf_stage.wall_time))
 
 
         # write the preprocessed client's set to disk
@@ -34,9 +34,41 @@ def main():
         pickle.dump(encoded_client_set, g)
         g.close()
 
-        t2 = time()
+        with tracing.stage("fhe_precomputation") as fhe_stage:
+            # FHE keys are generated ahead of time, so that encryptions of zero can be precomputed under them;
+            # every run rotates them, and they are reused for QUERIES_PER_KEY queries (see constants.py)
+            HEctx, s_context, s_public_key, s_relin_key = client_FHE_setup(POLY_MOD, PLAIN_MOD)
+
+            zero_encryptions = fork_map(encrypt_zero, range(ZERO_POOL_SIZE), HEctx, NUM_OF_PROCESSES)
+
+            # the file holds the secret key, so it is created readable by the owner only
+            fd = os.open('client_fhe_keys.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'wb') as g:
+                pickle.dump([s_context, s_public_key, HEctx.to_bytes_secret_key(), s_relin_key], g)
+            os.replace('client_fhe_keys.tmp', 'client_fhe_keys')
+
+            # the pool replaces any previous one; it is tagged with the public key it was made under
+            with zero_pool_lock('client_zero_pool'):
+                g = open('client_zero_pool.tmp', 'wb')
+                pickle.dump([key_fingerprint(s_public_key), zero_encryptions], g)
+                g.close()
+                os.replace('client_zero_pool.tmp', 'client_zero_pool')
+
+        console.log("[yellow]FHE keys generated and {} encryptions of zero precomputed ({} queries). Time taken: {:.2f}s.[/yellow]".format(ZERO_POOL_SIZE, QUERIES_PER_KEY, fhe_stage.wall_time))
+
+        console.log("[blue]Client offline total time: {:.2f}s[/blue]".format(oprf_stage.wall_time + fhe_stage.wall_time))
+
+    tracing.export()
+
+
+def encrypt_zero(HEctx, _):
+    """
+    :param HEctx: the client's Pyfhel object
+    :return: a fresh encryption of zero (all slots), serialized
+    """
 
-        console.log("[blue]Client offline total time: {:.2f}s[/blue]".format(t2-t0))
+    return HEctx.encrypt(np.zeros(POLY_MOD, dtype=np.int64)).to_bytes()
 
 
 
@@ -1,16 +1,23 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
 from math import log2
+import os
 import pickle
 import socket
 from time import time
+from typing import List, Tuple
 
+import numpy as np
 from Pyfhel import Pyfhel, PyCtxt
 from rich.console import Console
 
-from auxiliary_functions import serialize_and_send_data, get_and_deserialize_data
+from auxiliary_functions import get_and_deserialize_data, read_file_return_list_of_int, serialize_and_send_data
 from constants import *
-from cuckoo_hash import reconstruct_item, CuckooHash
+from cuckoo_hash import CuckooHash
 from oprf import client_prf_online_parallel
 from oprf_constants import BASE_ORDER, CLIENT_OPRF_KEY
+import tracing
 
 dummy_msg_client = 2 ** (SIGMA_MAX - OUTPUT_BITS + LOG_NO_HASHES)
 
@@ -23,79 +30,134 @@ def main():
 
         t0 = time()
 
+        # client's set, in the same order as the preprocessed items (see client_offline.py)
+        client_set = read_file_return_list_of_int("client_set")
+
         # connect to server
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect(('localhost', 4470))
+        client.connect((SERVER_HOST, SERVER_PORT))
+
+        PSI_intersection, computation_time, client_to_server_size, server_to_client_size = run_client(client, console, client_set)
+
+        t1 = time()
+
+        # disconnect from server
+        client.close()
+
+        console.log("\n[blue]Intersection recovered correctly: {}[/blue]".format(check_if_recovered_real_intersection(PSI_intersection, "intersection")))
+        console.log("[blue]Client time spent on computations: {:.2f}s[/blue]".format(computation_time))
+        console.log("[blue]Client program total time: {:.2f}s[/blue]".format(t1 - t0))
+        console.log("[blue]Communication sizes:[/blue]")
+        console.log("[blue]\tClient --> Server:\t{:.2f} MB[/blue]".format(client_to_server_size / 2 ** 20))
+        console.log("[blue]\tServer --> Client:\t{:.2f} MB[/blue]".format(server_to_client_size / 2 ** 20))
+
+    tracing.export()
+
+
+def run_client(client: socket.socket, console: Console, client_set: List[int]) -> Tuple[List[int], float, int, int]:
+    """
+    Runs the online phase of the protocol with the server: the OPRF, then the query
+    and the recovery of the intersection. Uses the files written by client_offline.py
+    (in the current directory).
+
+    :param client: socket connected to the server
+    :param console: rich console used for progress messages
+    :param client_set: client's set, in the same order as the preprocessed items
+    :returns:
+        PSI_intersection: the client's intersection with the server set
+        computation_time: time (in seconds) spent on computations
+        client_to_server_size: number of bytes sent to the server
+        server_to_client_size: number of bytes received from the server
+    """
 
-        # FHE setup
-        # HEctx, s_context, s_public_key, s_relin_key, s_rotate_key = client_FHE_setup(POLY_MOD, PLAIN_MOD)
-        HEctx, s_context, s_public_key, s_relin_key = client_FHE_setup(POLY_MOD, PLAIN_MOD)
-        console.log("[yellow]FHE setup finished.[/yellow]")
+    with tracing.stage("client_session") as session:
+        # FHE setup; keys and encryptions of zero precomputed by client_offline.py are used if present
+        with tracing.stage("fhe_setup") as fhe_stage:
+            HEctx = None
+            if os.path.exists("client_fhe_keys"):
+                HEctx, s_context, s_public_key, s_relin_key = load_client_FHE_keys("client_fhe_keys")
+                zero_encryptions = take_zero_encryptions("client_zero_pool", QUERY_CIPHERTEXTS, key_fingerprint(s_public_key))
+                if len(zero_encryptions) < QUERY_CIPHERTEXTS:
+                    # the precomputed keys are only reused for the QUERIES_PER_KEY queries their pool covers
+                    console.log("[red]The precomputed encryptions of zero are used up; run client_offline.py to rotate the FHE keys and refill them. Fresh keys are used for this query.[/red]")
+                    HEctx = None
+                else:
+                    console.log("[yellow]FHE keys loaded, {} precomputed encryptions of zero taken.[/yellow]".format(len(zero_encryptions)))
+            if HEctx is None:
+                # HEctx, s_context, s_public_key, s_relin_key, s_rotate_key = client_FHE_setup(POLY_MOD, PLAIN_MOD)
+                HEctx, s_context, s_public_key, s_relin_key = client_FHE_setup(POLY_MOD, PLAIN_MOD)
+                zero_encryptions = []
+                console.log("[yellow]FHE setup finished.[/yellow]")
 
         # send our EC embedded items to server
-        client_to_server_communiation_oprf = serialize_and_send_data(client, filename="client_preprocessed")
+        with tracing.stage("send_oprf_request") as send_oprf_stage:
+            serialize_and_send_data(client, filename="client_preprocessed", msg_type=MSG_OPRF_REQUEST)
         console.log("[yellow]Elliptic curve embedded items sent to server.[/yellow]")
 
         # get the PRFed version of our set back from server
-        PRFed_encoded_client_set, server_to_client_communication_oprf = get_and_deserialize_data(client)
+        with tracing.stage("receive_oprf_response") as receive_oprf_stage:
+            PRFed_encoded_client_set, _ = get_and_deserialize_data(client, MSG_OPRF_RESPONSE)
         console.log("[yellow]PRFed items received from server.[/yellow]")
 
 
         # We finalize the OPRF processing by applying the inverse of the secret key, oprf_client_key
-        key_inverse = pow(CLIENT_OPRF_KEY, -1, BASE_ORDER)
-        PRFed_client_set = client_prf_online_parallel(PRFed_encoded_client_set, key_inverse)
+        with tracing.stage("client_oprf_online") as oprf_stage:
+            key_inverse = pow(CLIENT_OPRF_KEY, -1, BASE_ORDER)
+            PRFed_client_set = client_prf_online_parallel(PRFed_encoded_client_set, key_inverse)
         console.log("[yellow]OPRF processing finished.[/yellow]")
 
         # Each PRFed item from the client set is mapped to a Cuckoo hash table
         # We pad the Cuckoo vector with dummy messages
-        CH = CuckooHash(HASH_SEEDS)
-        CH.insert_items(PRFed_client_set)
-        CH.pad(dummy_msg_client)
+        with tracing.stage("cuckoo_hashing") as hashing_stage:
+            CH = CuckooHash(HASH_SEEDS)
+            CH.insert_items(PRFed_client_set)
+            CH.pad(dummy_msg_client)
 
         console.log("[yellow]PRF-encoded items inserted into Cuckoo hash table.[/yellow]")
+        if CH.dropped:
+            console.log("[red]{} items did not fit in the Cuckoo hash table and are left out of the query; they will be missing from the intersection.[/red]".format(len(CH.dropped)))
 
         # Window procedure for all the items in the CH table
-        windowed_items =  CH.windowing(MINIBIN_CAP, PLAIN_MOD)
+        with tracing.stage("windowing") as windowing_stage:
+            windowed_items =  CH.windowing(MINIBIN_CAP, PLAIN_MOD)
         console.log("[yellow]Windowing procedure applied to items in the Cuckoo hash table.[/yellow]")
 
         # batching
-        enc_query_serialized = create_and_seralize_batched_query(HEctx, windowed_items, LOG_B_ELL, BASE, MINIBIN_CAP)
+        with tracing.stage("query_encryption") as encryption_stage:
+            enc_query_serialized = create_and_seralize_batched_query(HEctx, windowed_items, LOG_B_ELL, BASE, MINIBIN_CAP, zero_encryptions)
         console.log("[yellow]Batched query finalized.[/yellow]")
 
-        t1 = time()
-        
         # set up and serialize the query to be sent to the server
         # message_to_be_sent = [s_context, s_public_key, s_relin_key, s_rotate_key, enc_query_serialized]
         message_to_be_sent = [s_context, s_public_key, s_relin_key, enc_query_serialized]
         # send query to server
-        client_to_server_communiation_query = serialize_and_send_data(client, data=message_to_be_sent)
+        with tracing.stage("send_query"):
+            serialize_and_send_data(client, data=message_to_be_sent, msg_type=MSG_QUERY)
         console.log("[yellow]Query sent to server, waiting for answer.[/yellow]")
 
         # get the ciphertexts from server
-        ciphertexts, server_to_client_query_response = get_and_deserialize_data(client)
+        with tracing.stage("receive_response"):
+            ciphertexts, _ = get_and_deserialize_data(client, MSG_RESPONSE)
         console.log("[yellow]Answer containing ciphertexts received from server.[/yellow]")
 
-        t2 = time()
-
         # decrypt ciphertexts
-        decryptions = decrypt_ciphertexts(HEctx, ciphertexts)
+        with tracing.stage("decryption") as decryption_stage:
+            decryptions = decrypt_ciphertexts(HEctx, ciphertexts)
         console.log("[yellow]Ciphertexts decrypted.[/yellow]")
 
         # find the client's intersection with the server set (as found by the PSI protocol)
-        PSI_intersection = find_client_intersection(decryptions, windowed_items, PRFed_client_set)
+        with tracing.stage("intersection") as intersection_stage:
+            PSI_intersection = find_client_intersection(decryptions, CH, client_set)
         console.log("[yellow]Client and server intersection found.[/yellow]")
 
-        t3 = time()
+    # the exchange of the OPRF is counted as computation, since the client waits for the server's OPRF there
+    computation_stages = [fhe_stage, send_oprf_stage, receive_oprf_stage, oprf_stage, hashing_stage,
+                          windowing_stage, encryption_stage, decryption_stage, intersection_stage]
 
-        # disconnect from server
-        client.close()
-
-        console.log("\n[blue]Intersection recovered correctly: {}[/blue]".format(check_if_recovered_real_intersection(PSI_intersection, "intersection")))
-        console.log("[blue]Client time spent on computations: {:.2f}s[/blue]".format(t1-t0+t3-t2))
-        console.log("[blue]Client program total time: {:.2f}s[/blue]".format(t3 - t0))
-        console.log("[blue]Communication sizes:[/blue]")
-        console.log("[blue]\tClient --> Server:\t{:.2f} MB[/blue]".format((client_to_server_communiation_oprf + client_to_server_communiation_query )/ 2 ** 20))
-        console.log("[blue]\tServer --> Client:\t{:.2f} MB[/blue]".format((server_to_client_communication_oprf + server_to_client_query_response )/ 2 ** 20))
+    return (PSI_intersection,
+            sum(stage.wall_time for stage in computation_stages),
+            session.total_bytes_sent,
+            session.total_bytes_received)
 
 
 def client_FHE_setup(polynomial_modulus, coefficient_modulus):
@@ -121,39 +183,124 @@ def client_FHE_setup(polynomial_modulus, coefficient_modulus):
     # return (HEctx, s_context, s_public_key, s_relin_key, s_rotate_key)
     return (HEctx, s_context, s_public_key, s_relin_key)
 
-def create_and_seralize_batched_query(pyfhelobj, windowed_items, log_b_ell, base, minibin_cap):
+def load_client_FHE_keys(filename):
+    """
+    Loads the client's FHE context and keys saved by client_offline.py.
+
+    :param filename: name of the file holding the serialized context and keys
+    :return: the Pyfhel object, context, public key and relinearization key in a 4-tuple
+             (the last 3 as bytes for sending to server), like client_FHE_setup.
+    """
+    with open(filename, "rb") as f:
+        s_context, s_public_key, s_secret_key, s_relin_key = pickle.load(f)
+
+    HEctx = Pyfhel()
+    HEctx.from_bytes_context(s_context)
+    HEctx.from_bytes_public_key(s_public_key)
+    HEctx.from_bytes_secret_key(s_secret_key)
+    HEctx.from_bytes_relin_key(s_relin_key)
+
+    return (HEctx, s_context, s_public_key, s_relin_key)
+
+def key_fingerprint(s_public_key):
+    """
+    :param s_public_key: serialized public key
+    :return: SHA-256 digest (hex) identifying the key, stored with the encryptions of zero made under it
+    """
+    return hashlib.sha256(bytes(s_public_key)).hexdigest()
+
+@contextmanager
+def zero_pool_lock(filename):
+    """
+    Holds an exclusive lock on the pool of encryptions of zero saved in filename, so that
+    concurrent clients (and client_offline.py refilling the pool) change it one at a time.
+    The lock is taken on the separate file filename + ".lock", since the pool file itself
+    is replaced rather than rewritten.
+
+    :param filename: name of the pool file
+    """
+    fd = os.open(filename + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+def take_zero_encryptions(filename, count, fingerprint):
+    """
+    Takes up to count precomputed encryptions of zero from the pool saved by client_offline.py.
+    The taken encryptions are removed from the pool file before they are returned, so
+    that none of them is ever used twice, even if the client crashes afterwards. The pool
+    is locked (see zero_pool_lock) from the read to the replacement, so concurrent clients
+    never take the same encryptions.
+
+    :param filename: name of the pool file
+    :param count: number of encryptions of zero wanted
+    :param fingerprint: fingerprint of the public key in use (see key_fingerprint)
+    :return: list of at most count serialized encryptions of zero (empty if there is no pool,
+             or if it was made under other keys)
+    """
+    with zero_pool_lock(filename):
+        if not os.path.exists(filename):
+            return []
+
+        with open(filename, "rb") as f:
+            pool_fingerprint, pool = pickle.load(f)
+
+        if pool_fingerprint != fingerprint:
+            return []
+
+        taken, rest = pool[:count], pool[count:]
+
+        # write the rest of the pool to a new file and swap it in atomically
+        with open(filename + ".tmp", "wb") as f:
+            pickle.dump([fingerprint, rest], f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + ".tmp", filename)
+
+    return taken
+
+def query_positions(log_b_ell, base, minibin_cap):
     """
-    Given a list of windowed items, returns a serialized and batched query to be sent to the server.
-    Using the provided Pyfhel object, pyfhelobj, the query is of course encrypted.
+    :return: the positions (j, i) of the ciphertexts in the batched query, i.e. those
+             holding y ** ((j + 1) * base ** i) with an exponent of at most minibin_cap
+    """
+    return [(j, i) for i in range(log_b_ell) for j in range(base - 1) if (j + 1) * base ** i - 1 < minibin_cap]
+
+def create_and_seralize_batched_query(pyfhelobj, windowed_items, log_b_ell, base, minibin_cap, zero_encryptions=()):
+    """
+    Given the windowed items, returns a serialized and batched query to be sent to the server.
+    Using the provided Pyfhel object, pyfhelobj, the query is of course encrypted. Precomputed
+    encryptions of zero are turned into query ciphertexts by adding the encoded plaintext to
+    them; the remaining ciphertexts are encrypted from scratch.
     
     :param pyfhelobj: the Pyfhel object
-    :param windowed_items: client's windowed items
+    :param windowed_items: client's windowed items, as returned by CuckooHash.windowing
+    :param zero_encryptions: serialized encryptions of zero, each used for one ciphertext
     :return: batched query
     """
-    plain_query = [None for k in range(len(windowed_items))]
-    enc_query = [[None for j in range(log_b_ell)] for i in range(1, base)]
+    enc_query_serialized = [[None for j in range(log_b_ell)] for i in range(1, base)]
 
     # We create the <<batched>> query to be sent to the server
     # By our choice of parameters, number of bins = poly modulus degree (m/N =1), so we get (base - 1) * logB_ell ciphertexts
-    for i in range(log_b_ell):
-        for j in range(base - 1):
-            if ((j + 1) * base ** i - 1 < minibin_cap):
-                for k in range(len(windowed_items)):
-                    plain_query[k] = windowed_items[k][j][i]
-                enc_query[j][i] = pyfhelobj.encrypt(plain_query)
-    
-    enc_query_serialized = [[None for j in range(log_b_ell)] for i in range(1, base)]
-
-    for i in range(log_b_ell):
-        for j in range(base - 1):
-            if ((j + 1) * base ** i - 1 < minibin_cap):
-                enc_query_serialized[j][i] = enc_query[j][i].to_bytes()
+    for k, (j, i) in enumerate(query_positions(log_b_ell, base, minibin_cap)):
+        # windowed_items[j, i] is already the (contiguous) slot vector of the ciphertext
+        if k < len(zero_encryptions):
+            # Enc(0) + m is an encryption of m as good as a fresh one
+            ciphertext = PyCtxt(pyfhel=pyfhelobj, bytestring=zero_encryptions[k])
+            pyfhelobj.add_plain(ciphertext, pyfhelobj.encodeInt(windowed_items[j, i]))
+        else:
+            ciphertext = pyfhelobj.encrypt(windowed_items[j, i])
+        enc_query_serialized[j][i] = ciphertext.to_bytes()
 
     return enc_query_serialized
 
 def decrypt_ciphertexts(pyfhelobj, ciphertexts, scheme="bfv"):
     """
-    Decrypts a lits of ciphertexts, returns a list of plaintexts.
+    Decrypts a lits of ciphertexts, returns a list of plaintexts. Their noise budget is
+    checked, since decrypting a ciphertext without any budget left gives garbage.
 
     :param pyfhelobj: the Pyfhel object
     :param ciphertexts: list of ciphertexts
@@ -163,44 +310,32 @@ def decrypt_ciphertexts(pyfhelobj, ciphertexts, scheme="bfv"):
 
     decryptions = []
     for ct in ciphertexts:
-        decryptions.append(PyCtxt(bytestring=ct, pyfhel=pyfhelobj, scheme=scheme).decrypt())
+        ctxt = PyCtxt(bytestring=bytes(ct), pyfhel=pyfhelobj, scheme=scheme)
+        if pyfhelobj.noise_level(ctxt) <= 0:
+            raise Exception("Server response has no noise budget left; the evaluation is too deep for the BFV parameters in constants.py")
+        decryptions.append(ctxt.decrypt())
     return decryptions
 
-def find_client_intersection(decryptions, windowed_items, PRFed_client_set,):
+def find_client_intersection(decryptions, CH, client_set):
     """
-    Finds the client's intersection given the list of decrypted answers from the server,
-    the client's windowed items, and the PRF-processed client set.
+    Finds the client's intersection given the list of decrypted answers from the server.
+    A zero in slot i of any decryption means that the item in bin i of the Cuckoo hash
+    table is in the server's set; the item is found through the table's item_indices.
 
     :param decryptions: list of decrypted ciphertexts
-    :param windowed_items: client's windowed items
-    :param PRFed_client_set: client's PRFed client set
+    :param CH: client's Cuckoo hash table, filled with the PRFed client set
+    :param client_set: client's set, in the order its PRFed items were inserted into CH
     :return: the client's intersection with the server set
     """
 
-    recover_CH_structure = []
-    for matrix in windowed_items:
-        recover_CH_structure.append(matrix[0][0])
-
-    count = [0] * ALPHA
-
-    # get client's set
-    g = open('client_set', 'r')
-    client_set_entries = g.readlines()
-    g.close()
+    # bins with a zero in at least one of the ALPHA decryptions
+    hits = np.nonzero((np.asarray(decryptions)[:, :CH.number_of_bins] == 0).any(axis=0))[0]
 
-    client_intersection = []
+    # indices of the items in those bins; bins padded with a dummy message have index -1
+    item_indices = np.asarray(CH.item_indices)[hits]
+    item_indices = item_indices[item_indices >= 0]
 
-    for j in range(ALPHA):
-        for i in range(POLY_MOD):
-            if decryptions[j][i] == 0:
-                count[j] = count[j] + 1
-                # The index i is the location of the element in the intersection
-                # Here we recover this element from the Cuckoo hash structure
-                PRFed_common_element = reconstruct_item(recover_CH_structure[i], i, HASH_SEEDS[recover_CH_structure[i] % (2 ** LOG_NO_HASHES)])
-                index = PRFed_client_set.index(PRFed_common_element)
-                client_intersection.append(int(client_set_entries[index][:-1]))
-
-    return client_intersection
+    return [client_set[index] for index in item_indices]
 
 def check_if_recovered_real_intersection(PSI_intersection, real_intersection_file):
     """
@@ -211,10 +346,8 @@ def check_if_recovered_real_intersection(PSI_intersection, real_intersection_fil
     :param real_intersection_file: filename of file containing the real client/server set intersection
     :return: boolean indicating whether the correct intersection was recovered or not
     """
-    h = open(real_intersection_file, 'r')
-    real_intersection = [int(line[:-1]) for line in h]
-    h.close()
-    
+    real_intersection = read_file_return_list_of_int(real_intersection_file)
+
     return set(PSI_intersection) == set(real_intersection)
 
 if __name__ == "__main__":
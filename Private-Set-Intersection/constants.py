@@ -15,6 +15,18 @@ How many items the server and client should have in common.
 Make sure it is smaller than both the client and server size.
 """
 
+# Set files
+SET_FILE_MAGIC = b"PSISET01"
+"""
+First bytes of a set file in binary format; they are followed by the number of items
+(unsigned 64-bit, little-endian) and the items themselves (unsigned 64-bit, little-endian).
+Set files without it are text files with one item per line.
+"""
+SET_CHUNK_SIZE = 2 ** 20
+"""
+Number of items generated, written or read at a time when streaming a set file.
+"""
+
 # Hash constants
 NUM_OF_HASHES = 3
 """
@@ -37,6 +49,18 @@ POW_2_MASK = 2 ** OUTPUT_BITS - 1
 The bitmask to select the lower OUTPUT_BITS bits of a hash value.
 Limits the range of the hash value to a OUTPUT_BITS bits.
 """
+MAX_DROPPED_ITEMS = 0
+"""
+How many client items Cuckoo hashing may leave out of the table when they cannot be placed.
+This is not a stash: dropped items are not part of the query, so they are never found in the
+intersection even if the server has them. Keep it at 0 unless losing a few items is acceptable;
+with 0, hashing is retried and then fails instead.
+"""
+CUCKOO_RETRIES = 3
+"""
+How many times Cuckoo hashing starts over with a different random walk (seeded from the
+original seed) before giving up.
+"""
 
 # BFV scheme parameters
 PLAIN_MOD = 536903681
@@ -80,7 +104,118 @@ LOG_B_ELL = int(log2(MINIBIN_CAP/ELL)) + 1
 Number of elements in each row of the windowing matrix. Needs to be <= 2 ** HE.depth
 """
 
+# Client precomputation
+QUERY_CIPHERTEXTS = sum(1 for i in range(LOG_B_ELL) for j in range(1, BASE) if j * BASE ** i <= MINIBIN_CAP)
+"""
+Number of ciphertexts in a query: one per windowed power y ** (j * BASE ** i) with an
+exponent of at most MINIBIN_CAP (see query_positions in client_online.py).
+"""
+QUERIES_PER_KEY = 16
+"""
+Number of queries the client makes with the FHE keys generated by client_offline.py.
+Reusing the keys is a deliberate trade-off: it lets the encryptions of zero be precomputed
+offline, but the server can link the queries made under the same public key, and the
+secret key stays on disk (readable by the owner only) for longer. Once the queries are
+used up, the client generates fresh keys for every query until client_offline.py is run
+again, which rotates the keys.
+"""
+ZERO_POOL_SIZE = QUERIES_PER_KEY * QUERY_CIPHERTEXTS
+"""
+Number of encryptions of zero the client precomputes offline (see client_offline.py).
+Every query ciphertext uses one of them, so this covers QUERIES_PER_KEY queries.
+"""
+
+# Server preprocessing
+OFFLINE_MEMORY_BUDGET = 2 ** 30
+"""
+Approximate bound (in bytes) on the memory used by the server offline phase, on top of
+the interpreter itself. The server set is OPRFed in chunks and the bins are interpolated
+in ranges sized to fit it (see server_offline.py).
+"""
+
+# Polynomial evaluation
+POLY_EVALUATION = "flat"
+"""
+How the server evaluates the minibin polynomials: "flat" computes all the powers
+y, ..., y ** MINIBIN_CAP and takes a dot product with the coefficients (no ciphertext
+multiplications per minibin); "paterson-stockmeyer" computes only about 2 * sqrt(MINIBIN_CAP)
+powers, at the price of ciphertext multiplications per minibin (see plan_paterson_stockmeyer
+in auxiliary_functions.py).
+"""
+PS_BABY_STEPS = 0
+"""
+Number of baby steps for the Paterson-Stockmeyer evaluation; 0 picks the number needing
+the fewest ciphertext multiplications for the current ALPHA and windowing parameters.
+"""
+
 SIGMA_MAX = int(log2(PLAIN_MOD)) + OUTPUT_BITS - (int(log2(NUM_OF_HASHES)) + 1)
 """
 The length of the database items.
-"""
\ No newline at end of file
+"""
+
+# Network
+SERVER_HOST = 'localhost'
+"""
+Address the server listens on and the client connects to.
+"""
+SERVER_PORT = 4470
+"""
+Port the server listens on and the client connects to.
+"""
+SESSION_TIMEOUT = 300
+"""
+Time (in seconds) the server waits on a client or shard connection, for each send or
+receive, before it drops the session; it must cover the longest computation the other
+side does between two messages (e.g. a shard evaluating its partitions).
+"""
+MAX_FRAME_SIZE = 2 ** 30
+"""
+Largest message (in bytes, framing included) accepted from the other party; larger
+frames are rejected before anything is allocated for them.
+"""
+WORKER_RESPAWN_DELAY = 1
+"""
+Time (in seconds) the server waits before restarting a worker process that exited, so
+that a worker failing at startup is not restarted in a tight loop.
+"""
+
+# Sharding
+SHARD_BASE_PORT = 4471
+"""
+Port of the first local shard server; shard i listens on SHARD_BASE_PORT + i by default.
+"""
+
+# Message types
+MSG_DATA = 0
+"""
+Message without a specific type.
+"""
+MSG_OPRF_REQUEST = 1
+"""
+Client --> Server: the client's elliptic curve embedded items.
+"""
+MSG_OPRF_RESPONSE = 2
+"""
+Server --> Client: the client's items multiplied by the server's OPRF key.
+"""
+MSG_QUERY = 3
+"""
+Client --> Server: the client's FHE context, keys and encrypted query.
+"""
+MSG_RESPONSE = 4
+"""
+Server --> Client: the evaluated polynomials in encrypted form.
+"""
+MSG_SHARD_QUERY = 5
+"""
+Front end --> Shard: the client's FHE context and relinearization key, the partitions to
+evaluate and the client's encrypted powers (see server_frontend.py).
+"""
+MSG_SHARD_RESPONSE = 6
+"""
+Shard --> Front end: the evaluated polynomials of the requested partitions.
+"""
+MSG_ERROR = 7
+"""
+Either side: the request could not be served; the body is the reason, as UTF-8 bytes.
+"""
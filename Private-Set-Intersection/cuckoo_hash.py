@@ -1,12 +1,13 @@
 import math
-from random import randint
-from typing import List, Tuple, Union
+from random import Random, SystemRandom
+from typing import Iterable, List
 
 # The hash family used for Cuckoo hashing relies on the Murmur hash family (mmh3)
 import mmh3
+import numpy as np
 
-from auxiliary_functions import get_random_distinct_integer, windowing
-from constants import LOG_NO_HASHES, OUTPUT_BITS, NUM_OF_HASHES, NUM_OF_BINS, POW_2_MASK
+from auxiliary_functions import windowing_batched
+from constants import CUCKOO_RETRIES, LOG_NO_HASHES, OUTPUT_BITS, NUM_OF_HASHES, NUM_OF_BINS, POW_2_MASK, MAX_DROPPED_ITEMS
 
 
 def location(seed, item):
@@ -35,44 +36,25 @@ def left_and_index(item, index):
     return ((item >> (OUTPUT_BITS)) << (LOG_NO_HASHES)) + index 	
 
 
-def extract_index(item_left_and_index): 
-    '''
-    Extracts the index from an integer that combines an item and an index.
-
-    :param item_left_and_index: an integer represented as item_left || index
-    :return: index extracted
-    '''
-    return item_left_and_index & (2 ** LOG_NO_HASHES - 1) 
-
-
-def reconstruct_item(item_left_and_index, current_location, seed):
-    '''
-    Reconstructs the original item from an integer that combines an item
-    and an index, the corresponding location obtained from the location()
-    function, and the seed value used by the Murmur hash function.
-
-    :param item_left_and_index: an integer represented as item_left || index
-    :param current_location: the corresponding location, i.e. Murmur_hash(item_left) xor item_right
-    :param seed: the seed of the Murmur hash function
-    :return: the integer item
-    '''
-    item_left = item_left_and_index >> LOG_NO_HASHES
-    hashed_item_left = mmh3.hash(str(item_left), seed, signed=False) >> (32 - OUTPUT_BITS)
-    item_right = hashed_item_left ^ current_location
-    return (item_left << OUTPUT_BITS) + item_right
-
-
 class CuckooHash():
     """
-    The CuckooHash class implements a data structure for cuckoo hashing.
+    The CuckooHash class implements a data structure for cuckoo hashing. Items are
+    inserted in batches: the NUM_OF_HASHES candidate locations of each item are computed
+    once, and items are placed with an iterative random walk over those locations.
 
     Attributes:
         hash_seed (list): A list of integers that will be used as seeds for hashing.
         number_of_bins (int): The number of bins in the hash table.
-        recursion_depth (int): The maximum recursion depth when inserting an item into the hash table.
-        data_structure (list): The actual hash table represented as a list.
-        insert_index (int): The current index used for inserting an item into the hash table.
-        depth (int): The current recursion depth when inserting an item into the hash table.
+        max_evictions (int): The maximum number of evictions when inserting an item into the hash table.
+        max_dropped (int): The maximum number of items left out of the table when they cannot be placed.
+        seed (int): The seed of the random walk; retries use seed + 1, seed + 2, ...
+        items (list): The inserted items, in insertion order.
+        item_indices (np.ndarray): For each slot, the index (in items) of the item stored there, or -1.
+        hash_indices (np.ndarray): For each slot, the index of the hash function that placed its item there.
+        dropped (list): Indices (in items) of the items that could not be placed in the table. They are
+                        not part of the query, so they are never found in the intersection.
+        data_structure (np.ndarray): The hash table; slot i holds item_left || hash index of its item,
+                                     the dummy message once padded, or -1 if empty.
 
     Methods:
         insert_items(items: List[int]) -> None:
@@ -84,32 +66,61 @@ class CuckooHash():
         pad(dummy_msg: Any) -> None:
             Fills the remaining empty slots in the hash table with a dummy message.
 
-        windowing(minibin_cap: int, plain_mod: int) -> List:
-            Applies windowing to all items in the hash table and returns a list of the windowed items.
+        windowing(minibin_cap: int, plain_mod: int) -> np.ndarray:
+            Applies windowing to all items in the hash table and returns the windowed items.
     """
 
-    def __init__(self, hash_seed: List[int]):
+    def __init__(self, hash_seed: List[int], max_dropped: int = MAX_DROPPED_ITEMS, seed: int = None):
         """
         CuckooHash Constructor.
 
         :param hash_seed: A list of NUM_OF_HASHES integers that are used as the seeds for the hash functions.
+        :param max_dropped: The maximum number of items that may be left out of the table (see MAX_DROPPED_ITEMS).
+        :param seed: A seed for the random walk (random if None).
         """
         self.number_of_bins = NUM_OF_BINS
-        self.recursion_depth = int(8 * math.log(self.number_of_bins) / math.log(2))
-        self.data_structure = [None for j in range(self.number_of_bins)]
-        self.insert_index = randint(0, NUM_OF_HASHES - 1)
-        self.depth = 0
+        self.max_evictions = int(8 * math.log(self.number_of_bins) / math.log(2))
+        self.max_dropped = max_dropped
+        self.seed = SystemRandom().getrandbits(64) if seed is None else seed
+        self.random = Random(self.seed)
+
+        self.items = []
+        self.locations = []
+        self.item_indices = np.full(self.number_of_bins, -1, dtype=np.int64)
+        self.hash_indices = np.zeros(self.number_of_bins, dtype=np.int8)
+        self.dropped = []
+        self.dummy_msg = None
+        self.data_structure = np.full(self.number_of_bins, -1, dtype=np.int64)
 
         self.hash_seed = hash_seed
 
-    def insert_items(self, items: List[int]) -> None:
+    def insert_items(self, items: Iterable[int]) -> None:
         """
-        Inserts a list of items into the CuckooHash data structure.
+        Inserts a list of items into the CuckooHash data structure. The position
+        of each item in items is recorded in item_indices. If some item cannot be
+        placed and max_dropped items are already left out, the whole table is rebuilt
+        with a random walk seeded with seed + attempt, up to CUCKOO_RETRIES times,
+        so that a given seed always gives the same table.
 
         :param items: A list of integers to insert.
         """
-        for item in items:
-            self.insert(item)
+        first_new = len(self.items)
+        self.items.extend(items)
+        self.locations.extend([tuple(location(seed, item) for seed in self.hash_seed) for item in self.items[first_new:]])
+
+        for attempt in range(CUCKOO_RETRIES + 1):
+            if all(self._place(item_index) for item_index in range(first_new, len(self.items))):
+                break
+
+            # start over with all the items and a different random walk
+            first_new = 0
+            self.random.seed(self.seed + attempt + 1)
+            self.item_indices.fill(-1)
+            self.dropped = []
+        else:
+            raise Exception('Hashing failed: bin is full')
+
+        self._update_data_structure()
 
     def insert(self, item: int) -> None:
         """
@@ -117,42 +128,79 @@ class CuckooHash():
 
         :param item: an integer to insert.
         """
-        current_location = location( self.hash_seed[self.insert_index], item)
-        current_item = self.data_structure[ current_location]
-        self.data_structure[ current_location ] = left_and_index(item, self.insert_index)
+        self.insert_items([item])
+
+    def _place(self, item_index: int) -> bool:
+        """
+        Places an item in the table, evicting items to their other locations if needed
+        (random walk). An item left without a slot is dropped if fewer than max_dropped
+        items are already left out.
+
+        :param item_index: index of the item (in items) to place
+        :return: False if an item is left without a slot and cannot be dropped, True otherwise
+        """
+        item_indices = self.item_indices
+        hash_indices = self.hash_indices
+
+        # use a free candidate location if there is one
+        for h, loc in enumerate(self.locations[item_index]):
+            if item_indices[loc] < 0:
+                item_indices[loc] = item_index
+                hash_indices[loc] = h
+                return True
+
+        current = item_index
+        h = self.random.randrange(NUM_OF_HASHES)
+
+        for _ in range(self.max_evictions):
+            loc = self.locations[current][h]
+            evicted, evicted_h = item_indices[loc], hash_indices[loc]
+            item_indices[loc] = current
+            hash_indices[loc] = h
+
+            if evicted < 0:
+                return True
+
+            # the evicted item moves to one of its other locations
+            current = int(evicted)
+            h = self.random.randrange(NUM_OF_HASHES - 1)
+            if h >= evicted_h:
+                h += 1
+
+        if len(self.dropped) < self.max_dropped:
+            self.dropped.append(current)
+            return True
+
+        return False
+
+    def _update_data_structure(self) -> None:
+        """
+        Recomputes data_structure from item_indices and hash_indices.
+        """
+        filled = self.item_indices >= 0
+        items = np.asarray(self.items, dtype=np.int64)[self.item_indices[filled]]
+
+        self.data_structure.fill(-1 if self.dummy_msg is None else self.dummy_msg)
+        # left_and_index for every filled slot
+        self.data_structure[filled] = ((items >> OUTPUT_BITS) << LOG_NO_HASHES) + self.hash_indices[filled]
 
-        if (current_item == None):
-            self.insert_index = randint(0, NUM_OF_HASHES - 1)	
-            self.depth = 0	
-        else:
-            unwanted_index = extract_index(current_item)
-            self.insert_index = get_random_distinct_integer(NUM_OF_HASHES, unwanted_index)	
-            if (self.depth < self.recursion_depth):
-                self.depth +=1
-                jumping_item = reconstruct_item(current_item, current_location, self.hash_seed[unwanted_index])
-                self.insert(jumping_item)		
-            else:
-                raise Exception('Hashing failed: bin is full')
-    
     def pad(self, dummy_msg: int) -> None:
         """
         Pads the CuckooHash data structure with a dummy message.
 
         :param dummy_msg: an integer that will be used as the dummy message.
         """
-        for i in range(self.number_of_bins):
-            if (self.data_structure[i] == None):
-                self.data_structure[i] = dummy_msg
+        self.dummy_msg = dummy_msg
+        self.data_structure[self.item_indices < 0] = dummy_msg
 
-    def windowing(self, minibin_cap: int, plain_mod: int) -> List[Union[None, Tuple[int, int]]]:
+    def windowing(self, minibin_cap: int, plain_mod: int) -> np.ndarray:
         """
-        Applies windowing for all items in the CuckooHash data structure.
+        Applies windowing for all items in the CuckooHash data structure at once.
 
         :param minibin_cap: an integer representing the size of each minibin.
         :param plain_mod: an integer representing the size of the plain modulus.
-        :return: a list of tuples representing the windowed items.
+        :return: an int64 array of shape (BASE - 1, LOG_B_ELL, number_of_bins) holding the
+                 windowed items (see windowing_batched); entry [i, j] holds the slots of
+                 one query ciphertext.
         """
-        windowed_items = []
-        for item in self.data_structure:
-            windowed_items.append(windowing(item, minibin_cap, plain_mod))
-        return windowed_items
+        return windowing_batched(self.data_structure, minibin_cap, plain_mod)
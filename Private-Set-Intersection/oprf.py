@@ -1,10 +1,166 @@
-from multiprocessing import Pool
+import atexit
+from math import ceil
+from multiprocessing import Pool, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Tuple
 
 from fastecdsa.point import Point
 
-from auxiliary_functions import split_list_into_parts, unpack_list_of_lists
+from auxiliary_functions import split_list_into_chunks, unpack_list_of_lists
 from oprf_constants import *
 
+# process-wide worker pool, created on first use and reused by every OPRF call
+_worker_pool = None
+_worker_pool_size = NUM_OF_PROCESSES
+
+# fixed-base multiplication tables, keyed by the (x, y) coordinates of their base point
+_fixed_base_multipliers = {}
+
+
+class FixedBaseMultiplier():
+    """
+    Scalar multiplication by a fixed point on the EC CURVE using a precomputed comb table.
+    The scalar is split into windows of window_bits bits; the table stores every multiple
+    d * 2 ** (window_bits * i) * point, so a multiplication is one table lookup and one
+    point addition per window, with no doublings. Additions are done in Jacobian
+    coordinates and converted back to affine coordinates with a single inversion, so
+    the results are identical to those of scalar * point.
+
+    Attributes:
+        p (int): the modulus of the curve
+        a (int): the a coefficient of the curve equation y^2 = x^3 + ax + b
+        window_bits (int): the size of a window in bits
+        num_of_windows (int): number of windows needed to cover a scalar modulo BASE_ORDER
+        table (List[List[Tuple[int, int]]]): table[i][d - 1] are the affine coordinates
+                                             of d * 2 ** (window_bits * i) * point
+
+    Methods:
+        multiply(scalar: int) -> Tuple[int, int]:
+            Returns the affine coordinates of scalar * point.
+
+        multiply_all(scalars: List[int]) -> List[Tuple[int, int]]:
+            Returns the affine coordinates of scalar * point for every scalar in scalars.
+    """
+
+    def __init__(self, point: Point, window_bits: int = FIXED_BASE_WINDOW):
+        """
+        FixedBaseMultiplier constructor. Builds the precomputed table for point.
+
+        :param point: a point on the EC CURVE
+        :param window_bits: the size of a window in bits
+        """
+
+        self.p = CURVE.p
+        self.a = CURVE.a
+        self.window_bits = window_bits
+        self.num_of_windows = ceil(BASE_ORDER.bit_length() / window_bits)
+        self.table = []
+
+        window_base = point
+        for i in range(self.num_of_windows):
+            row = [window_base]
+            for d in range(2, 2 ** window_bits):
+                row.append(row[-1] + window_base)
+            self.table.append([(P.x, P.y) for P in row])
+            # 2 ** window_bits * window_base
+            window_base = row[-1] + window_base
+
+    def multiply(self, scalar: int) -> Tuple[int, int]:
+        """
+        :param scalar: an integer
+        :return: the affine X and Y coordinates of scalar * point
+        """
+
+        p = self.p
+        mask = 2 ** self.window_bits - 1
+        scalar %= BASE_ORDER
+
+        # the accumulator is in Jacobian coordinates; Z = 0 is the point at infinity
+        X, Y, Z = 0, 1, 0
+
+        for row in self.table:
+            d = scalar & mask
+            scalar >>= self.window_bits
+            if d == 0:
+                continue
+
+            x2, y2 = row[d - 1]
+
+            if Z == 0:
+                X, Y, Z = x2, y2, 1
+                continue
+
+            # mixed addition of the Jacobian accumulator and the affine table point
+            ZZ = Z * Z % p
+            H = (x2 * ZZ - X) % p
+            r = (y2 * Z * ZZ - Y) % p
+
+            if H == 0:
+                if r != 0:
+                    # the table point is the inverse of the accumulator
+                    X, Y, Z = 0, 1, 0
+                    continue
+                X, Y, Z = self._double(X, Y, Z)
+                continue
+
+            HH = H * H % p
+            HHH = H * HH % p
+            V = X * HH % p
+            X = (r * r - HHH - 2 * V) % p
+            Y = (r * (V - X) - Y * HHH) % p
+            Z = Z * H % p
+
+        if Z == 0:
+            raise ValueError("scalar is a multiple of the base point order")
+
+        Z_inv = pow(Z, -1, p)
+        ZZ_inv = Z_inv * Z_inv % p
+
+        return X * ZZ_inv % p, Y * ZZ_inv * Z_inv % p
+
+    def multiply_all(self, scalars: List[int]) -> List[Tuple[int, int]]:
+        """
+        :param scalars: a list of integers
+        :return: list of the affine X and Y coordinates of scalar * point for each scalar
+        """
+
+        return [self.multiply(scalar) for scalar in scalars]
+
+    def _double(self, X: int, Y: int, Z: int) -> Tuple[int, int, int]:
+        """
+        Doubles a point given in Jacobian coordinates.
+
+        :return: the Jacobian coordinates of 2 * (X, Y, Z)
+        """
+
+        p = self.p
+        XX = X * X % p
+        YY = Y * Y % p
+        ZZ = Z * Z % p
+        S = 4 * X * YY % p
+        M = (3 * XX + self.a * ZZ * ZZ) % p
+        X3 = (M * M - 2 * S) % p
+        Y3 = (M * (S - X3) - 8 * YY * YY) % p
+        Z3 = 2 * Y * Z % p
+
+        return X3, Y3, Z3
+
+
+def get_fixed_base_multiplier(point):
+    """
+    Returns the FixedBaseMultiplier for point, building its table on first use.
+    Tables are cached per process, so a worker process builds the table for a
+    given key only once.
+
+    :param point: a point on the EC CURVE
+    :return: FixedBaseMultiplier for point
+    """
+
+    if (point.x, point.y) not in _fixed_base_multipliers:
+        _fixed_base_multipliers[(point.x, point.y)] = FixedBaseMultiplier(point)
+
+    return _fixed_base_multipliers[(point.x, point.y)]
+
 def server_prf_offline(list_of_items_and_point):
     """
     Takes a list of items and processes them by multiplying each item with a point
@@ -21,15 +177,17 @@ def server_prf_offline(list_of_items_and_point):
              bits taken from the first coordinate
     """
 
-    items_time_point = multiply_items_by_point(list_of_items_and_point)
+    # the point is the same for every item, so the precomputed table is reused
+    multiplier = get_fixed_base_multiplier(list_of_items_and_point[1])
+    items_time_point = multiplier.multiply_all(list_of_items_and_point[0])
 
-    return [(Q.x >> LOG_P - SIGMA_MAX - 10) & MASK for Q in items_time_point]
+    return [(x >> LOG_P - SIGMA_MAX - 10) & MASK for x, _ in items_time_point]
 
 
 def server_prf_offline_parallel(item_list, point):
     '''
-    Takes a list of items as input, then splits them into NUM_OF_PROCESSES lists.
-    Runs server_prf_offline in parallel on each list, then merges and returns the
+    Takes a list of items as input, then splits them into chunks.
+    Runs server_prf_offline in parallel on each chunk, then merges and returns the
     result. The point is appended along with each list as a way to send it to the
     subrotuine server_prf_offline.
 
@@ -40,41 +198,37 @@ def server_prf_offline_parallel(item_list, point):
     '''
 
     # split up list, add point along with each of the new lists as a way to pass the point to each process
-    process_items = split_list_into_parts(item_list, NUM_OF_PROCESSES)
+    process_items = split_into_work_chunks(item_list)
     inputs_and_point = [(input_vec, point) for input_vec in process_items]
 
     return parallelize_function_on_lists(server_prf_offline, inputs_and_point)
 
 
 
-def server_prf_online(points_with_key):
+def server_prf_online(coords_with_key):
     """
-    :param points_with_key: sever's PRF-encoded items (first index) and key (second index)
-    :return: X and Y coordinates (as integers) of the server's PRF-encoded items multiplied
-             by the key (second index of points_with_key)
+    :param coords_with_key: X and Y coordinates (as integers) of the client's PRF-encoded items
+                            (first index) and the server's key (second index)
+    :return: X and Y coordinates (as integers) of the client's PRF-encoded items multiplied
+             by the key (second index of coords_with_key)
     """
-    multiplied_points = multiply_items_by_point(points_with_key)
+
+    # X and Y coordinates into actual points on the EC (this also checks that they are on the curve)
+    list_of_points = [Point(P[0], P[1], curve=CURVE) for P in coords_with_key[0]]
+
+    multiplied_points = [coords_with_key[1] * P for P in list_of_points]
     return [[P.x, P.y] for P in multiplied_points]
 
 
 def server_prf_online_parallel(prf_list, key):
     '''
-    :param prf_list: list consisting of the server's PRF encoded items, represented
+    :param prf_list: list consisting of the client's PRF encoded items, represented
                      as integer X and Y coordinates
     :param key: server's key on the EC CURVE (see oprf_constants.py)
     :return: list of coordinates of points key * P on the EC CURVE
     '''
 
-    # X and Y coordinates into actual points on the EC
-    list_of_points = [Point(P[0], P[1], curve=CURVE) for P in prf_list]
-
-    # prepare lists for each process (for multiprocessing)
-    inputs = split_list_into_parts(list_of_points, NUM_OF_PROCESSES)
-
-    # add key to each list so each process has access to it
-    inputs_with_key = [(_, key) for _ in inputs]
-
-    return parallelize_function_on_lists(server_prf_online, inputs_with_key)
+    return multiply_coordinates_parallel(prf_list, key)
 
 def client_prf_offline(set_with_point):
     """
@@ -84,64 +238,180 @@ def client_prf_offline(set_with_point):
     """
     c_set = set_with_point[0]
     p = set_with_point[1]
-    return [(point.x, point.y) for point in multiply_items_by_point((c_set, p))]
+    return get_fixed_base_multiplier(p).multiply_all(c_set)
 
-def client_prf_online(key_coord_list):
+def client_prf_online_parallel(prf_list, inv_key):
     """
-    :param coord_key_list: list consisting of the inverse of theclient's key plus a list of X and Y coordinates
-                           (as integers) of points belonging to the EC CURVE (see oprf_constants.py) representing
-                           the client's encoded items
-    :return: client items multiplied by the point (key * generator), with SIGMA_MAX bits taken from the first coordinate
+    :param inv_key: inverse of secret key
+    :param prf_list: the PRF-encoded client set
+    :return: inverse of the the secret key (inv_key) applied to the PRF-encoded client set
     """
 
-    # reconstruct the the points on the curve based on the given X and Y coords (coord_key_list[1])
-    list_of_points = [Point(pair[0],pair[1], curve=CURVE) for pair in key_coord_list[1]]
-
-    # multiply the inverse of the key (key_coord_list[0]) with all the points
-    points_time_inversekey = [key_coord_list[0] * PP for PP in list_of_points]
+    multiplied_coords = multiply_coordinates_parallel(prf_list, inv_key)
 
     # return SIGMA_MAX bits from first coordinate
-    return [(Q.x >> LOG_P - SIGMA_MAX - 10) & MASK for Q in points_time_inversekey]
+    return [(x >> LOG_P - SIGMA_MAX - 10) & MASK for x, _ in multiplied_coords]
 
+def multiply_coordinates_parallel(coord_list, scalar):
+    """
+    Multiplies the points given by coord_list with scalar using the worker pool.
+    The coordinates are written as fixed-width (COORD_BYTES) big-endian integers
+    into one shared memory buffer. Each worker reads its range of points from the
+    buffer, reconstructs and validates the points, multiplies them and writes the
+    resulting coordinates back in place, so no points are pickled between processes.
+    Small inputs are handled by server_prf_online in the current process.
+
+    :param coord_list: list of X and Y coordinates of points on the EC CURVE
+    :param scalar: integer to multiply each point with
+    :return: list of coordinates of points scalar * P on the EC CURVE
+    """
 
-def client_prf_online_parallel(prf_list, inv_key):
+    chunks = split_into_work_chunks(coord_list)
+    pool = get_worker_pool()
+
+    if pool is None or len(chunks) <= 1:
+        return server_prf_online((coord_list, scalar))
+
+    shm = SharedMemory(create=True, size=2 * COORD_BYTES * len(coord_list))
+    try:
+        write_coordinates_to_buffer(shm.buf, 0, coord_list)
+
+        ranges = []
+        start = 0
+        for chunk in chunks:
+            ranges.append((shm.name, start, start + len(chunk), scalar))
+            start += len(chunk)
+
+        pool.map(multiply_shared_coordinates, ranges, chunksize=1)
+
+        return read_coordinates_from_buffer(shm.buf, 0, len(coord_list))
+    finally:
+        shm.close()
+        shm.unlink()
+
+def multiply_shared_coordinates(name_range_and_scalar):
     """
-    :param inv_key: inverse of secret key
-    :param prf_list: the PRF-encoded client set
-    :return: inverse of the the secret key (inv_key) applied to the PRF-encoded client set
+    Worker side of multiply_coordinates_parallel. Multiplies the points stored in
+    the shared memory block between start and stop by scalar, in place.
+
+    :param name_range_and_scalar: name of the shared memory block, start and stop indices
+                                  of the points to process, and the scalar
+    """
+
+    name, start, stop, scalar = name_range_and_scalar
+
+    shm = SharedMemory(name=name)
+    try:
+        coords = read_coordinates_from_buffer(shm.buf, start, stop)
+        write_coordinates_to_buffer(shm.buf, start, server_prf_online((coords, scalar)))
+    finally:
+        shm.close()
+
+def write_coordinates_to_buffer(buf, start, coord_list):
+    """
+    :param buf: writable buffer holding 2 * COORD_BYTES bytes per point
+    :param start: index of the point where writing starts
+    :param coord_list: list of X and Y coordinates to write
+    """
+
+    data = b"".join(x.to_bytes(COORD_BYTES, "big") + y.to_bytes(COORD_BYTES, "big") for x, y in coord_list)
+    buf[2 * COORD_BYTES * start: 2 * COORD_BYTES * start + len(data)] = data
+
+def read_coordinates_from_buffer(buf, start, stop):
     """
+    :param buf: buffer holding 2 * COORD_BYTES bytes per point
+    :param start: index of the first point to read
+    :param stop: index after the last point to read
+    :return: list of [X, Y] coordinates of the points between start and stop
+    """
+
+    data = bytes(buf[2 * COORD_BYTES * start: 2 * COORD_BYTES * stop])
+
+    return [[int.from_bytes(data[i: i + COORD_BYTES], "big"),
+             int.from_bytes(data[i + COORD_BYTES: i + 2 * COORD_BYTES], "big")]
+            for i in range(0, len(data), 2 * COORD_BYTES)]
+
+def get_worker_pool():
+    """
+    Returns the process-wide worker pool, creating it on first use. The pool is
+    kept alive between calls so that repeated queries do not pay the cost of
+    spawning processes and importing modules again. It is shut down at exit.
+
+    :return: the multiprocessing Pool used for the OPRF computations, or None
+             if the pool is configured with a single process (serial execution)
+    """
+
+    global _worker_pool
 
-    inputs = split_list_into_parts(prf_list, NUM_OF_PROCESSES)
-        
-    keyed_inputs = [(inv_key, _) for _ in inputs]
+    if _worker_pool is None and _worker_pool_size > 1:
+        # start the resource tracker before the workers, so that they share it and
+        # shared memory blocks attached by the workers are only tracked once
+        resource_tracker.ensure_running()
+        _worker_pool = Pool(_worker_pool_size)
+        atexit.register(shutdown_worker_pool)
 
-    return parallelize_function_on_lists(client_prf_online, keyed_inputs)
+    return _worker_pool
 
-def multiply_items_by_point(items_with_point):
+def shutdown_worker_pool():
     """
-    :param items_with_point: list with items (first index) and point (on an elliptic curve)
-                             (second index)
-    :return: list of items multiplied by point
+    Terminates the process-wide worker pool, if it was created.
     """
 
-    item_list = items_with_point[0]
-    p = items_with_point[1]
+    global _worker_pool
 
-    return [item * p for item in item_list]
+    if _worker_pool is not None:
+        _worker_pool.close()
+        _worker_pool.join()
+        _worker_pool = None
+
+def configure_worker_pool(processes):
+    """
+    Sets the number of processes in the worker pool. An existing pool with a
+    different size is shut down; the new one is created on next use.
+
+    :param processes: number of worker processes; 1 makes all OPRF computations serial
+    """
+
+    global _worker_pool_size
+
+    if processes != _worker_pool_size:
+        shutdown_worker_pool()
+        _worker_pool_size = max(1, processes)
+
+def split_into_work_chunks(items):
+    """
+    Splits items into chunks for the worker pool. There are about CHUNKS_PER_PROCESS
+    chunks per worker, so that a worker which finishes early picks up the next
+    chunk instead of idling. Small inputs are kept in a single chunk.
+
+    :param items: list of items to split
+    :return: list of chunks (lists) covering items in order
+    """
+
+    if _worker_pool_size <= 1 or len(items) < PARALLEL_THRESHOLD:
+        return [items]
+
+    chunk_size = ceil(len(items) / (_worker_pool_size * CHUNKS_PER_PROCESS))
+
+    return split_list_into_chunks(items, chunk_size)
 
 def parallelize_function_on_lists(func, lists):
     """"
-    Uses the multiprocessing library's Pool object to run
-    func on each list in lists. 
+    Runs func on each list in lists using the process-wide worker pool.
+    If there is only a single list, func is run in the current process.
 
     :param func: function that takes a list as input and returns a list as output.
     :param lists: list of lists.
     :return: the aggregated lists from func as a single list. 
     """
 
-    outputs = []
-    with Pool(NUM_OF_PROCESSES) as p:
-        outputs = p.map(func, lists)
+    pool = get_worker_pool()
+
+    if pool is None or len(lists) <= 1:
+        outputs = [func(l) for l in lists]
+    else:
+        # chunksize=1 lets idle workers pull the next chunk as soon as they are done
+        outputs = pool.map(func, lists, chunksize=1)
+
     # outputs consists of a list of lists
     return unpack_list_of_lists(outputs)
-
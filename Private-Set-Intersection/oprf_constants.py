@@ -1,4 +1,5 @@
 from math import log2
+import os
 
 from fastecdsa.curve import P192
 from fastecdsa.point import Point
@@ -10,9 +11,27 @@ MASK = 2 ** SIGMA_MAX - 1
 Integer used to mask.
 """
 
-NUM_OF_PROCESSES = 8
+NUM_OF_PROCESSES = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
 """
-Used for parallel computation. Should probably set to number of cores on your system.
+Used for parallel computation. Equal to the number of CPUs this process is allowed to run on.
+"""
+
+PARALLEL_THRESHOLD = 512
+"""
+Inputs with fewer items than this are processed serially; below it the
+cost of dispatching work to the worker pool outweighs the speedup.
+"""
+
+CHUNKS_PER_PROCESS = 4
+"""
+How many chunks each worker process receives on average. Workers pull chunks
+from a shared queue as they finish, so more chunks means better load balancing.
+"""
+
+FIXED_BASE_WINDOW = 8
+"""
+Window size (in bits) of the precomputed table used for fixed-base scalar multiplication.
+The table holds (2 ** FIXED_BASE_WINDOW - 1) points per window of the scalar.
 """
 
 # Elliptic curve constants
@@ -27,6 +46,11 @@ LOG_P = int(log2(CURVE.p)) + 1
 An integer equal to the number of bits needed to represent the modulus of the curve.
 Modulus being the p in the curve equation y^2 = x^3 + ax + b (mod p).
 """
+COORD_BYTES = (LOG_P + 7) // 8
+"""
+Number of bytes used to store one coordinate of a point when coordinates are exchanged
+between processes through shared memory.
+"""
 BASE_ORDER = CURVE.q
 """
 The order of the base (i.e the point that generates all other points on the curve) point of the curve.
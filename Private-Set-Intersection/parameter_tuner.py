@@ -0,0 +1,472 @@
+import argparse
+import json
+from math import ceil, lgamma, log, log2
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from auxiliary_functions import plan_power_computation, windowed_exponents
+from constants import CLIENT_SIZE, HASH_SEEDS, PLAIN_MOD, SERVER_SIZE
+from oprf_constants import COORD_BYTES, NUM_OF_PROCESSES
+
+STAT_SECURITY = 40
+"""
+Simple hashing must not overflow a bin except with probability at most 2 ** -STAT_SECURITY.
+"""
+CUCKOO_MAX_LOAD = {3: 0.5}
+"""
+Largest load factor (client items / bins) at which Cuckoo hashing is considered safe, per
+number of hash functions. These are conservative limits; add entries (and seeds to
+HASH_SEEDS) to let the tuner consider other numbers of hash functions.
+"""
+POLY_MOD_CHOICES = (2 ** 13, 2 ** 14)
+"""
+Polynomial modulus degrees considered. PLAIN_MOD supports batching for both.
+"""
+ELL_CHOICES = (1, 2, 3, 4)
+"""
+Windowing parameters considered.
+"""
+MAX_ALPHA = 128
+"""
+Largest partitioning parameter considered.
+"""
+NOISE_MARGIN = 10
+"""
+Noise budget (bits) that must be left in the server's answer, to absorb modelling errors.
+"""
+FHE_DATA_BITS = {2 ** 13: 174, 2 ** 14: 389}
+"""
+Size in bits of the coefficient modulus used by ciphertexts (without the special prime) in
+the default 128-bit secure BFV contexts.
+"""
+FHE_DATA_PRIMES = {2 ** 13: 4, 2 ** 14: 8}
+"""
+Number of primes in the coefficient modulus used by ciphertexts (without the special prime).
+"""
+
+DEFAULT_PROFILE = {
+    "processes": NUM_OF_PROCESSES,
+    "bandwidth": 1.25e8,
+    "ec_fixed_mul": 2.2e-4,
+    "ec_mul": 1.4e-3,
+    "hash": 1.1e-6,
+    "interpolation": 6.6e-9,
+    "fhe": {
+        str(2 ** 13): {"encrypt": 6e-3, "ct_mult": 3e-2, "plain_mult": 3e-3, "add": 2e-4, "decrypt": 2e-3},
+        str(2 ** 14): {"encrypt": 1.4e-2, "ct_mult": 1.2e-1, "plain_mult": 7e-3, "add": 5e-4, "decrypt": 5e-3},
+    },
+}
+"""
+Hardware profile used when none is given: per-operation costs in seconds (EC multiplications,
+hashing one item, one multiply-add of the interpolation kernel per root squared, and the
+BFV operations per polynomial modulus degree), the number of cores and the network bandwidth
+in bytes per second. The EC and hashing costs were measured on a single core of a recent x86
+server; run with --calibrate to measure them on the target machine.
+"""
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Chooses the PSI parameters in constants.py for given set sizes.")
+    parser.add_argument("--server-size", type=int, default=SERVER_SIZE, help="number of items in the server's set")
+    parser.add_argument("--client-size", type=int, default=CLIENT_SIZE, help="number of items in the client's set")
+    parser.add_argument("--profile", help="hardware profile (JSON) to use instead of the default one")
+    parser.add_argument("--calibrate", action="store_true", help="measure the hardware profile with micro-benchmarks")
+    parser.add_argument("--save-profile", help="file to save the (calibrated) hardware profile to")
+    parser.add_argument("--processes", type=int, help="number of cores (overrides the profile)")
+    parser.add_argument("--objective", choices=("online", "offline", "communication"), default="online",
+                        help="what to minimize")
+    parser.add_argument("--top", type=int, default=10, help="number of candidates to show")
+    parser.add_argument("--output", help="file to write the chosen parameters and predictions to (JSON)")
+    args = parser.parse_args()
+
+    # for prettier printing
+    console = Console()
+
+    profile = load_profile(args.profile)
+    if args.processes:
+        profile["processes"] = args.processes
+
+    if args.calibrate:
+        with console.status("[bold red]Calibrating...") as status:
+            profile = calibrate(profile, console)
+
+    if args.save_profile:
+        with open(args.save_profile, "w") as f:
+            json.dump(profile, f, indent=4)
+
+    ranked = tune(args.server_size, args.client_size, profile, args.objective)
+
+    if not ranked:
+        console.log("[red]No valid parameter set for these set sizes.[/red]")
+        return
+
+    table = Table(title="Best parameter sets ({} objective)".format(args.objective))
+    for column in ("POLY_MOD", "ALPHA", "ELL", "BIN_CAP", "MINIBIN_CAP", "depth", "noise left",
+                   "offline (s)", "online (s)", "communication (MB)"):
+        table.add_column(column, justify="right")
+    for candidate, prediction in ranked[:args.top]:
+        table.add_row(str(candidate["POLY_MOD"]), str(candidate["ALPHA"]), str(candidate["ELL"]),
+                      str(candidate["BIN_CAP"]), str(candidate["MINIBIN_CAP"]), str(candidate["depth"]),
+                      "{:.0f}".format(prediction["noise_budget"]), "{:.1f}".format(prediction["offline_time"]),
+                      "{:.2f}".format(prediction["online_latency"]), "{:.2f}".format(prediction["communication"] / 2 ** 20))
+    console.print(table)
+
+    best, prediction = ranked[0]
+    console.print("\n[blue]Parameters for constants.py:[/blue]")
+    console.print(format_constants(best, args.server_size, args.client_size))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"parameters": best, "prediction": prediction, "profile": profile}, f, indent=4)
+
+
+def load_profile(filename: Optional[str]) -> Dict[str, Any]:
+    """
+    :param filename: hardware profile file (JSON) or None for the default profile
+    :return: the hardware profile; missing entries are taken from DEFAULT_PROFILE
+    """
+
+    profile = json.loads(json.dumps(DEFAULT_PROFILE))
+
+    if filename is not None:
+        with open(filename) as f:
+            loaded = json.load(f)
+        fhe = loaded.pop("fhe", {})
+        profile.update(loaded)
+        for poly_mod, costs in fhe.items():
+            profile["fhe"].setdefault(poly_mod, {}).update(costs)
+
+    return profile
+
+
+def log2_binomial_tail(m: int, p: float, c: int) -> float:
+    """
+    :return: log2 of P(X > c) for X ~ Binomial(m, p)
+    """
+
+    if c >= m:
+        return float("-inf")
+
+    def log_term(k):
+        return lgamma(m + 1) - lgamma(k + 1) - lgamma(m - k + 1) + k * log(p) + (m - k) * log(1 - p)
+
+    # sum the terms from c + 1 on, in log space, until they become negligible
+    first = log_term(c + 1)
+    total = 1.0
+    for k in range(c + 2, m + 1):
+        ratio = log_term(k) - first
+        if ratio < -50:
+            break
+        total += np.exp(ratio)
+
+    return (first + log(total)) / log(2)
+
+
+def simple_hashing_bin_cap(num_of_balls: int, num_of_bins: int, stat_security: int = STAT_SECURITY) -> int:
+    """
+    Smallest bin capacity such that throwing num_of_balls balls into num_of_bins bins
+    overflows some bin with probability at most 2 ** -stat_security (union bound over bins).
+
+    :param num_of_balls: number of balls, i.e. server items times the number of hash functions
+    :param num_of_bins: number of bins
+    :param stat_security: statistical security parameter
+    :return: the bin capacity
+    """
+
+    p = 1 / num_of_bins
+    cap = int(num_of_balls * p)
+
+    while log2(num_of_bins) + log2_binomial_tail(num_of_balls, p, cap) > -stat_security:
+        cap += 1
+
+    return cap
+
+
+def candidate_parameters(server_size: int, client_size: int) -> Iterator[Dict[str, int]]:
+    """
+    Enumerates the parameter sets the tuner considers. Cuckoo hashing and simple hashing
+    bounds are applied here; noise is checked with the hardware profile (see validate).
+
+    :param server_size: number of items in the server's set
+    :param client_size: number of items in the client's set
+    :return: iterator over parameter sets (constants.py names, plus derived quantities)
+    """
+
+    for poly_mod in POLY_MOD_CHOICES:
+        num_of_bins = poly_mod
+
+        for num_of_hashes, max_load in CUCKOO_MAX_LOAD.items():
+            if num_of_hashes > len(HASH_SEEDS) or client_size > max_load * num_of_bins:
+                continue
+
+            needed_bin_cap = simple_hashing_bin_cap(num_of_hashes * server_size, num_of_bins)
+
+            for alpha in range(1, min(MAX_ALPHA, needed_bin_cap) + 1):
+                minibin_cap = ceil(needed_bin_cap / alpha)
+
+                for ell in ELL_CHOICES:
+                    base = 2 ** ell
+                    log_b_ell = max(1, int(log2(minibin_cap / ell)) + 1)
+                    sources = windowed_exponents(base, log_b_ell, minibin_cap)
+
+                    try:
+                        plan = plan_power_computation(range(1, minibin_cap + 1), sources)
+                    except ValueError:
+                        # some powers cannot be computed from the windowed query
+                        continue
+
+                    depth = dict.fromkeys(sources, 0)
+                    width = {}
+                    for e, a, b in plan:
+                        depth[e] = max(depth[a], depth[b]) + 1
+                        width[depth[e]] = width.get(depth[e], 0) + 1
+
+                    yield {
+                        "POLY_MOD": poly_mod,
+                        "OUTPUT_BITS": int(log2(num_of_bins)),
+                        "NUM_OF_HASHES": num_of_hashes,
+                        "BIN_CAP": alpha * minibin_cap,
+                        "ALPHA": alpha,
+                        "MINIBIN_CAP": minibin_cap,
+                        "ELL": ell,
+                        "LOG_B_ELL": log_b_ell,
+                        "query_ciphertexts": len(sources),
+                        "power_multiplications": len(plan),
+                        "max_level_width": max(width.values(), default=0),
+                        "depth": max(depth.values()),
+                    }
+
+
+def noise_budget_left(candidate: Dict[str, int], profile: Dict[str, Any]) -> float:
+    """
+    Predicts the noise budget (bits) left in the server's answer: the fresh budget, minus
+    one multiplication per level of the power computation, one plaintext multiplication
+    and the growth from adding up MINIBIN_CAP + 1 terms. Measured noise figures in the
+    profile (see calibrate) take precedence over the textbook estimates.
+
+    :param candidate: parameter set (see candidate_parameters)
+    :param profile: hardware profile
+    :return: predicted noise budget in bits
+    """
+
+    poly_mod = candidate["POLY_MOD"]
+    costs = profile["fhe"].get(str(poly_mod), {})
+
+    # textbook estimates: every multiplication costs about log2(t) + log2(n) / 2 bits
+    growth = log2(PLAIN_MOD) + log2(poly_mod) / 2
+    fresh = costs.get("fresh_noise_budget", FHE_DATA_BITS[poly_mod] - growth)
+    mult = costs.get("mult_noise", growth)
+    plain = costs.get("plain_mult_noise", growth)
+
+    return fresh - candidate["depth"] * mult - plain - log2(candidate["MINIBIN_CAP"] + 1)
+
+
+def validate(candidate: Dict[str, int], client_size: int, profile: Dict[str, Any]) -> List[str]:
+    """
+    :param candidate: parameter set (see candidate_parameters)
+    :param client_size: number of items in the client's set
+    :param profile: hardware profile
+    :return: list of the reasons why the parameter set is not usable (empty if it is)
+    """
+
+    problems = []
+
+    if client_size > CUCKOO_MAX_LOAD.get(candidate["NUM_OF_HASHES"], 0) * candidate["POLY_MOD"]:
+        problems.append("too many client items for Cuckoo hashing")
+    if str(candidate["POLY_MOD"]) not in profile["fhe"]:
+        problems.append("no costs for POLY_MOD {} in the hardware profile".format(candidate["POLY_MOD"]))
+    elif noise_budget_left(candidate, profile) < NOISE_MARGIN:
+        problems.append("not enough noise budget")
+    if candidate["MINIBIN_CAP"] * candidate["ALPHA"] != candidate["BIN_CAP"]:
+        problems.append("BIN_CAP is not ALPHA * MINIBIN_CAP")
+
+    return problems
+
+
+def ciphertext_size(poly_mod: int) -> int:
+    """
+    :return: size in bytes of a (two-polynomial, uncompressed) ciphertext
+    """
+
+    return 2 * poly_mod * FHE_DATA_PRIMES[poly_mod] * 8
+
+
+def predict_costs(candidate: Dict[str, int], server_size: int, client_size: int,
+                  profile: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Analytical cost model of the protocol, with the per-operation costs of the profile.
+
+    :param candidate: parameter set (see candidate_parameters)
+    :param server_size: number of items in the server's set
+    :param client_size: number of items in the client's set
+    :param profile: hardware profile
+    :return: predicted server offline time (s), online latency (s), communication (bytes)
+             and noise budget left (bits)
+    """
+
+    processes = max(1, profile["processes"])
+    fhe = profile["fhe"][str(candidate["POLY_MOD"])]
+    alpha, minibin_cap = candidate["ALPHA"], candidate["MINIBIN_CAP"]
+
+    # OPRF, simple hashing and interpolation of every minibin
+    offline_time = (server_size * profile["ec_fixed_mul"] / processes
+                    + candidate["NUM_OF_HASHES"] * server_size * profile["hash"]
+                    + candidate["POLY_MOD"] * alpha * minibin_cap ** 2 * profile["interpolation"])
+
+    ct_size = ciphertext_size(candidate["POLY_MOD"])
+    communication = (2 * client_size * 2 * COORD_BYTES                            # OPRF, both ways
+                     + (2 + FHE_DATA_PRIMES[candidate["POLY_MOD"]]) * ct_size     # public and relinearization keys
+                     + candidate["query_ciphertexts"] * ct_size                   # query
+                     + alpha * ct_size)                                           # answer
+
+    online_latency = (2 * client_size * profile["ec_mul"] / processes
+                      + ceil(candidate["query_ciphertexts"] / processes) * fhe["encrypt"]
+                      + candidate["power_multiplications"] * fhe["ct_mult"] / max(1, min(processes, candidate["max_level_width"]))
+                      + ceil(alpha / processes) * minibin_cap * (fhe["plain_mult"] + fhe["add"])
+                      + alpha * fhe["decrypt"]
+                      + communication / profile["bandwidth"])
+
+    return {
+        "offline_time": offline_time,
+        "online_latency": online_latency,
+        "communication": communication,
+        "noise_budget": noise_budget_left(candidate, profile),
+    }
+
+
+def tune(server_size: int, client_size: int, profile: Dict[str, Any],
+         objective: str = "online") -> List[Tuple[Dict[str, int], Dict[str, float]]]:
+    """
+    :param server_size: number of items in the server's set
+    :param client_size: number of items in the client's set
+    :param profile: hardware profile
+    :param objective: "online", "offline" or "communication"
+    :return: the valid parameter sets with their predicted costs, best first
+    """
+
+    key = {"online": "online_latency", "offline": "offline_time", "communication": "communication"}[objective]
+
+    ranked = []
+    for candidate in candidate_parameters(server_size, client_size):
+        if not validate(candidate, client_size, profile):
+            ranked.append((candidate, predict_costs(candidate, server_size, client_size, profile)))
+
+    ranked.sort(key=lambda c: (c[1][key], c[1]["online_latency"], c[1]["communication"]))
+
+    return ranked
+
+
+def format_constants(candidate: Dict[str, int], server_size: int, client_size: int) -> str:
+    """
+    :return: the assignments to make in constants.py for the parameter set (the other
+             constants are derived from these)
+    """
+
+    return "\n".join([
+        "SERVER_SIZE = {}".format(server_size),
+        "CLIENT_SIZE = {}".format(client_size),
+        "NUM_OF_HASHES = {}".format(candidate["NUM_OF_HASHES"]),
+        "OUTPUT_BITS = {}".format(candidate["OUTPUT_BITS"]),
+        "POLY_MOD = 2 ** {}".format(int(log2(candidate["POLY_MOD"]))),
+        "BIN_CAP = {}".format(candidate["BIN_CAP"]),
+        "ALPHA = {}".format(candidate["ALPHA"]),
+        "ELL = {}".format(candidate["ELL"]),
+    ])
+
+
+def calibrate(profile: Dict[str, Any], console: Console) -> Dict[str, Any]:
+    """
+    Measures the per-operation costs of the hardware profile with micro-benchmarks of the
+    kernels used by the protocol. The BFV costs and noise figures are only measured if
+    Pyfhel is installed; otherwise those of the given profile are kept.
+
+    :param profile: hardware profile to start from
+    :param console: rich console used for progress messages
+    :return: the calibrated hardware profile
+    """
+
+    # imported here, so that the tuner runs without the benchmarked modules' dependencies
+    import mmh3
+
+    from auxiliary_functions import compute_coefficients_from_roots_batched
+    from oprf import get_fixed_base_multiplier
+    from oprf_constants import BASE_ORDER, G
+
+    profile = json.loads(json.dumps(profile))
+    rng = np.random.default_rng()
+    scalars = [int(x) % BASE_ORDER for x in rng.integers(1, 2 ** 62, 200)]
+
+    multiplier = get_fixed_base_multiplier(G)
+    profile["ec_fixed_mul"] = time_per_call(lambda: [multiplier.multiply(k) for k in scalars]) / len(scalars)
+
+    point = 5 * G
+    profile["ec_mul"] = time_per_call(lambda: [k * point for k in scalars[:50]]) / 50
+
+    profile["hash"] = time_per_call(lambda: [mmh3.hash(str(k), HASH_SEEDS[0], signed=False) for k in scalars]) / len(scalars)
+
+    roots = rng.integers(0, PLAIN_MOD, (1024, 32))
+    profile["interpolation"] = time_per_call(lambda: compute_coefficients_from_roots_batched(roots, PLAIN_MOD)) / (1024 * 32 ** 2)
+
+    console.log("[yellow]Measured elliptic curve, hashing and interpolation costs.[/yellow]")
+
+    try:
+        from Pyfhel import Pyfhel
+    except ImportError:
+        console.log("[red]Pyfhel is not installed; keeping the profile's BFV costs.[/red]")
+        return profile
+
+    for poly_mod in POLY_MOD_CHOICES:
+        HE = Pyfhel()
+        HE.contextGen(scheme="bfv", n=poly_mod, t=PLAIN_MOD)
+        HE.keyGen()
+        HE.relinKeyGen()
+
+        values = rng.integers(0, PLAIN_MOD, poly_mod, dtype=np.int64)
+        plaintext = HE.encodeInt(values)
+        ciphertext = HE.encrypt(values)
+
+        def multiply_and_relinearize():
+            product = HE.multiply(ciphertext, ciphertext, in_new_ctxt=True)
+            HE.relinearize(product)
+            return product
+
+        product = multiply_and_relinearize()
+        plain_product = HE.multiply_plain(ciphertext, plaintext, in_new_ctxt=True)
+        fresh = HE.noise_level(ciphertext)
+
+        profile["fhe"][str(poly_mod)] = {
+            "encrypt": time_per_call(lambda: HE.encrypt(values)),
+            "ct_mult": time_per_call(multiply_and_relinearize),
+            "plain_mult": time_per_call(lambda: HE.multiply_plain(ciphertext, plaintext, in_new_ctxt=True)),
+            "add": time_per_call(lambda: HE.add(ciphertext, ciphertext, in_new_ctxt=True)),
+            "decrypt": time_per_call(lambda: HE.decrypt(ciphertext)),
+            "fresh_noise_budget": fresh,
+            "mult_noise": fresh - HE.noise_level(product),
+            "plain_mult_noise": fresh - HE.noise_level(plain_product),
+        }
+
+        console.log("[yellow]Measured BFV costs for POLY_MOD = {}.[/yellow]".format(poly_mod))
+
+    return profile
+
+
+def time_per_call(func, repetitions: int = 3) -> float:
+    """
+    :return: the smallest time (in seconds) func takes over repetitions calls
+    """
+
+    best = float("inf")
+    for _ in range(repetitions):
+        t0 = perf_counter()
+        func()
+        best = min(best, perf_counter() - t0)
+
+    return best
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import argparse
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+import socket
+from time import sleep, time
+from typing import List, Optional, Tuple
+
+from rich.console import Console
+
+from constants import *
+from oprf import configure_worker_pool
+from oprf_constants import NUM_OF_PROCESSES
+from server_online import get_evaluation_pool, load_encoded_server_database, serve_client, server_listen
+import tracing
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Long-running PSI server answering many clients concurrently.")
+    parser.add_argument("--workers", type=int, default=NUM_OF_PROCESSES,
+                        help="number of worker processes, i.e. clients served in parallel")
+    parser.add_argument("--db", default="server_preprocessed",
+                        help="server database produced by server_offline.py")
+    args = parser.parse_args()
+
+    # for prettier printing
+    console = Console()
+
+    t0 = time()
+
+    # the database is loaded and encoded once, before the workers are forked, so that
+    # every worker starts with it in memory (shared copy-on-write with this process)
+    load_encoded_server_database(args.db)
+
+    console.log("[yellow]Server database loaded. Time taken: {:.2f}s.[/yellow]".format(time() - t0))
+
+    listener = server_listen(backlog=128)
+
+    console.log("[blue]Listening on {}:{} with {} workers.[/blue]".format(SERVER_HOST, SERVER_PORT, args.workers))
+
+    run_workers(listener, args.db, args.workers)
+
+
+def run_workers(listener: socket.socket, server_preprocessed_filename: str, num_workers: int,
+                shards: Optional[List[Tuple[str, int]]] = None) -> None:
+    """
+    Forks num_workers workers serving clients on the listening socket (see serve_forever)
+    and watches them: a worker that exits (e.g. killed, or out of memory) is restarted.
+    The workers are terminated on a keyboard interrupt.
+
+    :param listener: listening socket shared by all workers
+    :param server_preprocessed_filename: filename where server's prepocessed items are
+                                         (see server_offline.py)
+    :param num_workers: number of workers, i.e. clients served in parallel
+    :param shards: if given, (host, port) addresses of the shard servers queries are evaluated by
+    """
+
+    console = Console()
+
+    # workers are not daemonic, so that a worker serving clients on its own may still use the OPRF worker pool
+    context = get_context("fork")
+
+    def start_worker(worker_id):
+        worker = context.Process(target=serve_forever, args=(listener, server_preprocessed_filename, worker_id, num_workers > 1, shards))
+        worker.start()
+        return worker
+
+    workers = {worker_id: start_worker(worker_id) for worker_id in range(num_workers)}
+
+    try:
+        while True:
+            sentinels = {worker.sentinel: worker_id for worker_id, worker in workers.items()}
+            for sentinel in wait(list(sentinels)):
+                worker_id = sentinels[sentinel]
+                workers[worker_id].join()
+                console.log("[red]Worker {} exited with code {}; restarting it.[/red]".format(worker_id, workers[worker_id].exitcode))
+                sleep(WORKER_RESPAWN_DELAY)
+                workers[worker_id] = start_worker(worker_id)
+    except KeyboardInterrupt:
+        for worker in workers.values():
+            worker.terminate()
+    finally:
+        listener.close()
+
+
+def serve_forever(listener: socket.socket, server_preprocessed_filename: str, worker_id: int, serial_oprf: bool,
+                  shards: Optional[List[Tuple[str, int]]] = None) -> None:
+    """
+    Worker loop: accepts clients on the shared listening socket and runs the online
+    phase for each of them, one at a time. Several workers accept on the same socket,
+    so clients are served in parallel across workers.
+
+    :param listener: listening socket shared by all workers
+    :param server_preprocessed_filename: filename where server's prepocessed items are
+                                         (see server_offline.py)
+    :param worker_id: integer identifying the worker in log messages
+    :param serial_oprf: whether to run the OPRF and the homomorphic evaluation in the worker
+                        itself; with several workers the parallelism comes from serving
+                        several clients at once
+    :param shards: if given, (host, port) addresses of the shard servers queries are evaluated by
+    """
+
+    console = Console()
+
+    if serial_oprf:
+        configure_worker_pool(1)
+
+    processes = 1 if serial_oprf else NUM_OF_PROCESSES
+
+    # fork the evaluation pool now rather than on the first query; it inherits the loaded database
+    # (a front end has none, and only uses the pool to recover the powers)
+    if processes > 1:
+        get_evaluation_pool(processes)
+
+    while True:
+        conn_socket, address = listener.accept()
+        # a client that stalls must not hold the worker forever
+        conn_socket.settimeout(SESSION_TIMEOUT)
+        console.log("[yellow]Worker {}: client {}:{} connected.[/yellow]".format(worker_id, *address))
+
+        try:
+            t0 = time()
+            computation_time, server_to_client_size, client_to_server_size = serve_client(conn_socket, console, server_preprocessed_filename, processes, shards)
+            console.log("[blue]Worker {}: client served in {:.2f}s ({:.2f}s computations, {:.2f} MB sent, {:.2f} MB received).[/blue]".format(
+                worker_id, time() - t0, computation_time, server_to_client_size / 2 ** 20, client_to_server_size / 2 ** 20))
+        except Exception as e:
+            # one failing session must not take the worker down
+            console.log("[red]Worker {}: session failed: {}[/red]".format(worker_id, e))
+        finally:
+            conn_socket.close()
+            tracing.export()
+
+if __name__ == "__main__":
+    main()
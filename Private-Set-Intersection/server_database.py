@@ -0,0 +1,92 @@
+import struct
+from typing import List, Union
+
+import numpy as np
+
+from constants import ALPHA, MINIBIN_CAP, NUM_OF_BINS, PLAIN_MOD, POLY_MOD
+
+DB_MAGIC = b"PSIDB\x00\x00\x00"
+"""
+The first bytes of a server database file.
+"""
+DB_VERSION = 1
+"""
+Version of the server database format. Increase it whenever the layout changes.
+"""
+DB_HEADER = struct.Struct("<8sIIIIQQ")
+"""
+Header of a server database file: magic, version, number of bins, ALPHA, MINIBIN_CAP,
+PLAIN_MOD and POLY_MOD, all little-endian.
+"""
+DB_HEADER_SIZE = 64
+"""
+Size in bytes reserved for the header. The coefficient matrix starts at this offset,
+so it is aligned for memory mapping.
+"""
+
+
+def db_shape(num_bins: int = NUM_OF_BINS, alpha: int = ALPHA, minibin_cap: int = MINIBIN_CAP):
+    """
+    :return: shape of the coefficient matrix stored in a server database file. Row
+             (minibin_cap + 1) * i + j holds coefficient j of minibin i for every bin,
+             i.e. the matrix is the transpose of the coefficients returned by
+             SimpleHash.partition, in the column order used by the dot product.
+    """
+
+    return (alpha * (minibin_cap + 1), num_bins)
+
+
+def create_server_database(filename: str) -> np.memmap:
+    """
+    Creates a server database file for the current parameters (see constants.py) and
+    returns its coefficient matrix, memory-mapped for writing.
+
+    :param filename: name of the file to create
+    :return: writable memory-mapped uint32 coefficient matrix of shape db_shape()
+    """
+
+    header = DB_HEADER.pack(DB_MAGIC, DB_VERSION, NUM_OF_BINS, ALPHA, MINIBIN_CAP, PLAIN_MOD, POLY_MOD)
+
+    with open(filename, "wb") as f:
+        f.write(header.ljust(DB_HEADER_SIZE, b"\x00"))
+
+    return np.memmap(filename, dtype="<u4", mode="r+", offset=DB_HEADER_SIZE, shape=db_shape())
+
+
+def write_server_database(filename: str, poly_coeffs: Union[List[List[int]], np.ndarray]) -> None:
+    """
+    Writes the minibin coefficients to a server database file.
+
+    :param filename: name of the file to write
+    :param poly_coeffs: coefficients as returned by SimpleHash.partition (one row per bin)
+    """
+
+    db = create_server_database(filename)
+    db[:] = np.asarray(poly_coeffs, dtype=np.uint32).T
+    db.flush()
+    del db
+
+
+def load_server_database(filename: str, mode: str = "r") -> np.memmap:
+    """
+    Memory-maps the coefficient matrix of a server database file. Nothing is read
+    until the coefficients are used, and processes mapping the same file share the
+    page-cached copy.
+
+    :param filename: name of the server database file (see server_offline.py)
+    :param mode: "r" for read-only access, "r+" to update the coefficients in place, "c" to
+                 change them in memory only (copy-on-write)
+    :return: memory-mapped uint32 coefficient matrix of shape db_shape()
+    """
+
+    with open(filename, "rb") as f:
+        magic, version, num_bins, alpha, minibin_cap, plain_mod, poly_mod = DB_HEADER.unpack(f.read(DB_HEADER.size))
+
+    if magic != DB_MAGIC:
+        raise ValueError("{} is not a server database file".format(filename))
+    if version != DB_VERSION:
+        raise ValueError("{} has format version {}, expected {}".format(filename, version, DB_VERSION))
+    if (num_bins, alpha, minibin_cap, plain_mod, poly_mod) != (NUM_OF_BINS, ALPHA, MINIBIN_CAP, PLAIN_MOD, POLY_MOD):
+        raise ValueError("{} was built with different parameters than the ones in constants.py".format(filename))
+
+    return np.memmap(filename, dtype="<u4", mode=mode, offset=DB_HEADER_SIZE, shape=db_shape())
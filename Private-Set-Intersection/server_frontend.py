@@ -0,0 +1,53 @@
+import argparse
+from typing import List, Tuple
+
+from rich.console import Console
+
+from constants import *
+from oprf_constants import NUM_OF_PROCESSES
+from server_daemon import run_workers
+from server_online import server_listen
+
+def main():
+
+    parser = argparse.ArgumentParser(description="PSI server front end: runs the OPRF with clients and has their queries evaluated by shard servers (server_shard.py).")
+    parser.add_argument("--shards", default=None,
+                        help="comma separated host:port addresses of the shard servers")
+    parser.add_argument("--num-shards", type=int, default=2,
+                        help="number of local shard servers, listening on SHARD_BASE_PORT, SHARD_BASE_PORT + 1, ... (used if --shards is not given)")
+    parser.add_argument("--workers", type=int, default=NUM_OF_PROCESSES,
+                        help="number of worker processes, i.e. clients served in parallel")
+    args = parser.parse_args()
+
+    shards = parse_shard_addresses(args.shards) if args.shards else [(SERVER_HOST, SHARD_BASE_PORT + i) for i in range(args.num_shards)]
+
+    # for prettier printing
+    console = Console()
+
+    listener = server_listen(backlog=128)
+
+    console.log("[blue]Listening on {}:{} with {} workers, evaluating queries on shards {}.[/blue]".format(
+        SERVER_HOST, SERVER_PORT, args.workers, ", ".join("{}:{}".format(*address) for address in shards)))
+
+    # the front end holds no database; the shards do
+    run_workers(listener, None, args.workers, shards)
+
+
+def parse_shard_addresses(text: str) -> List[Tuple[str, int]]:
+    """
+    Example: parse_shard_addresses("localhost:4471,10.0.0.2:4471") is [("localhost", 4471), ("10.0.0.2", 4471)]
+
+    :param text: comma separated host:port addresses
+    :return: list of (host, port) addresses
+    """
+
+    addresses = []
+
+    for address in text.split(","):
+        host, _, port = address.strip().rpartition(":")
+        addresses.append((host or SERVER_HOST, int(port)))
+
+    return addresses
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,171 @@
-from math import log2
+import argparse
+from math import ceil, log2
+import os
 import pickle
-from time import time
+import tempfile
+from typing import Tuple
 
+import numpy as np
 from rich.console import Console
 
-from auxiliary_functions import read_file_return_list_of_int
+from auxiliary_functions import iterate_set_chunks
 from constants import *
 from oprf import server_prf_offline_parallel
 from oprf_constants import BASE_ORDER, G, SERVER_OPRF_KEY
-from simple_hash import SimpleHash
+from server_database import create_server_database
+from simple_hash import SimpleHash, hash_entries
+import tracing
 
 # simple_hashed_data is padded with MSG_PADDING
 MSG_PADDING = 2 ** (SIGMA_MAX - OUTPUT_BITS + int(log2(NUM_OF_HASHES)) + 1) + 1
 
+SPILL_RECORD = np.dtype([("bin", "<u4"), ("entry", "<u8")])
+"""
+Record of a spill file: an entry of the simple hash table and the bin it goes to.
+"""
+OPRF_BYTES_PER_ITEM = 512
+"""
+Estimated memory (in bytes) per server item while its chunk is OPRFed and hashed.
+"""
+
 def main():
+
+    parser = argparse.ArgumentParser(description="Builds the server's database (server_preprocessed) from server_set.")
+    parser.add_argument("--memory-budget", type=int, default=OFFLINE_MEMORY_BUDGET,
+                        help="approximate bound (in bytes) on the memory used")
+    args = parser.parse_args()
+
     # for prettier printing
     console = Console()
 
     with console.status("[bold red]Server offline in progress...") as status:
 
-        # store server's set in memory 
-        server_set = read_file_return_list_of_int("server_set")
-
         # key * generator of elliptic curve (EC)
         key_gen_point = (SERVER_OPRF_KEY % BASE_ORDER) * G
 
-        t0 = time()
+        chunk_size, bins_per_range = plan_offline_memory(args.memory_budget)
+
+        # spill files are kept next to the database rather than in /tmp, which may be in memory
+        with tempfile.TemporaryDirectory(prefix="server_spill_", dir=".") as spill_dir:
+
+            # server's items multiplied by server's key * generator of the EC, then
+            # hashed; the entries are spilled to disk by range of bins
+            with tracing.stage("server_oprf_offline") as oprf_stage:
+                num_of_items = spill_server_set("server_set", key_gen_point, spill_dir, chunk_size, bins_per_range)
+
+            console.log("[yellow]OPRF preprocessing finished (server items are embedded on the ellipctic curve and hashed to bins). {} items in chunks of {}. Time taken: {:.2f}s.[/yellow]".format(
+                num_of_items, chunk_size, oprf_stage.wall_time))
+
+            # Server's OPRFed items are placed in their bins and padded (see simple_hash.py); the
+            # bins are kept in a file so that the database can be updated without a rebuild (see server_update.py)
+            with tracing.stage("partitioning") as partitioning_stage:
+                SH = SimpleHash(HASH_SEEDS, compact=True, filename="server_hashed_bins.npy")
+
+                # coefficients are stored transposed in a memory-mappable file (see server_database.py)
+                db = create_server_database('server_preprocessed')
+
+                for start in range(0, NUM_OF_BINS, bins_per_range):
+                    partition_spilled_bins(SH, db, spill_dir, start, min(start + bins_per_range, NUM_OF_BINS))
+
+                db.flush()
+                del db
+
+                h = open('server_hashed', 'wb')
+                pickle.dump(SH, h)
+                h.close()
+
+        console.log("[yellow]Finished partitioning (coefficients of minibin polynomials found) in {} ranges of bins. Time taken: {:.2f}s.[/yellow]".format(
+            ceil(NUM_OF_BINS / bins_per_range), partitioning_stage.wall_time))
+
+        console.log("[blue]Server offline total time: {:.2f}s[/blue]".format(oprf_stage.wall_time + partitioning_stage.wall_time))
+
+    tracing.export()
+
+
+def plan_offline_memory(memory_budget: int) -> Tuple[int, int]:
+    """
+    Sizes the two phases of the offline pipeline so that each of them fits in the memory budget.
+
+    :param memory_budget: approximate bound (in bytes) on the memory used
+    :returns:
+        chunk_size: number of server items OPRFed at a time
+        bins_per_range: number of bins interpolated at a time
+    """
+
+    # per bin: the bin itself, its spill records (and the copies made to deduplicate them),
+    # and the minibin coefficients with the temporaries of their interpolation
+    bytes_per_bin = BIN_CAP * (8 + 3 * SPILL_RECORD.itemsize) + 5 * 8 * ALPHA * (MINIBIN_CAP + 1)
+
+    chunk_size = max(1, min(SET_CHUNK_SIZE, memory_budget // OPRF_BYTES_PER_ITEM))
+    bins_per_range = max(1, min(NUM_OF_BINS, memory_budget // bytes_per_bin))
+
+    return chunk_size, bins_per_range
+
+def spill_filename(spill_dir: str, start: int) -> str:
+    """
+    :return: filename of the spill file of the range of bins starting at bin start
+    """
+
+    return os.path.join(spill_dir, "bins_{}".format(start))
+
+def spill_server_set(set_filename: str, key_gen_point, spill_dir: str, chunk_size: int, bins_per_range: int) -> int:
+    """
+    OPRFs the server's set chunk by chunk, computes the simple hashing entries of each
+    OPRFed item and appends them to the spill file of the range of bins they go to.
+
+    :param set_filename: filename of the server's set (text or binary, see set_gen.py)
+    :param key_gen_point: server's key * generator of the EC
+    :param spill_dir: directory of the spill files
+    :param chunk_size: number of server items OPRFed at a time
+    :param bins_per_range: number of bins of a spill file
+    :return: number of server items
+    """
+
+    num_of_items = 0
+
+    for chunk in iterate_set_chunks(set_filename, chunk_size):
+        num_of_items += len(chunk)
+
+        locs, entries = hash_entries(server_prf_offline_parallel(chunk, key_gen_point), HASH_SEEDS)
 
-        # server's items multiplied by server's key * generator of the EC
-        PRFed_server_set = set(server_prf_offline_parallel(server_set, key_gen_point))
+        records = np.empty(len(locs), dtype=SPILL_RECORD)
+        records["bin"] = locs
+        records["entry"] = entries
 
-        t1 = time()
+        # group the records by range of bins, one append per spill file
+        ranges = locs // bins_per_range
+        order = np.argsort(ranges, kind="stable")
+        range_indices, first_index, counts = np.unique(ranges[order], return_index=True, return_counts=True)
 
-        console.log("[yellow]OPRF preprocessing finished (server items are embedded on the ellipctic curve). Time taken: {:.2f}s.[/yellow]".format(t1-t0))
+        for range_index, first, count in zip(range_indices, first_index, counts):
+            with open(spill_filename(spill_dir, range_index * bins_per_range), "ab") as f:
+                records[order[first: first + count]].tofile(f)
 
-        # Server's OPRFed items are hashed and padded (see simple_hash.py)
-        SH = SimpleHash(HASH_SEEDS)
-        SH.insert_entries(PRFed_server_set)
-        SH.pad_bins()
+    return num_of_items
 
-        t2 = time()
+def partition_spilled_bins(SH: SimpleHash, db: np.memmap, spill_dir: str, start: int, stop: int) -> None:
+    """
+    Fills the bins from start to stop with the entries of their spill file, pads them, and
+    writes the coefficients of their minibin polynomials to the server database.
 
-        console.log("[yellow]Simple hashing finished (server items are in bins). Time taken: {:.2f}s.[/yellow]".format(t2-t1))
+    :param SH: the server's (compact) SimpleHash
+    :param db: memory-mapped coefficient matrix of the server database (see server_database.py)
+    :param spill_dir: directory of the spill files
+    :param start: first bin of the range
+    :param stop: bin after the last one of the range
+    """
 
-        poly_coeffs = SH.partition(ALPHA, MINIBIN_CAP, PLAIN_MOD)
+    filename = spill_filename(spill_dir, start)
 
-        f = open('server_preprocessed', 'wb')
-        pickle.dump(poly_coeffs, f)
-        f.close()
-        
-        t3 = time()
+    if os.path.exists(filename):
+        # a repeated server item gives the same records every time; it is inserted once, like in a set
+        records = np.unique(np.fromfile(filename, dtype=SPILL_RECORD))
+        SH.insert_hashed_entries(records["bin"].astype(np.int64), records["entry"])
+        os.remove(filename)
 
-        console.log("[yellow]Finished partitioning (coefficients of minibin polynomials found). Time taken: {:.2f}s.[/yellow]".format(t3-t2))
+    SH.pad_bins(start, stop)
 
-        console.log("[blue]Server offline total time: {:.2f}s[/blue]".format(t3-t0))
+    db[:, start:stop] = np.asarray(SH.partition(ALPHA, MINIBIN_CAP, PLAIN_MOD, start, stop), dtype=np.uint32).T
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
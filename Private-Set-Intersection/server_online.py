@@ -1,16 +1,260 @@
+import atexit
+from itertools import count
+from multiprocessing import get_context, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import os
 import pickle
 import socket
 from time import time, sleep
-from typing import List, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
-from Pyfhel import Pyfhel, PyCtxt
+from Pyfhel import Pyfhel, PyCtxt, PyPtxt
 from rich.console import Console
 
-from auxiliary_functions import get_and_deserialize_data, reconstruct_power, serialize_and_send_data
+from auxiliary_functions import get_and_deserialize_data, plan_paterson_stockmeyer, plan_power_computation, serialize_and_send_data, windowed_exponents
 from constants import *
 from oprf import server_prf_online_parallel
-from oprf_constants import SERVER_OPRF_KEY
+from oprf_constants import NUM_OF_PROCESSES, SERVER_OPRF_KEY
+from server_database import load_server_database
+import tracing
+
+# encoded plaintext columns of the loaded server database, see load_encoded_server_database
+_encoded_server_database = {}
+
+# long-lived pool the homomorphic evaluation is spread over, see get_evaluation_pool
+_evaluation_pool = None
+_evaluation_pool_key = None
+
+# in a worker of the evaluation pool: the query being evaluated, see SharedQuery
+_worker_query = {"query_id": None, "pyfhelobj": None, "ciphertexts": {}, "segments": {}}
+_query_ids = count()
+
+
+class SharedQuery():
+    """
+    A client query evaluated on the evaluation pool (see get_evaluation_pool): the client's
+    context, relinearization key and encrypted powers, serialized into shared memory. Tasks
+    only carry their locations, and every worker deserializes each of them at most once
+    per query, keeping them until it gets a task of another query.
+
+    So there is one serialized copy of the query, but one deserialized copy per worker.
+    Pyfhel objects live in the native heap of the process that deserialized them and can
+    only cross processes as bytes. A worker can share the parent's deserialized copy only
+    if it is forked after the query arrives, i.e. with a new pool per query, which is the
+    per-query fork this pool exists to avoid. Deserializing a key or ciphertext is one pass
+    over its bytes, cheap next to the evaluation, since each object is read once per worker
+    and then used in many multiplications. The price is memory: a worker keeps up to all the
+    powers of a query (about 20 MB with the default parameters).
+
+    Attributes:
+        query_id (str): identifies the query in the workers
+        locations (Dict[Any, Tuple[str, int, int]]): for "context", "relin_key" and the
+                                                     exponent of every power: name of its
+                                                     shared memory block, offset and length
+        segments (List[SharedMemory]): shared memory blocks of the query, only in the
+                                       process that set it up
+
+    Methods:
+        share(blobs: Dict[Any, bytes]) -> None:
+            Writes more serialized objects (e.g. powers just computed) to shared memory.
+
+        pyfhel() -> Pyfhel:
+            In a worker, returns the client's Pyfhel object.
+
+        ciphertext(exponent: int) -> PyCtxt:
+            In a worker, returns the encrypted power Enc(y^exponent).
+
+        close() -> None:
+            Releases the shared memory blocks, once the query is evaluated.
+    """
+
+    def __init__(self, context: bytes, relin_key: bytes):
+        """
+        SharedQuery constructor.
+
+        :param context: the client's serialized context
+        :param relin_key: the client's serialized relinearization key
+        """
+
+        self.query_id = "{}-{}".format(os.getpid(), next(_query_ids))
+        self.locations = {}
+        self.segments = []
+
+        self.share({"context": context, "relin_key": relin_key})
+
+    @classmethod
+    def from_received_data(cls, received_data: List[Any]) -> "SharedQuery":
+        """
+        :param received_data: the client's FHE context, keys and query (see server_FHE_setup)
+        :return: the shared query, holding the powers found in the client's query
+        """
+
+        query = cls(received_data[0], received_data[2])
+
+        serialized_query = received_data[3]
+        query.share({(i + 1) * BASE ** j: serialized_query[i][j]
+                     for i in range(BASE - 1) for j in range(LOG_B_ELL) if (i + 1) * BASE ** j - 1 < MINIBIN_CAP})
+
+        return query
+
+    @classmethod
+    def from_pyfhel(cls, pyfhelobj: Pyfhel, powers: Dict[int, PyCtxt]) -> "SharedQuery":
+        """
+        :param pyfhelobj: the Pyfhel object holding the client's context and relinearization key
+        :param powers: dictionary mapping exponents to encrypted powers
+        :return: the shared query, holding the given powers
+        """
+
+        query = cls(pyfhelobj.to_bytes_context(), pyfhelobj.to_bytes_relin_key())
+        query.share({e: power.to_bytes(compr_mode="none") for e, power in powers.items()})
+
+        return query
+
+    def __getstate__(self):
+        # the shared memory blocks stay with the process that set up the query
+        return {"query_id": self.query_id, "locations": self.locations}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.segments = []
+
+    def share(self, blobs: Dict[Any, bytes]) -> None:
+        """
+        Writes serialized objects to a new shared memory block.
+
+        :param blobs: bytes-like serialized objects, keyed by "context", "relin_key" or exponent
+        """
+
+        blobs = {key: memoryview(blob).cast("B") for key, blob in blobs.items()}
+        if not blobs:
+            return
+
+        segment = SharedMemory(create=True, size=sum(blob.nbytes for blob in blobs.values()))
+        self.segments.append(segment)
+
+        offset = 0
+        for key, blob in blobs.items():
+            segment.buf[offset: offset + blob.nbytes] = blob
+            self.locations[key] = (segment.name, offset, blob.nbytes)
+            offset += blob.nbytes
+
+    def close(self) -> None:
+        """
+        Releases the shared memory blocks of the query.
+        """
+
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+    def pyfhel(self) -> Pyfhel:
+        """
+        :return: in a worker, the client's Pyfhel object (deserialized once per query)
+        """
+
+        cache = self._worker_cache()
+
+        if cache["pyfhelobj"] is None:
+            pyfhelobj = Pyfhel()
+            pyfhelobj.from_bytes_context(self._read("context"))
+            pyfhelobj.from_bytes_relin_key(self._read("relin_key"))
+            cache["pyfhelobj"] = pyfhelobj
+
+        return cache["pyfhelobj"]
+
+    def ciphertext(self, exponent: int) -> PyCtxt:
+        """
+        :param exponent: exponent of a power shared with the workers
+        :return: in a worker, the encrypted power Enc(y^exponent) (deserialized once per query)
+        """
+
+        cache = self._worker_cache()
+
+        if exponent not in cache["ciphertexts"]:
+            cache["ciphertexts"][exponent] = PyCtxt(pyfhel=self.pyfhel(), bytestring=self._read(exponent))
+
+        return cache["ciphertexts"][exponent]
+
+    def _read(self, key: Any) -> bytes:
+        """
+        :return: in a worker, a copy of the serialized object stored under key
+        """
+
+        name, offset, length = self.locations[key]
+        segments = self._worker_cache()["segments"]
+
+        if name not in segments:
+            segments[name] = SharedMemory(name=name)
+
+        return bytes(segments[name].buf[offset: offset + length])
+
+    def _worker_cache(self) -> Dict[str, Any]:
+        """
+        :return: the worker's cache for this query; the objects of the previous query are dropped
+        """
+
+        if _worker_query["query_id"] != self.query_id:
+            for segment in _worker_query["segments"].values():
+                segment.close()
+            _worker_query.update(query_id=self.query_id, pyfhelobj=None, ciphertexts={}, segments={})
+
+        return _worker_query
+
+
+def get_evaluation_pool(processes: int):
+    """
+    Returns the long-lived pool the homomorphic evaluation is spread over, forking it on
+    first use. Its workers inherit the encoded server database from this process (see
+    load_encoded_server_database), so the pool is forked again when another database is
+    loaded (e.g. after server_update.py) or with another number of processes; the state
+    of each query reaches them through shared memory (see SharedQuery). It is shut down at exit.
+
+    :param processes: number of worker processes
+    :return: the multiprocessing Pool used for the homomorphic evaluation
+    """
+
+    global _evaluation_pool, _evaluation_pool_key
+
+    key = (processes, tuple(_encoded_server_database))
+
+    if _evaluation_pool is not None and _evaluation_pool_key != key:
+        shutdown_evaluation_pool()
+
+    if _evaluation_pool is None:
+        # start the resource tracker before the workers, so that they share it and
+        # shared memory blocks attached by the workers are only tracked once
+        resource_tracker.ensure_running()
+        _evaluation_pool = get_context("fork").Pool(processes)
+        _evaluation_pool_key = key
+        atexit.register(shutdown_evaluation_pool)
+
+    return _evaluation_pool
+
+def shutdown_evaluation_pool():
+    """
+    Terminates the evaluation pool, if it was created.
+    """
+
+    global _evaluation_pool, _evaluation_pool_key
+
+    if _evaluation_pool is not None:
+        _evaluation_pool.close()
+        _evaluation_pool.join()
+        _evaluation_pool = None
+        _evaluation_pool_key = None
+
+def evaluation_pool_map(func: Callable[..., Any], args: List[Tuple], processes: int) -> List[Any]:
+    """
+    :param func: module-level function run by the workers of the evaluation pool
+    :param args: argument tuples of the calls of func
+    :param processes: number of worker processes of the evaluation pool
+    :return: list of the results of the calls, in order
+    """
+
+    # chunksize=1 lets idle workers pull the next call as soon as they are done
+    return get_evaluation_pool(processes).starmap(func, args, chunksize=1)
 
 
 def main():
@@ -27,70 +271,304 @@ def main():
         conn_socket = server_network_setup()
         console.log("[yellow]Client connection accepted.[/yellow]")
 
+        computation_time, server_to_client_size, client_to_server_size = serve_client(conn_socket, console)
+
+        t5 = time()
+
+        # close the connection socket
+        conn_socket.close()
+
+        console.log("\n[blue]Server time spent on computations: {:.2f}s[/blue]".format(computation_time))
+        console.log("[blue]Server program total time:  {:.2f}s[/blue]".format(t5 - t0))
+        console.log("[blue]Communication sizes:[/blue]")
+        console.log("[blue]\tServer --> Client:\t{:.2f} MB[/blue]".format(server_to_client_size / 2 ** 20))
+        console.log("[blue]\tClient --> Server:\t{:.2f} MB[/blue]".format(client_to_server_size / 2 ** 20))
+
+    tracing.export()
+
+
+def serve_client(conn_socket: socket.socket, console: Console,
+                 server_preprocessed_filename: str = "server_preprocessed",
+                 processes: int = NUM_OF_PROCESSES,
+                 shards: Optional[List[Tuple[str, int]]] = None) -> Tuple[float, int, int]:
+    """
+    Runs the online phase of the protocol for one client: the OPRF, then the
+    evaluation of the client's query against the server's database.
+
+    :param conn_socket: socket connected to the client
+    :param console: rich console used for progress messages
+    :param server_preprocessed_filename: filename where server's prepocessed items are
+                                         (see server_offline.py)
+    :param processes: number of processes the homomorphic evaluation is spread over
+    :param shards: if given, (host, port) addresses of shard servers the query is evaluated
+                   by instead of this process (see server_shard.py)
+    :returns:
+        computation_time: time (in seconds) spent on computations
+        server_to_client_size: number of bytes sent to the client
+        client_to_server_size: number of bytes received from the client
+    """
+
+    with tracing.stage("server_session"):
         # server receives elliptic curve embedded curve points from the client
-        encoded_client_set, client_embedded_set_size = get_and_deserialize_data(conn_socket)
+        with tracing.stage("receive_oprf_request") as receive_oprf_stage:
+            encoded_client_set, _ = get_and_deserialize_data(conn_socket, MSG_OPRF_REQUEST)
         console.log("[yellow]Received client's elliptic curve embedded items.[/yellow]")
 
-        t1 = time()
         # server multiplies the client's curve points with server's OPRF key
-        PRFed_client_set = server_prf_online_parallel(encoded_client_set, SERVER_OPRF_KEY)
+        with tracing.stage("server_oprf_online") as oprf_stage:
+            PRFed_client_set = server_prf_online_parallel(encoded_client_set, SERVER_OPRF_KEY)
         console.log("[yellow]Finished multiplying client's items with server's OPRF key.[/yellow]")
 
-        t2 = time()
         # send the result (PRFed_client_set) to the client
-        PRFed_client_set_size = serialize_and_send_data(conn_socket, PRFed_client_set)
+        with tracing.stage("send_oprf_response") as send_oprf_stage:
+            serialize_and_send_data(conn_socket, PRFed_client_set, msg_type=MSG_OPRF_RESPONSE)
         console.log("[yellow]Client's EC-embedded items * server's OPRF key sent to client.[/yellow]")
-    
+
         # We wait for client to send us their FHE context and ciphertext, and also their query
-        received_data, fhe_context_and_query_size = get_and_deserialize_data(conn_socket)
+        with tracing.stage("receive_query") as receive_query_stage:
+            received_data, _ = get_and_deserialize_data(conn_socket, MSG_QUERY)
+
+        with tracing.stage("query_evaluation") as evaluation_stage:
+            if shards:
+                srv_answer = gather_shard_responses(received_data, shards, console, processes)
+                console.log("[yellow]Query evaluated by {} shards.[/yellow]".format(len(shards)))
+            else:
+                srv_answer = evaluate_query(received_data, console, server_preprocessed_filename, processes)
+
+        # send the answer
+        with tracing.stage("send_response") as send_response_stage:
+            serialize_and_send_data(conn_socket, data=srv_answer, msg_type=MSG_RESPONSE)
+        console.log("[yellow]Server's answer prepared and sent to client.[/yellow]")
+
+    # messages exchanged with shards are not part of the communication with the client
+    return (oprf_stage.wall_time + evaluation_stage.wall_time,
+            send_oprf_stage.total_bytes_sent + send_response_stage.total_bytes_sent,
+            receive_oprf_stage.total_bytes_received + receive_query_stage.total_bytes_received)
+
 
+def evaluate_query(received_data: List[Any], console: Console,
+                   server_preprocessed_filename: str = "server_preprocessed",
+                   processes: int = NUM_OF_PROCESSES,
+                   partitions: Optional[Iterable[int]] = None) -> List[bytes]:
+    """
+    Evaluates a client's query against the server's database.
+
+    :param received_data: the client's FHE context, keys and query (see server_FHE_setup)
+    :param console: rich console used for progress messages
+    :param server_preprocessed_filename: filename where server's prepocessed items are
+                                         (see server_offline.py)
+    :param processes: number of processes the homomorphic evaluation is spread over
+    :param partitions: indices of the partitions to evaluate (default: all ALPHA of them)
+    :return: evaluated polynomials in encrypted form, one per partition
+    """
+
+    with tracing.stage("query_deserialization"):
         # reconstruct the pyfhel object (pyfhelobj) and the (serialized) client query
         pyfhelobj, serialized_query = server_FHE_setup(received_data)
         console.log("[yellow]Received client's query and Fully Homomorphic Encryption context.[/yellow]")
 
         # deserialize the client's query
         encrypted_query = reconstruct_encrypted_query(pyfhelobj, serialized_query)
-        console.log("[yellow]Finished deserializing client's query.[/yellow]")
 
-        # recover all the encrypted powers Enc(y), Enc(y^2), Enc(y^3) ..., Enc(y^{minibin_capacity})
-        all_powers = recover_encrypted_powers(encrypted_query)
+        # the database is encoded before the evaluation pool is forked, so that its workers share it
+        load_encoded_server_database(server_preprocessed_filename, partitions)
+
+        # the evaluation pool's workers get the client's context, keys and powers through shared memory
+        query = SharedQuery.from_received_data(received_data) if processes > 1 else None
+    console.log("[yellow]Finished deserializing client's query.[/yellow]")
+
+    try:
+        # recover the encrypted powers the evaluation needs: Enc(y), ..., Enc(y^{minibin_capacity}),
+        # or only the baby step and giant step powers for Paterson-Stockmeyer
+        with tracing.stage("power_recovery"):
+            powers = compute_encrypted_powers(encrypted_query, query_power_exponents(), pyfhelobj, processes, query)
         console.log("[yellow]Finished recovering client's encrypted powers.[/yellow]")
 
-        t3 = time()
         # prepare server's answer to client query; the evaluated polynomials in encrypted form
-        srv_answer = prepare_server_response(pyfhelobj, all_powers, "server_preprocessed")
+        with tracing.stage("response_evaluation"):
+            return evaluate_powers(pyfhelobj, powers, server_preprocessed_filename, processes, partitions, query)
+    finally:
+        if query is not None:
+            query.close()
+
+def evaluate_shard_query(received_data: List[Any], console: Console,
+                         server_preprocessed_filename: str = "server_preprocessed",
+                         processes: int = NUM_OF_PROCESSES) -> List[bytes]:
+    """
+    Evaluates a query forwarded by the front end (see gather_shard_responses) on some
+    partitions of the server's database. The front end already recovered the encrypted
+    powers, so only the evaluation of the partitions is left.
+
+    :param received_data: the client's serialized context and relinearization key, the
+                          partitions to evaluate, the exponents of the powers and the
+                          serialized powers
+    :param console: rich console used for progress messages
+    :param server_preprocessed_filename: filename where server's prepocessed items are
+                                         (see server_offline.py)
+    :param processes: number of processes the homomorphic evaluation is spread over
+    :return: evaluated polynomials in encrypted form, one per requested partition
+    """
 
-        t4 = time()
-        # send the answer
-        server_answer_size = serialize_and_send_data(conn_socket, data=srv_answer)
-        console.log("[yellow]Server's answer prepared and sent to client.[/yellow]")
+    context, relin_key, partitions, exponents, serialized_powers = received_data
 
-        t5 = time()
+    with tracing.stage("query_deserialization"):
+        pyfhelobj = Pyfhel()
+        pyfhelobj.from_bytes_context(bytes(context))
+        pyfhelobj.from_bytes_relin_key(bytes(relin_key))
+        powers = {e: PyCtxt(pyfhel=pyfhelobj, bytestring=bytes(power)) for e, power in zip(exponents, serialized_powers)}
 
-        # close the connection socket
-        conn_socket.close()
+        # the database is encoded before the evaluation pool is forked, so that its workers share it
+        load_encoded_server_database(server_preprocessed_filename, partitions)
 
-        console.log("\n[blue]Server time spent on computations: {:.2f}s[/blue]".format(t2-t1+t4-t3))
-        console.log("[blue]Server program total time:  {:.2f}s[/blue]".format(t5 - t0))
-        console.log("[blue]Communication sizes:[/blue]")
-        console.log("[blue]\tServer --> Client:\t{:.2f} MB[/blue]".format((PRFed_client_set_size + server_answer_size )/ 2 ** 20))
-        console.log("[blue]\tClient --> Server:\t{:.2f} MB[/blue]".format((client_embedded_set_size + fhe_context_and_query_size )/ 2 ** 20))
+        # the evaluation pool's workers get the client's context, keys and powers through shared memory
+        query = None
+        if processes > 1:
+            query = SharedQuery(context, relin_key)
+            query.share(dict(zip(exponents, serialized_powers)))
+    console.log("[yellow]Finished deserializing the client's encrypted powers.[/yellow]")
 
+    try:
+        with tracing.stage("response_evaluation"):
+            return evaluate_powers(pyfhelobj, powers, server_preprocessed_filename, processes, partitions, query)
+    finally:
+        if query is not None:
+            query.close()
+
+def query_power_exponents() -> List[int]:
+    """
+    :return: exponents of the encrypted powers the evaluation of the partitions needs (see
+             POLY_EVALUATION): 1, ..., MINIBIN_CAP, or only the baby and giant steps
+    """
+
+    if POLY_EVALUATION == "paterson-stockmeyer":
+        baby_steps, _ = plan_paterson_stockmeyer(MINIBIN_CAP, ALPHA, windowed_exponents(BASE, LOG_B_ELL, MINIBIN_CAP), PS_BABY_STEPS)
+        giant_steps = (MINIBIN_CAP + baby_steps) // baby_steps
+        return list(range(1, baby_steps)) + [g * baby_steps for g in range(1, giant_steps)]
+
+    return list(range(1, MINIBIN_CAP + 1))
+
+def evaluate_powers(pyfhelobj: Pyfhel, powers: Dict[int, PyCtxt], server_preprocessed_filename: str,
+                    processes: int = 1, partitions: Optional[Iterable[int]] = None,
+                    query: Optional[SharedQuery] = None) -> List[bytes]:
+    """
+    Evaluates the polynomials of the partitions on the client's encrypted powers, with
+    the evaluation chosen by POLY_EVALUATION.
+
+    :param pyfhelobj: the Pyfhel object
+    :param powers: dictionary mapping exponents to encrypted powers, holding (at least) the
+                   powers of query_power_exponents()
+    :param server_preprocessed_filename: filename where server's prepocessed items are
+                                         (see server_offline.py)
+    :param processes: number of processes to spread the partitions over
+    :param partitions: indices of the partitions to evaluate (default: all ALPHA of them)
+    :param query: the query shared with the evaluation pool, holding the same powers (see
+                  SharedQuery); if not given, one is set up when needed
+    :return: evaluated polynomials in encrypted form, one per partition
+    """
+
+    if POLY_EVALUATION == "paterson-stockmeyer":
+        baby_steps, _ = plan_paterson_stockmeyer(MINIBIN_CAP, ALPHA, windowed_exponents(BASE, LOG_B_ELL, MINIBIN_CAP), PS_BABY_STEPS)
+        return prepare_server_response_paterson_stockmeyer(pyfhelobj, powers, baby_steps, server_preprocessed_filename,
+                                                           processes=processes, partitions=partitions, query=query)
+
+    all_powers = [powers[k] for k in range(MINIBIN_CAP, 0, -1)]
+    return prepare_server_response(pyfhelobj, all_powers, server_preprocessed_filename,
+                                   processes=processes, partitions=partitions, query=query)
+
+def gather_shard_responses(received_data: List[Any], shards: List[Tuple[str, int]],
+                           console: Console, processes: int = 1) -> List[bytes]:
+    """
+    Has a client's query evaluated by the shard servers (see server_shard.py). The
+    encrypted powers are recovered once, here, and sent to every shard, so that the
+    shards only evaluate their partitions; shard k is asked for shard_partitions(k, N).
+    The powers are sent to every shard before any answer is awaited, so the shards
+    evaluate their partitions at the same time. A shard that does not answer within
+    SESSION_TIMEOUT fails the query instead of hanging the worker, and so does a shard
+    that does not own the partitions it is asked for (it answers with MSG_ERROR).
+
+    :param received_data: the client's FHE context, keys and query (see server_FHE_setup)
+    :param shards: (host, port) addresses of the shard servers
+    :param console: rich console used for progress messages
+    :param processes: number of processes the power recovery is spread over
+    :return: evaluated polynomials in encrypted form, one per partition, in partition order
+    """
+
+    with tracing.stage("query_deserialization"):
+        pyfhelobj, serialized_query = server_FHE_setup(received_data)
+        encrypted_query = reconstruct_encrypted_query(pyfhelobj, serialized_query)
+    console.log("[yellow]Finished deserializing client's query.[/yellow]")
+
+    with tracing.stage("power_recovery"):
+        exponents = query_power_exponents()
+        powers = compute_encrypted_powers(encrypted_query, exponents, pyfhelobj, processes)
+        serialized_powers = [powers[e].to_bytes() for e in exponents]
+    console.log("[yellow]Finished recovering client's encrypted powers.[/yellow]")
+
+    shares = [shard_partitions(k, len(shards)) for k in range(len(shards))]
+    connections = []
+    srv_answer = []
+
+    with tracing.stage("shard_evaluation"):
+        try:
+            for address, share in zip(shards, shares):
+                connections.append(socket.create_connection(address, timeout=SESSION_TIMEOUT))
+                serialize_and_send_data(connections[-1], [received_data[0], received_data[2], share, exponents, serialized_powers],
+                                        msg_type=MSG_SHARD_QUERY)
+
+            for address, share, connection in zip(shards, shares, connections):
+                ciphertexts, _ = get_and_deserialize_data(connection, MSG_SHARD_RESPONSE)
+                if len(ciphertexts) != len(share):
+                    raise Exception('Shard {}:{} answered with {} partitions instead of {}'.format(*address, len(ciphertexts), len(share)))
+                srv_answer += ciphertexts
+        finally:
+            for connection in connections:
+                connection.close()
+
+    return srv_answer
+
+def shard_partitions(shard: int, num_shards: int) -> List[int]:
+    """
+    Example: with ALPHA = 16, shard_partitions(1, 3) is [5, 6, 7, 8, 9]
+
+    :param shard: index of the shard
+    :param num_shards: number of shards
+    :return: the shard's share of the ALPHA partitions; the shares are contiguous (so that
+             a shard reads a contiguous part of the database) and their sizes differ by at most one
+    """
+
+    if not 0 <= shard < num_shards:
+        raise ValueError("Shard index {} out of range for {} shards".format(shard, num_shards))
+
+    return list(range(ALPHA * shard // num_shards, ALPHA * (shard + 1) // num_shards))
+
+def server_listen(backlog: int = 1, port: int = SERVER_PORT) -> socket.socket:
+    """
+    Sets up server's socket and binds it to SERVER_HOST on port SERVER_PORT.
+
+    :param backlog: number of pending connections the socket queues
+    :param port: port to listen on
+    :return: listening socket
+    """
+    serv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    serv.bind((SERVER_HOST, port))
+    serv.listen(backlog)
+
+    return serv
 
 def server_network_setup():
     """
-    Sets up server's socket and binds it to localhost on port 4470.
+    Sets up server's socket and binds it to SERVER_HOST on port SERVER_PORT.
     Waits for a connection from the client. Returns the connection
     socket when a connection has been established.
 
     :return: socket representing the server-client connection
     """
-    serv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    serv.bind(('localhost', 4470))
-    serv.listen(1)
+    serv = server_listen()
 
     # accept connection from client
     connectionsocket, _ = serv.accept()
+    serv.close()
 
     return connectionsocket
 
@@ -107,9 +585,11 @@ def server_FHE_setup(received_data: List[bytes]) -> Tuple[Pyfhel, bytes]:
         serialized_query: client's query
     """
     pyfhelobj = Pyfhel()
-    pyfhelobj.from_bytes_context(received_data[0])
-    pyfhelobj.from_bytes_public_key(received_data[1])
-    pyfhelobj.from_bytes_relin_key(received_data[2])
+    # keys and context arrive as memoryviews into the receive buffer (see get_and_deserialize_data);
+    # Pyfhel needs them as bytes
+    pyfhelobj.from_bytes_context(bytes(received_data[0]))
+    pyfhelobj.from_bytes_public_key(bytes(received_data[1]))
+    pyfhelobj.from_bytes_relin_key(bytes(received_data[2]))
     # pyfhelobj.from_bytes_rotate_key(received_data[3])
 
     # serialized_query = received_data[4]
@@ -131,73 +611,331 @@ def reconstruct_encrypted_query(pyfhelobj, serialized_query):
     for i in range(BASE - 1):
         for j in range(LOG_B_ELL):
             if ((i + 1) * BASE ** j - 1 < MINIBIN_CAP):
-                deserialized_query[i][j] = PyCtxt(pyfhel=pyfhelobj, bytestring=serialized_query[i][j])
+                deserialized_query[i][j] = PyCtxt(pyfhel=pyfhelobj, bytestring=bytes(serialized_query[i][j]))
 
     return deserialized_query
 
-def recover_encrypted_powers(encrypted_query):
+def recover_encrypted_powers(encrypted_query, pyfhelobj: Pyfhel, processes: int = 1,
+                             query: Optional[SharedQuery] = None) -> List[PyCtxt]:
     """
     Recovers all the encrypted powers Encrypted(y), Encrypted(y^2), ..., Encrypted(y^{minibin_capacity}),
     using the encrypted windowing of y.
     "needed to compute the polynomial of degree minibin_capacity"
 
     :param encrypted_query: deserialized query from client
+    :param pyfhelobj: the Pyfhel object, needed for relinearization after multiplications
+    :param processes: number of processes to spread the multiplications over
+    :param query: the query shared with the evaluation pool, if already set up (see SharedQuery)
     :return: all the encrypted powers Enc(y), Enc(y^2), Enc(y^3) ..., Enc(y^{minibin_capacity})
     """
 
-    all_powers = [None for i in range(MINIBIN_CAP)]
+    powers = compute_encrypted_powers(encrypted_query, range(1, MINIBIN_CAP + 1), pyfhelobj, processes, query)
+
+    return [powers[k] for k in range(MINIBIN_CAP, 0, -1)]
+
+def compute_encrypted_powers(encrypted_query, exponents: Iterable[int], pyfhelobj: Pyfhel, processes: int = 1,
+                             query: Optional[SharedQuery] = None) -> Dict[int, PyCtxt]:
+    """
+    Computes the encrypted powers Enc(y^e) (e in exponents) from the encrypted windowing
+    of y, following the plan of plan_power_computation: each power is computed once, with
+    the smallest multiplicative depth, and reused for the powers that depend on it. Every
+    product is relinearized, so all the powers have two polynomials. With several
+    processes, the powers of each depth are computed in parallel on the evaluation pool,
+    one depth after the other; every new power is added to the shared query, so that the
+    next depth (and the evaluation of the partitions) can use it.
+
+    :param encrypted_query: deserialized query from client
+    :param exponents: exponents of the powers to compute
+    :param pyfhelobj: the Pyfhel object, needed for relinearization after multiplications
+    :param processes: number of processes to spread the multiplications over
+    :param query: the query shared with the evaluation pool, holding the powers found in
+                  the query (see SharedQuery); if not given, one is set up for this call
+    :return: dictionary mapping exponents to encrypted powers; it also holds the powers
+             found in the query
+    """
+
+    powers = {}
 
     for i in range(BASE - 1):
         for j in range(LOG_B_ELL):
             if ((i + 1) * BASE ** j - 1 < MINIBIN_CAP):
-                all_powers[(i + 1) * BASE ** j - 1] = encrypted_query[i][j]
+                powers[(i + 1) * BASE ** j] = encrypted_query[i][j]
+
+    plan = plan_power_computation(exponents, powers.keys())
+
+    # group the steps by depth; the steps of one depth only use powers of smaller depths
+    depth = dict.fromkeys(powers, 0)
+    levels = []
+    for e, a, b in plan:
+        depth[e] = max(depth[a], depth[b]) + 1
+        if depth[e] > len(levels):
+            levels.append([])
+        levels[depth[e] - 1].append((e, a, b))
+
+    own_query = query is None and processes > 1 and any(len(level) > 1 for level in levels)
+    if own_query:
+        query = SharedQuery.from_pyfhel(pyfhelobj, powers)
+
+    try:
+        for level in levels:
+            if query is not None and len(level) > 1:
+                products = evaluation_pool_map(multiply_shared_powers, [(query, step) for step in level], processes)
+                for (e, _, _), product in zip(level, products):
+                    powers[e] = PyCtxt(pyfhel=pyfhelobj, bytestring=product)
+            else:
+                for e, a, b in level:
+                    powers[e] = pyfhelobj.multiply(powers[a], powers[b], in_new_ctxt=True)
+                    pyfhelobj.relinearize(powers[e])
+                products = [powers[e].to_bytes(compr_mode="none") for e, _, _ in level] if query is not None else []
+
+            if query is not None:
+                query.share({e: product for (e, _, _), product in zip(level, products)})
+    finally:
+        if own_query:
+            query.close()
+
+    return powers
+
+def multiply_shared_powers(query: SharedQuery, step: Tuple[int, int, int]) -> bytes:
+    """
+    Computes one step of a power computation plan in a worker of the evaluation pool.
 
-    for k in range(MINIBIN_CAP):
-        if all_powers[k] == None:
-            all_powers[k] = reconstruct_power(encrypted_query, k + 1)
-    all_powers = all_powers[::-1]
+    :param query: the shared query, holding the powers computed so far
+    :param step: (e, a, b), meaning Enc(y^e) = Enc(y^a) * Enc(y^b)
+    :return: the relinearized product, serialized (uncompressed, since it does not leave the server)
+    """
+
+    pyfhelobj = query.pyfhel()
+    _, a, b = step
+
+    product = pyfhelobj.multiply(query.ciphertext(a), query.ciphertext(b), in_new_ctxt=True)
+    pyfhelobj.relinearize(product)
+
+    return product.to_bytes(compr_mode="none")
+
+def load_encoded_server_database(server_preprocessed_filename: str,
+                                 partitions: Optional[Iterable[int]] = None) -> List[Optional[PyPtxt]]:
+    """
+    Returns every coefficient column of the server database, already encoded as a BFV
+    plaintext. The columns are encoded once per loaded database and kept in memory, so
+    queries do not re-encode them; the cache is refreshed when the file changes (e.g.
+    after server_update.py). Batch encoding only depends on POLY_MOD and PLAIN_MOD, so
+    the plaintexts work with any client context using these parameters.
+
+    :param server_preprocessed_filename: filename where server's prepocessed items are
+                                         (see server_offline.py)
+    :param partitions: if given, only the columns of these partitions are read and encoded
+                       (e.g. on a shard server, see server_shard.py)
+    :return: list of ALPHA * (MINIBIN_CAP + 1) plaintexts; entry (MINIBIN_CAP + 1) * i + j
+             holds coefficient j of minibin i for every bin (None for the partitions left out)
+    """
+
+    partitions = tuple(range(ALPHA)) if partitions is None else tuple(sorted(partitions))
+    key = (os.path.abspath(server_preprocessed_filename), os.stat(server_preprocessed_filename).st_mtime_ns, partitions)
+
+    if key not in _encoded_server_database:
+        transposed_poly_coeffs = load_server_database(server_preprocessed_filename)
 
-    return all_powers
+        encoder = Pyfhel()
+        encoder.contextGen(scheme="bfv", n=POLY_MOD, t=PLAIN_MOD)
+
+        # the columns of a partition are contiguous in the file, so only those pages are read
+        columns = [None] * len(transposed_poly_coeffs)
+        for i in partitions:
+            for j in range((MINIBIN_CAP + 1) * i, (MINIBIN_CAP + 1) * (i + 1)):
+                columns[j] = encoder.encodeInt(np.ascontiguousarray(transposed_poly_coeffs[j], dtype=np.int64))
+
+        _encoded_server_database.clear()
+        _encoded_server_database[key] = columns
+
+    return _encoded_server_database[key]
 
 def prepare_server_response(pyfhelobj: Pyfhel, all_powers: List[PyCtxt], 
-                            server_preprocessed_filename: str) -> List[bytes]:
+                            server_preprocessed_filename: str,
+                            processes: int = 1,
+                            partitions: Optional[Iterable[int]] = None,
+                            query: Optional[SharedQuery] = None) -> List[bytes]:
     """
     Computes the polynomials (while in encrypted form; FHE magic happens here)
-    and returns the resulting ciphertexts.
+    and returns the resulting ciphertexts. The ALPHA partitions are independent,
+    so with several processes they are evaluated in parallel on the evaluation pool;
+    its workers inherit the encoded database and deserialize the context and the
+    powers once per query (see SharedQuery).
 
     :param pyfhelobj: the Pyfhel object, needed for relinearization after multiplications
     :param all_powers: client's encrypted powers
     :param server_preprocessed_filename: filename where server's prepocessed items are
                                          (see server_offline.py)
-    :return: evaluated polynomials in encrypted form
+    :param processes: number of processes to spread the partitions over
+    :param partitions: indices of the partitions to evaluate (default: all ALPHA of them)
+    :param query: the query shared with the evaluation pool, holding all the powers (see
+                  SharedQuery); if not given, one is set up for this call
+    :return: evaluated polynomials in encrypted form, one per partition
+    """
+
+    partitions = list(range(ALPHA) if partitions is None else partitions)
+
+    # get server's preprocessed items, encoded as plaintexts (before the evaluation pool is forked, so that workers share them)
+    encoded_poly_coeffs = load_encoded_server_database(server_preprocessed_filename, partitions)
+
+    if processes <= 1 or len(partitions) <= 1:
+        # Server sends alpha ciphertexts, obtained from performing dot_product between the polynomial coefficients from the preprocessed server database and all the powers Enc(y), ..., Enc(y^{minibin_capacity})
+        return [evaluate_partition(pyfhelobj, all_powers, encoded_poly_coeffs, i) for i in partitions]
+
+    own_query = query is None
+    if own_query:
+        query = SharedQuery.from_pyfhel(pyfhelobj, {MINIBIN_CAP - k: power for k, power in enumerate(all_powers)})
+
+    try:
+        return evaluation_pool_map(evaluate_shared_partition,
+                                   [(query, server_preprocessed_filename, partitions, i) for i in partitions], processes)
+    finally:
+        if own_query:
+            query.close()
+
+def evaluate_partition(pyfhelobj: Pyfhel, all_powers: List[PyCtxt], encoded_poly_coeffs: List[PyPtxt],
+                       i: int) -> bytes:
+    """
+    Evaluates the polynomial of partition i (see prepare_server_response).
+
+    :param pyfhelobj: the Pyfhel object
+    :param all_powers: client's encrypted powers Enc(y^{minibin_capacity}), ..., Enc(y)
+    :param encoded_poly_coeffs: the encoded server database (see load_encoded_server_database)
+    :param i: index of the partition
+    :return: evaluated polynomial in encrypted form
+    """
+
+    # the rows with index multiple of (B/alpha+1) have only 1s
+    dot_product = PyCtxt(copy_ctxt=all_powers[0])
+
+    # multiply-accumulate into dot_product in place
+    for j in range(1, MINIBIN_CAP):
+        term = pyfhelobj.multiply_plain(all_powers[j], encoded_poly_coeffs[(MINIBIN_CAP + 1) * i + j], in_new_ctxt=True)
+        pyfhelobj.add(dot_product, term)
+
+    pyfhelobj.add_plain(dot_product, encoded_poly_coeffs[(MINIBIN_CAP + 1) * i + MINIBIN_CAP])
+
+    return dot_product.to_bytes()
+
+def evaluate_shared_partition(query: SharedQuery, server_preprocessed_filename: str,
+                              partitions: List[int], i: int) -> bytes:
+    """
+    Evaluates the polynomial of partition i in a worker of the evaluation pool (see
+    prepare_server_response); the encoded database is the one inherited from the server.
+    """
+
+    all_powers = [query.ciphertext(k) for k in range(MINIBIN_CAP, 0, -1)]
+    encoded_poly_coeffs = load_encoded_server_database(server_preprocessed_filename, partitions)
+
+    return evaluate_partition(query.pyfhel(), all_powers, encoded_poly_coeffs, i)
+
+def prepare_server_response_paterson_stockmeyer(pyfhelobj: Pyfhel, powers: Dict[int, PyCtxt], baby_steps: int,
+                                                server_preprocessed_filename: str,
+                                                processes: int = 1,
+                                                partitions: Optional[Iterable[int]] = None,
+                                                query: Optional[SharedQuery] = None) -> List[bytes]:
+    """
+    Same as prepare_server_response, but evaluates the polynomials with the
+    Paterson-Stockmeyer algorithm: with k baby steps, each polynomial is split into
+    blocks of k coefficients, each block is evaluated with the powers y, ..., y^{k-1},
+    multiplied by the giant step power y^{gk}, and the blocks are added up.
+
+    :param pyfhelobj: the Pyfhel object, needed for the multiplications by giant steps
+    :param powers: client's encrypted powers, holding (at least) the baby and giant steps
+                   (see plan_paterson_stockmeyer)
+    :param baby_steps: the number k of baby steps
+    :param server_preprocessed_filename: filename where server's prepocessed items are
+                                         (see server_offline.py)
+    :param processes: number of processes to spread the partitions over
+    :param partitions: indices of the partitions to evaluate (default: all ALPHA of them)
+    :param query: the query shared with the evaluation pool, holding (at least) the baby
+                  and giant steps (see SharedQuery); if not given, one is set up for this call
+    :return: evaluated polynomials in encrypted form, one per partition
     """
 
-    # get server's preprocessed items
-    g = open(server_preprocessed_filename, 'rb')
-    poly_coeffs = pickle.load(g)
+    partitions = list(range(ALPHA) if partitions is None else partitions)
+
+    # get server's preprocessed items, encoded as plaintexts (before the evaluation pool is forked, so that workers share them)
+    encoded_poly_coeffs = load_encoded_server_database(server_preprocessed_filename, partitions)
+
+    if processes <= 1 or len(partitions) <= 1:
+        return [evaluate_partition_paterson_stockmeyer(pyfhelobj, powers, baby_steps, encoded_poly_coeffs, i)
+                for i in partitions]
+
+    own_query = query is None
+    if own_query:
+        query = SharedQuery.from_pyfhel(pyfhelobj, powers)
 
-    # the columns are used
-    transposed_poly_coeffs = np.transpose(poly_coeffs).tolist()
+    try:
+        return evaluation_pool_map(evaluate_shared_partition_paterson_stockmeyer,
+                                   [(query, baby_steps, server_preprocessed_filename, partitions, i) for i in partitions],
+                                   processes)
+    finally:
+        if own_query:
+            query.close()
 
-    # Server sends alpha ciphertexts, obtained from performing dot_product between the polynomial coefficients from the preprocessed server database and all the powers Enc(y), ..., Enc(y^{minibin_capacity})
-    evaluated_polynomials = []
-    for i in range(ALPHA):
-        # the rows with index multiple of (B/alpha+1) have only 1s
+def evaluate_partition_paterson_stockmeyer(pyfhelobj: Pyfhel, powers: Dict[int, PyCtxt], baby_steps: int,
+                                           encoded_poly_coeffs: List[PyPtxt], i: int) -> bytes:
+    """
+    Evaluates the polynomial of partition i (see prepare_server_response_paterson_stockmeyer).
+
+    :param pyfhelobj: the Pyfhel object
+    :param powers: client's encrypted powers, holding (at least) the baby and giant steps
+    :param baby_steps: the number k of baby steps
+    :param encoded_poly_coeffs: the encoded server database (see load_encoded_server_database)
+    :param i: index of the partition
+    :return: evaluated polynomial in encrypted form
+    """
 
-        dot_product = all_powers[0]
-        for j in range(1, MINIBIN_CAP):
-            dot_product = dot_product + transposed_poly_coeffs[(MINIBIN_CAP + 1) * i + j] * all_powers[j]
-            
-            # # ValueError: not enough relinearization keys
-            # ~dot_product
-            
-            # # ValueError: not enough relinearization keys
-            # # pyfhelobj.relinearize(dot_product)
+    giant_steps = (MINIBIN_CAP + baby_steps) // baby_steps
+
+    # the coefficient of y^e is in column MINIBIN_CAP - e (the leading one holds only 1s)
+    def coefficient(e):
+        return encoded_poly_coeffs[(MINIBIN_CAP + 1) * i + MINIBIN_CAP - e]
+
+    evaluated = None
+    for g in range(giant_steps):
+        # block: sum of c_{gk+b} y^b for b = 0, ..., k-1
+        block = None
+        for b in range(1, min(baby_steps, MINIBIN_CAP - g * baby_steps + 1)):
+            term = pyfhelobj.multiply_plain(powers[b], coefficient(g * baby_steps + b), in_new_ctxt=True)
+            if block is None:
+                block = term
+            else:
+                pyfhelobj.add(block, term)
+
+        if block is None:
+            # the block is the constant c_{gk}; no ciphertext multiplication needed
+            block = pyfhelobj.multiply_plain(powers[g * baby_steps], coefficient(g * baby_steps), in_new_ctxt=True)
+        else:
+            pyfhelobj.add_plain(block, coefficient(g * baby_steps))
+            if g > 0:
+                block = pyfhelobj.multiply(block, powers[g * baby_steps], in_new_ctxt=True)
+
+        if evaluated is None:
+            evaluated = block
+        else:
+            pyfhelobj.add(evaluated, block)
+
+    # the products by giant steps leave three polynomials; the client gets two
+    if evaluated.size() > 2:
+        pyfhelobj.relinearize(evaluated)
+
+    return evaluated.to_bytes()
+
+def evaluate_shared_partition_paterson_stockmeyer(query: SharedQuery, baby_steps: int, server_preprocessed_filename: str,
+                                                  partitions: List[int], i: int) -> bytes:
+    """
+    Evaluates the polynomial of partition i in a worker of the evaluation pool (see
+    prepare_server_response_paterson_stockmeyer).
+    """
 
-        dot_product = dot_product + transposed_poly_coeffs[(MINIBIN_CAP + 1) * i + MINIBIN_CAP]
-        evaluated_polynomials.append(dot_product.to_bytes())
+    # the baby steps and the giant steps
+    exponents = list(range(1, baby_steps)) + list(range(baby_steps, MINIBIN_CAP + 1, baby_steps))
+    powers = {e: query.ciphertext(e) for e in exponents}
+    encoded_poly_coeffs = load_encoded_server_database(server_preprocessed_filename, partitions)
 
-    return evaluated_polynomials
+    return evaluate_partition_paterson_stockmeyer(query.pyfhel(), powers, baby_steps, encoded_poly_coeffs, i)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,125 @@
+import argparse
+import socket
+from time import time
+from typing import List
+
+from rich.console import Console
+
+from auxiliary_functions import get_and_deserialize_data, serialize_and_send_data
+from constants import *
+from oprf_constants import NUM_OF_PROCESSES
+from server_online import evaluate_shard_query, get_evaluation_pool, load_encoded_server_database, server_listen, shard_partitions
+import tracing
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Shard server evaluating a subset of the partitions of the server database for a front end (server_frontend.py).")
+    parser.add_argument("--shard", type=int, default=0, help="index of this shard")
+    parser.add_argument("--num-shards", type=int, default=1, help="number of shards the partitions are split over")
+    parser.add_argument("--partitions", default=None,
+                        help="partitions owned by this shard, e.g. 0-3,8 (default: the shard's share of the ALPHA partitions, which is what the front end asks it for)")
+    parser.add_argument("--port", type=int, default=None, help="port to listen on (default: SHARD_BASE_PORT + shard)")
+    parser.add_argument("--processes", type=int, default=NUM_OF_PROCESSES,
+                        help="number of processes the homomorphic evaluation is spread over")
+    parser.add_argument("--db", default="server_preprocessed",
+                        help="server database produced by server_offline.py")
+    args = parser.parse_args()
+
+    partitions = parse_partitions(args.partitions) if args.partitions else shard_partitions(args.shard, args.num_shards)
+    port = SHARD_BASE_PORT + args.shard if args.port is None else args.port
+
+    # for prettier printing
+    console = Console()
+
+    t0 = time()
+
+    # only the columns of this shard's partitions are read and encoded
+    load_encoded_server_database(args.db, partitions)
+
+    # fork the evaluation pool now rather than on the first query; it inherits the loaded partitions
+    if args.processes > 1:
+        get_evaluation_pool(args.processes)
+
+    console.log("[yellow]Partitions {} of the server database loaded. Time taken: {:.2f}s.[/yellow]".format(partitions, time() - t0))
+
+    listener = server_listen(backlog=16, port=port)
+
+    console.log("[blue]Shard {} listening on {}:{}.[/blue]".format(args.shard, SERVER_HOST, port))
+
+    try:
+        while True:
+            conn_socket, _ = listener.accept()
+            # a front end that stalls must not hold the shard forever
+            conn_socket.settimeout(SESSION_TIMEOUT)
+
+            try:
+                t0 = time()
+                serve_shard_query(conn_socket, console, partitions, args.db, args.processes)
+                console.log("[blue]Query evaluated in {:.2f}s.[/blue]".format(time() - t0))
+            except Exception as e:
+                # one failing query must not take the shard down
+                console.log("[red]Query failed: {}[/red]".format(e))
+            finally:
+                conn_socket.close()
+                tracing.export()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+
+
+def serve_shard_query(conn_socket: socket.socket, console: Console, partitions: List[int],
+                      server_preprocessed_filename: str = "server_preprocessed",
+                      processes: int = NUM_OF_PROCESSES) -> None:
+    """
+    Evaluates one client query, forwarded by the front end with the client's encrypted
+    powers, on the partitions the front end asks for, and sends back their evaluated
+    polynomials. If the shard does not own all of them, it answers with an error
+    message (MSG_ERROR) instead.
+
+    :param conn_socket: socket connected to the front end
+    :param console: rich console used for progress messages
+    :param partitions: indices of the partitions owned by this shard
+    :param server_preprocessed_filename: filename where server's prepocessed items are
+                                         (see server_offline.py)
+    :param processes: number of processes the homomorphic evaluation is spread over
+    """
+
+    with tracing.stage("shard_session"):
+        with tracing.stage("receive_query"):
+            received_data, _ = get_and_deserialize_data(conn_socket, MSG_SHARD_QUERY)
+
+        requested = received_data[2]
+        missing = [i for i in requested if i not in partitions]
+        if missing:
+            reason = "partitions {} are not owned by this shard (it owns {})".format(missing, partitions)
+            serialize_and_send_data(conn_socket, reason.encode(), msg_type=MSG_ERROR)
+            console.log("[red]Query rejected: {}[/red]".format(reason))
+            return
+
+        srv_answer = evaluate_shard_query(received_data, console, server_preprocessed_filename, processes)
+
+        with tracing.stage("send_response"):
+            serialize_and_send_data(conn_socket, srv_answer, msg_type=MSG_SHARD_RESPONSE)
+
+def parse_partitions(text: str) -> List[int]:
+    """
+    Example: parse_partitions("0-3,8") is [0, 1, 2, 3, 8]
+
+    :param text: comma separated partition indices and ranges (both ends included)
+    :return: sorted list of the partition indices
+    """
+
+    partitions = set()
+
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        partitions.update(range(int(first), int(last or first) + 1))
+
+    if not partitions <= set(range(ALPHA)):
+        raise ValueError("Partitions must be between 0 and {}".format(ALPHA - 1))
+
+    return sorted(partitions)
+
+if __name__ == "__main__":
+    main()
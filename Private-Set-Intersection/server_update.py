@@ -0,0 +1,109 @@
+import os
+import pickle
+from time import time
+
+from rich.console import Console
+
+from auxiliary_functions import read_file_return_list_of_int
+from constants import *
+from oprf import server_prf_offline_parallel
+from oprf_constants import BASE_ORDER, G, SERVER_OPRF_KEY
+from server_database import load_server_database, write_server_database
+from simple_hash import BinFullError, DuplicateItemError, ItemNotFoundError
+
+def main():
+    # for prettier printing
+    console = Console()
+
+    with console.status("[bold red]Server update in progress...") as status:
+
+        # items to add to / remove from the server's database (same format as server_set)
+        additions = read_file_return_list_of_int("server_additions") if os.path.exists("server_additions") else []
+        deletions = read_file_return_list_of_int("server_deletions") if os.path.exists("server_deletions") else []
+
+        t0 = time()
+
+        # hash table and coefficients produced by server_offline.py
+        h = open('server_hashed', 'rb')
+        SH = pickle.load(h)
+        h.close()
+
+        # the bins and the database are mapped copy-on-write: the files are only replaced
+        # once the whole update has succeeded (see save_server_update)
+        db = load_server_database('server_preprocessed', mode="c")
+
+        t1 = time()
+
+        console.log("[yellow]Loaded server's hash table and coefficients. Time taken: {:.2f}s.[/yellow]".format(t1-t0))
+
+        # the transpose of the stored matrix has one row per bin, like SimpleHash.partition
+        try:
+            recomputed_minibins = update_server_database(SH, db.T, additions, deletions)
+        except (BinFullError, DuplicateItemError, ItemNotFoundError) as e:
+            # the update is checked before anything is changed
+            console.log("[red]Update rejected, the database is unchanged: {}[/red]".format(e))
+            return
+
+        t2 = time()
+
+        console.log("[yellow]Added {} and removed {} items, {} minibins recomputed. Time taken: {:.2f}s.[/yellow]".format(len(additions), len(deletions), recomputed_minibins, t2-t1))
+
+        save_server_update(SH, db)
+
+        t3 = time()
+
+        console.log("[blue]Server update total time: {:.2f}s[/blue]".format(t3-t0))
+
+
+def update_server_database(SH, poly_coeffs, additions, deletions):
+    """
+    Applies additions and deletions to the server's preprocessed database. Only the new
+    (and deleted) items are OPRFed, only the bins they map to are changed, and only the
+    minibins of those bins that changed are interpolated again.
+
+    :param SH: the server's (padded) SimpleHash, as saved by server_offline.py
+    :param poly_coeffs: the minibin coefficients, one row per bin (e.g. the transpose of the
+                        memory-mapped server database); updated in place
+    :param additions: list of items to add to the server's set
+    :param deletions: list of items to remove from the server's set
+    :return: the number of minibins whose coefficients were recomputed
+    :raises ItemNotFoundError: if an item of deletions is not in the server's set
+    :raises DuplicateItemError: if an item of additions already is (and is not deleted)
+    :raises BinFullError: if the additions do not fit in their bins
+    """
+
+    # key * generator of elliptic curve (EC)
+    key_gen_point = (SERVER_OPRF_KEY % BASE_ORDER) * G
+
+    PRFed_additions = set(server_prf_offline_parallel(additions, key_gen_point)) if additions else set()
+    PRFed_deletions = set(server_prf_offline_parallel(deletions, key_gen_point)) if deletions else set()
+
+    changed_positions = SH.update_entries(PRFed_additions, PRFed_deletions)
+
+    return SH.repartition(poly_coeffs, changed_positions, ALPHA, MINIBIN_CAP, PLAIN_MOD)
+
+def save_server_update(SH, db):
+    """
+    Saves an updated server database. The bins, the pickled hash table and the coefficients
+    are all written to staging files first, and only then swapped in with os.replace, so
+    that an update failing before that point leaves the three files as they were (and
+    consistent with each other).
+
+    :param SH: the server's updated SimpleHash, with its bins mapped from server_hashed_bins.npy
+    :param db: the updated coefficient matrix of the server database (see server_database.py)
+    """
+
+    SH.save_bins(SH.filename + '.tmp')
+
+    write_server_database('server_preprocessed.tmp', db.T)
+
+    h = open('server_hashed.tmp', 'wb')
+    pickle.dump(SH, h)
+    h.close()
+
+    os.replace(SH.filename + '.tmp', SH.filename)
+    os.replace('server_preprocessed.tmp', 'server_preprocessed')
+    os.replace('server_hashed.tmp', 'server_hashed')
+
+if __name__ == "__main__":
+    main()
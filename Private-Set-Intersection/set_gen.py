@@ -1,42 +1,155 @@
-from random import sample
-from typing import List, Tuple
+import argparse
+import struct
+from typing import Iterable, Iterator, List, Optional, Tuple
 
-from constants import SERVER_SIZE, CLIENT_SIZE, INTERSECTION_SIZE
+import numpy as np
+
+from constants import SERVER_SIZE, CLIENT_SIZE, INTERSECTION_SIZE, SET_CHUNK_SIZE, SET_FILE_MAGIC
+
+ITEM_MASK = np.uint64(2 ** 63 - 1)
+"""
+Items are derived from a permutation of the 63-bit integers (see permute_counters).
+"""
+MIXING_MULTIPLIERS = (0xbf58476d1ce4e5b9, 0x94d049bb133111eb, 0xff51afd7ed558ccd, 0xc4ceb9fe1a85ec53)
+"""
+Odd multipliers of the mixing rounds (from SplitMix64 and MurmurHash3's finalizer).
+"""
 
 def main():
 
-	client_set, server_set, intersection = generate_data_sets(SERVER_SIZE, CLIENT_SIZE, INTERSECTION_SIZE)
+    parser = argparse.ArgumentParser(description="Generates the client set, the server set and their intersection.")
+    parser.add_argument("--server-size", type=int, default=SERVER_SIZE, help="number of server items")
+    parser.add_argument("--client-size", type=int, default=CLIENT_SIZE, help="number of client items")
+    parser.add_argument("--intersection-size", type=int, default=INTERSECTION_SIZE, help="number of common items")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the data sets; the same seed always gives the same sets (default: random)")
+    parser.add_argument("--format", choices=["text", "binary"], default="text",
+                        help="one item per line, or the binary format (see SET_FILE_MAGIC in constants.py)")
+    parser.add_argument("--chunk-size", type=int, default=SET_CHUNK_SIZE, help="number of items generated at a time")
+    args = parser.parse_args()
+
+    if args.seed is None:
+        args.seed = int(np.random.SeedSequence().entropy % 2 ** 63)
+    print("Seed: {}".format(args.seed))
+
+    keys = round_keys(args.seed)
+    client_ranges, server_ranges, intersection_ranges = data_set_ranges(args.server_size, args.client_size, args.intersection_size)
+
+    for filename, ranges in (("client_set", client_ranges), ("server_set", server_ranges), ("intersection", intersection_ranges)):
+        write_set_to_file(filename, stream_set(ranges, keys, args.chunk_size), sum(stop - start for start, stop in ranges), args.format)
+
+
+def data_set_ranges(server_size: int, client_size: int,
+                    intersection_size: int) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """
+    Assigns disjoint ranges of counters to the sets: the counters [0, intersection_size)
+    give the common items, followed by the server's own items and then the client's own items.
+
+    :param server_size: the size of the set for the server
+    :param client_size: the size of the set for the client
+    :param intersection_size: the size of the intersection between the sets
+    :return: the (start, stop) counter ranges of the client set, server set and their intersection
+    """
+
+    if not 0 <= intersection_size <= min(server_size, client_size):
+        raise ValueError("The intersection size must be at most the client and server size")
+
+    intersection = [(0, intersection_size)]
+    server_ranges = [(0, server_size)]
+    client_ranges = [(0, intersection_size), (server_size, server_size + client_size - intersection_size)]
+
+    return client_ranges, server_ranges, intersection
+
+def round_keys(seed: int) -> np.ndarray:
+    """
+    :param seed: seed of the data sets
+    :return: the keys of the mixing rounds of permute_counters, derived from the seed
+    """
+
+    return np.random.SeedSequence(seed).generate_state(len(MIXING_MULTIPLIERS), dtype=np.uint64) & ITEM_MASK
+
+def permute_counters(counters: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """
+    Maps counters to items with a keyed bijection of the 63-bit integers, so that distinct
+    counters always give distinct items and no item has to be remembered to avoid repeats.
+    Every round (adding a key, an xorshift and a multiplication by an odd number, all
+    modulo 2 ** 63) is invertible. Items are shifted by one, since 0 has no OPRF encoding.
+
+    :param counters: array of distinct integers in [0, 2 ** 63 - 1)
+    :param keys: keys of the rounds (see round_keys)
+    :return: array (np.uint64) of distinct items in [1, 2 ** 63]
+    """
+
+    x = counters.astype(np.uint64)
+
+    with np.errstate(over="ignore"):
+        for key, multiplier in zip(keys, MIXING_MULTIPLIERS):
+            x = (x + key) & ITEM_MASK
+            x ^= x >> np.uint64(31)
+            x = (x * np.uint64(multiplier)) & ITEM_MASK
+            x ^= x >> np.uint64(29)
+
+        return x + np.uint64(1)
 
-	write_list_to_file("client_set", client_set)
-	write_list_to_file("server_set", server_set)
-	write_list_to_file("intersection", intersection)
+def stream_set(ranges: Iterable[Tuple[int, int]], keys: np.ndarray, chunk_size: int = SET_CHUNK_SIZE) -> Iterator[np.ndarray]:
+    """
+    Generates the items of a set, chunk_size of them at a time.
+
+    :param ranges: (start, stop) counter ranges of the set (see data_set_ranges)
+    :param keys: keys of the permutation (see round_keys)
+    :param chunk_size: maximum number of items per chunk
+    :return: iterator over arrays (np.uint64) of items
+    """
 
+    for start, stop in ranges:
+        for chunk_start in range(start, stop, chunk_size):
+            yield permute_counters(np.arange(chunk_start, min(chunk_start + chunk_size, stop), dtype=np.uint64), keys)
 
-def generate_data_sets(server_size: int, client_size: int, intersection_size: int) -> Tuple[List[int], List[int]]:
+def generate_data_sets(server_size: int, client_size: int, intersection_size: int,
+                       seed: Optional[int] = None) -> Tuple[List[int], List[int], List[int]]:
     """
     Generates two lists of integers with the given sizes. They have an intersection equal
     to the given intersection size. The integers must be less than the order of the generator
-    of the elliptic curve used (e.g., 192-bit integers if P192 is used). Since we use the
-    random.sample function, we are limited to 2 ** 63 - 1 (see max_int).
+    of the elliptic curve used (e.g., 192-bit integers if P192 is used); they are at most 2 ** 63
+    (see permute_counters).
 
     :param server_size: the size of the set for the server
     :param client_size: the size of the set for the client
     :param intersection_size: the size of the intersection between the sets
+    :param seed: seed of the data sets; the same seed always gives the same sets (default: random)
     :return: a tuple containing the client set, server set and their intersection
     """
 
-	# maximum integer allowed for python's sample function
-    max_int = 2 ** 63 - 1
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % 2 ** 63)
 
-    # Generate a disjoint union of integers for both sets
-    disjoint_union = sample(range(max_int), server_size + client_size)
+    keys = round_keys(seed)
 
-    # Split the intersection and assign it to the server and client sets
-    intersection = disjoint_union[:intersection_size]
-    server_set = intersection + disjoint_union[intersection_size: server_size + intersection_size]
-    client_set = intersection + disjoint_union[server_size + intersection_size: server_size + client_size]
+    return tuple([item for chunk in stream_set(ranges, keys) for item in chunk.tolist()]
+                 for ranges in data_set_ranges(server_size, client_size, intersection_size))
+
+def write_set_to_file(filename: str, chunks: Iterable[np.ndarray], count: int, file_format: str = "text") -> None:
+    """
+    Writes the items of a set to a file with the specified name, a chunk at a time.
+
+    :param filename: The name of the file to write to.
+    :param chunks: iterator over arrays of items (see stream_set)
+    :param count: total number of items, written in the header of the binary format
+    :param file_format: "text" (one item per line) or "binary" (see SET_FILE_MAGIC in constants.py)
+    :return: None
+    """
 
-    return client_set, server_set, intersection
+    if file_format == "binary":
+        with open(filename, 'wb') as f:
+            f.write(SET_FILE_MAGIC + struct.pack("<Q", count))
+            for chunk in chunks:
+                f.write(chunk.astype("<u8").tobytes())
+    elif file_format == "text":
+        with open(filename, 'w') as f:
+            for chunk in chunks:
+                f.write("".join("{}\n".format(item) for item in chunk.tolist()))
+    else:
+        raise ValueError("Unknown set file format: {}".format(file_format))
 
 def write_list_to_file(filename: str, items: List) -> None:
     """
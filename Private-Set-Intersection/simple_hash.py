@@ -1,14 +1,30 @@
 import math
-from typing import List
+from typing import Iterable, List, Optional, Set, Tuple
 
 import mmh3
+import numpy as np
 
-from auxiliary_functions import compute_coefficients_from_roots
+from auxiliary_functions import compute_coefficients_from_roots, compute_coefficients_from_roots_batched
 from constants import BIN_CAP, NUM_OF_BINS, NUM_OF_HASHES, OUTPUT_BITS, SIGMA_MAX
 
 log_no_hashes = int(math.log(NUM_OF_HASHES) / math.log(2)) + 1
 POW_2_MASK = 2 ** OUTPUT_BITS - 1
 
+class BinFullError(Exception):
+    """
+    Raised when an item does not fit in its bin (the bin already holds BIN_CAP items).
+    """
+
+class ItemNotFoundError(Exception):
+    """
+    Raised when an item to remove is not in the hash table.
+    """
+
+class DuplicateItemError(Exception):
+    """
+    Raised when an item to add is already in the hash table.
+    """
+
 def left_and_index(item: int, index: int) -> int:
     '''
     Returns an integer represented as item_left || index, where item_left is the leftmost
@@ -42,6 +58,22 @@ def location(seed: int, item: int) -> int:
     hash_item_left = mmh3.hash(str(item_left), seed, signed=False) >> (32 - OUTPUT_BITS)
     return hash_item_left ^ item_right
 
+def hash_entries(items: List[int], hash_seeds: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Computes where each item goes in a simple hash table, under each hash seed,
+    without inserting it (see SimpleHash.insert_hashed_entries).
+
+    :param items: a list of integers
+    :param hash_seeds: list of hash seeds
+    :return: the bins (np.int64) and the entries (np.uint64) of the items, one per
+             item and hash seed, in the order SimpleHash.insert_entries inserts them
+    '''
+
+    locs = np.array([location(seed, item) for item in items for seed in hash_seeds], dtype=np.int64)
+    entries = np.array([left_and_index(item, i) for item in items for i in range(len(hash_seeds))], dtype=np.uint64)
+
+    return locs, entries
+
 class SimpleHash():
     """
     Class for performing simple hashing on a set of integers.
@@ -50,46 +82,95 @@ class SimpleHash():
         num_bins (int): the number of bins to hash the data into
         hashed_data (List[List[int]]): list of lists representing the hashed data,
                                        where each bin has a maximum capacity of bin_capacity
+                                       (a num_bins x bin_capacity uint64 array if compact)
         occurences (List[int]): list representing the number of elements in each bin
+                                (an integer array if compact)
         hash_seed (List[int]): list of seed values for the hash function
         bin_capacity (int): maximum capacity for bins
         msg_padding (int): padding value for bins to ensure a consistent size
+        compact (bool): whether the bins are stored in a single contiguous array
+        filename (str): .npy file the contiguous array is memory-mapped from (None if in memory)
 
     Methods:
         insert_entries(items: List[int]) -> None:
             Inserts a list of integers into the hash table
             using the insert method for each hash seed.
 
+        insert_hashed_entries(locs: np.ndarray, entries: np.ndarray) -> None:
+            Inserts the entries computed by hash_entries (compact only).
+
         insert(item: int, i: int) -> None:
             Inserts an integer item into the hash table for a given
             hash seed index i.
 
-        pad_bins() -> None:
+        remove(item: int, i: int) -> List[int]:
+            Removes an integer item from the hash table for a given
+            hash seed index i.
+
+        update_entries(additions: List[int], deletions: List[int]) -> Set[Tuple[int, int]]:
+            Removes and inserts items, returning the positions of the
+            bins that were changed.
+
+        check_update(additions: List[int], deletions: List[int]) -> None:
+            Checks that an update can be applied, without changing anything.
+
+        pad_bins(start: int = 0, stop: Optional[int] = None) -> None:
             Pads empty bins with a consistent value to ensure
             a consistent bin size.
 
-        partition(num_minibins: int, minibin_cap: int, plain_mod: int) -> List[List[int]]:
-            Performs partitioning on the hashed data.
+        partition(num_minibins: int, minibin_cap: int, plain_mod: int,
+                  start: int = 0, stop: Optional[int] = None) -> List[List[int]]:
+            Performs partitioning on the hashed data (optionally only
+            on the bins from start to stop).
             Bins are partitioned into num_minibins minibins,
             each with a capacity of minibin_cap.
             Returns a list of lists representing the coefficients of
             the polynomial representing each minibin.
+
+        minibin(i: int, j: int, minibin_cap: int) -> List[int]:
+            Returns the items of minibin j of bin i.
+
+        repartition(coefficients: List[List[int]], positions: Iterable[Tuple[int, int]],
+                    num_minibins: int, minibin_cap: int, plain_mod: int) -> int:
+            Recomputes, in place, the coefficients of the minibins containing
+            the given positions.
     """
 
 
-    def __init__(self, hash_seed):
+    def __init__(self, hash_seed, compact: bool = False, filename: Optional[str] = None):
         """
         SimpleHashing constructor.
+
+        In compact mode the bins are stored in a single num_bins x BIN_CAP uint64 array
+        instead of Python lists. The first occurrences[i] positions of bin i are occupied;
+        the others are free (0 before padding).
         
         :param hash_seed: List of hash seeds
+        :param compact: whether to use the array-backed storage
+        :param filename: in compact mode, a .npy file the array is memory-mapped from, so that
+                         the bins do not have to fit in memory; pickling the SimpleHash then
+                         only saves the filename, and unpickling maps the file again, copy-on-write:
+                         changes made to the unpickled table never reach the file (see save_bins)
         """
 
         self.num_bins = NUM_OF_BINS
-        self.hashed_data = [[None for j in range(BIN_CAP)] for i in range(self.num_bins)] # no_bins bins, len = BIN_CAP
-        self.occurrences = [0 for i in range(self.num_bins)]
+        self.compact = compact
+        self.filename = filename
+        if compact and filename is not None:
+            self.hashed_data = np.lib.format.open_memmap(filename, mode="w+", dtype=np.uint64, shape=(self.num_bins, BIN_CAP))
+        elif compact:
+            self.hashed_data = np.zeros((self.num_bins, BIN_CAP), dtype=np.uint64)
+        else:
+            self.hashed_data = [[None for j in range(BIN_CAP)] for i in range(self.num_bins)] # no_bins bins, len = BIN_CAP
+
+        if compact:
+            self.occurrences = np.zeros(self.num_bins, dtype=np.int64)
+        else:
+            self.occurrences = [0 for i in range(self.num_bins)]
         self.hash_seed = hash_seed
         self.bin_capacity = BIN_CAP
         self.msg_padding = 2 ** (SIGMA_MAX - OUTPUT_BITS + int(math.log2(NUM_OF_HASHES)) + 1) + 1 # data padding
+        self.padded = False
 
 
     def insert_entries(self, items: List[int]):
@@ -99,11 +180,52 @@ class SimpleHash():
         :param items: a list of integers representing the items to be inserted.
         """
 
+        if self.compact:
+            self._insert_entries_compact(items)
+            return
+
         for item in items:
             for i in range(len(self.hash_seed)): # NUM_OF_HASHES
                 self.insert(item, i)
 
 
+    def _insert_entries_compact(self, items: List[int]):
+        """
+        Same as insert_entries for the array-backed storage: the locations of all entries
+        are computed first, then the entries are written to their bins in one operation,
+        in the same order insert_entries would have placed them.
+
+        :param items: a list of integers representing the items to be inserted.
+        """
+
+        self.insert_hashed_entries(*hash_entries(items, self.hash_seed))
+
+
+    def insert_hashed_entries(self, locs: np.ndarray, entries: np.ndarray):
+        """
+        Writes entries (see hash_entries) to their bins in one operation (compact mode only).
+        Entries of the same bin are placed in the order they are given.
+
+        :param locs: array of the bins of the entries
+        :param entries: array of the entries
+        """
+
+        # stable sort, so that entries of the same bin keep their insertion order
+        order = np.argsort(locs, kind="stable")
+        sorted_locs = locs[order]
+
+        # position of each entry inside its bin
+        bins, first_index, counts = np.unique(sorted_locs, return_index=True, return_counts=True)
+        ranks = np.arange(len(sorted_locs)) - np.repeat(first_index, counts)
+        positions = self.occurrences[sorted_locs] + ranks
+
+        if len(positions) > 0 and positions.max() >= self.bin_capacity:
+            raise BinFullError('Hashing failed: bin is full')
+
+        self.hashed_data[sorted_locs, positions] = entries[order]
+        self.occurrences[bins] += counts
+
+
     def insert(self, item: int, i: int) -> None:
         """
         Inserts an item using hash i at the position determined by the hash value.
@@ -119,21 +241,134 @@ class SimpleHash():
             self.hashed_data[loc][self.occurrences[loc]] = left_and_index(item, i)
             self.occurrences[loc] += 1
         else:
-            raise Exception('Hashing failed: bin is full')
+            raise BinFullError('Hashing failed: bin is full')
+
+
+    def remove(self, item: int, i: int) -> List[int]:
+        """
+        Removes an item that was inserted using hash i. The last item of the bin
+        is moved into the freed position, so the occupied positions of a bin stay
+        contiguous and new items can still be inserted at the end of the bin.
+
+        :param item: An integer representing the item to be removed.
+        :param i: An integer representing the index of the hash function that was used.
+        :return: the positions inside the bin whose content changed
+        """
+
+        loc = location(self.hash_seed[i], item)
+        entry = left_and_index(item, i)
+        last = self.occurrences[loc] - 1
+
+        for j in range(self.occurrences[loc]):
+            if self.hashed_data[loc][j] == entry:
+                # Move the last item of the bin into the freed position
+                self.hashed_data[loc][j] = self.hashed_data[loc][last]
+                self.hashed_data[loc][last] = self.msg_padding if self.padded else (0 if self.compact else None)
+                self.occurrences[loc] -= 1
+                return [j, last]
 
+        raise ItemNotFoundError('Removal failed: item not found in bin')
 
-    def pad_bins(self):
+
+    def update_entries(self, additions: List[int], deletions: List[int]) -> Set[Tuple[int, int]]:
+        """
+        Removes the items in deletions, then inserts the items in additions. Only the
+        NUM_OF_HASHES bins each item maps to are touched. The whole update is checked
+        before anything is changed, so an update that fails leaves the table as it was.
+
+        :param additions: a list of distinct integers representing the items to be inserted.
+        :param deletions: a list of distinct integers representing the items to be removed.
+        :return: set of (bin, position) pairs whose content changed
+        :raises ItemNotFoundError: if an item of deletions is not in the table
+        :raises DuplicateItemError: if an item of additions is already in the table (and not deleted)
+        :raises BinFullError: if the additions do not fit in their bins
+        """
+
+        self.check_update(additions, deletions)
+
+        changed_positions = set()
+
+        for item in deletions:
+            for i in range(len(self.hash_seed)):
+                loc = location(self.hash_seed[i], item)
+                for j in self.remove(item, i):
+                    changed_positions.add((loc, j))
+
+        for item in additions:
+            for i in range(len(self.hash_seed)):
+                loc = location(self.hash_seed[i], item)
+                changed_positions.add((loc, int(self.occurrences[loc])))
+                self.insert(item, i)
+
+        return changed_positions
+
+
+    def check_update(self, additions: List[int], deletions: List[int]) -> None:
+        """
+        Checks, without changing anything, that update_entries(additions, deletions) can be
+        applied: every deleted item is in the table, no added item is (unless it is deleted
+        first), and the bins have room for the additions once the deletions are done.
+
+        :param additions: a list of distinct integers representing the items to be inserted.
+        :param deletions: a list of distinct integers representing the items to be removed.
+        """
+
+        deleted = set(deletions)
+        # change in the number of items of each touched bin
+        growth = {}
+
+        for item in deletions:
+            for i in range(len(self.hash_seed)):
+                loc = location(self.hash_seed[i], item)
+                if not self._holds(loc, left_and_index(item, i)):
+                    raise ItemNotFoundError('Removal failed: item {} not found in bin {}'.format(item, loc))
+                growth[loc] = growth.get(loc, 0) - 1
+
+        for item in additions:
+            for i in range(len(self.hash_seed)):
+                loc = location(self.hash_seed[i], item)
+                if item not in deleted and self._holds(loc, left_and_index(item, i)):
+                    raise DuplicateItemError('Insertion failed: item {} already in bin {}'.format(item, loc))
+                growth[loc] = growth.get(loc, 0) + 1
+
+        for loc, count in growth.items():
+            if self.occurrences[loc] + count > self.bin_capacity:
+                raise BinFullError('Hashing failed: bin {} is full'.format(loc))
+
+
+    def _holds(self, loc: int, entry: int) -> bool:
+        """
+        :return: whether entry is among the occupied positions of bin loc
+        """
+
+        return entry in self.hashed_data[loc][:self.occurrences[loc]]
+
+
+    def pad_bins(self, start: int = 0, stop: Optional[int] = None):
         """
         Pads bins in the hash structure to have a consistent size.
+
+        :param start: the first bin to pad
+        :param stop: the bin after the last one to pad (default: all bins)
         """
 
-        for i in range(self.num_bins):
-            for j in range(self.bin_capacity):
-                if self.hashed_data[i][j] == None:
-                    self.hashed_data[i][j] = self.msg_padding
+        stop = self.num_bins if stop is None else stop
 
+        if self.compact:
+            # every position past the occupied ones, in a single masked fill
+            bins = self.hashed_data[start:stop]
+            bins[np.arange(self.bin_capacity) >= self.occurrences[start:stop, None]] = self.msg_padding
+        else:
+            for i in range(start, stop):
+                for j in range(self.bin_capacity):
+                    if self.hashed_data[i][j] == None:
+                        self.hashed_data[i][j] = self.msg_padding
+
+        self.padded = True
 
-    def partition(self, num_minibins: int, minibin_cap: int, plain_mod: int) -> List[List[int]]:
+
+    def partition(self, num_minibins: int, minibin_cap: int, plain_mod: int,
+                  start: int = 0, stop: Optional[int] = None) -> List[List[int]]:
         """
         Performs partitioning on the bins (self.hashed_data). Bins are partitioned into
         num_minibins minibins, with minibin_cap items in each minibin. Minibins are represented
@@ -143,16 +378,106 @@ class SimpleHash():
         :param num_minibins: the number of minibins
         :param minibin_cap: the number of items in each minibin
         :param plain_mod: plain modulus (coefficient are modulo plain_mod)
-        :return: list of integers representing coefficients from the minibin polynomials
+        :param start: the first bin to partition
+        :param stop: the bin after the last one to partition (default: all bins)
+        :return: list of integers representing coefficients from the minibin polynomials, one
+                 list per bin from start to stop (a (stop - start) x num_minibins * (minibin_cap + 1)
+                 uint64 array if compact)
         """
 
+        stop = self.num_bins if stop is None else stop
+
+        if self.compact:
+            # all minibins of all bins are interpolated at once, one minibin per row
+            bins = self.hashed_data[start:stop, :num_minibins * minibin_cap]
+            coefficients = compute_coefficients_from_roots_batched(bins.reshape(-1, minibin_cap), plain_mod)
+            return coefficients.reshape(len(bins), num_minibins * (minibin_cap + 1))
+
         coefficients = []
 
-        for i in range(self.num_bins):
+        for i in range(start, stop):
             bin_coefficients = []
             for j in range(num_minibins):
-                roots = [self.hashed_data[i][minibin_cap * j + k] for k in range(minibin_cap)]
+                roots = self.minibin(i, j, minibin_cap)
                 bin_coefficients.extend(compute_coefficients_from_roots(roots, plain_mod))
             coefficients.append(bin_coefficients)
 
         return coefficients
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.filename is not None:
+            # the bins stay in their file
+            self.hashed_data.flush()
+            del state["hashed_data"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # tables pickled before the bins could be file-backed
+        self.__dict__.setdefault("filename", None)
+        if self.filename is not None:
+            # copy-on-write, so that an update failing halfway cannot leave the file half changed
+            self.hashed_data = np.lib.format.open_memmap(self.filename, mode="c")
+
+
+    def save_bins(self, filename: str) -> None:
+        """
+        Writes the bins (compact mode only) to a new .npy file, e.g. a staging copy that
+        is then swapped in for the file the bins are mapped from (see server_update.py).
+
+        :param filename: name of the file to write
+        """
+
+        with open(filename, "wb") as f:
+            np.save(f, self.hashed_data)
+
+
+    def minibin(self, i: int, j: int, minibin_cap: int) -> List[int]:
+        """
+        :param i: index of the bin
+        :param j: index of the minibin inside bin i
+        :param minibin_cap: the number of items in each minibin
+        :return: the items of minibin j of bin i, as Python integers
+        """
+
+        minibin = self.hashed_data[i][minibin_cap * j: minibin_cap * (j + 1)]
+
+        return minibin.tolist() if self.compact else minibin
+
+
+    def repartition(self, coefficients: List[List[int]], positions: Iterable[Tuple[int, int]],
+                    num_minibins: int, minibin_cap: int, plain_mod: int) -> int:
+        """
+        Recomputes the coefficients (as returned by partition) of the minibins that
+        contain any of the given positions, leaving all other minibins untouched.
+        The bins must have been padded.
+
+        :param coefficients: coefficients previously returned by partition, updated in place
+        :param positions: (bin, position) pairs whose content changed (see update_entries)
+        :param num_minibins: the number of minibins
+        :param minibin_cap: the number of items in each minibin
+        :param plain_mod: plain modulus (coefficient are modulo plain_mod)
+        :return: the number of minibins that were recomputed
+        """
+
+        # positions past the last minibin are not part of any polynomial
+        minibins = {(i, j // minibin_cap) for i, j in positions if j // minibin_cap < num_minibins}
+
+        if self.compact and minibins:
+            bins, minibin_indices = (np.array(indices) for indices in zip(*minibins))
+            starts = minibin_indices * minibin_cap
+            roots = self.hashed_data[bins[:, None], starts[:, None] + np.arange(minibin_cap)]
+            minibin_coefficients = compute_coefficients_from_roots_batched(roots, plain_mod)
+            columns = (minibin_cap + 1) * minibin_indices[:, None] + np.arange(minibin_cap + 1)
+            coefficients[bins[:, None], columns] = minibin_coefficients
+            return len(minibins)
+
+        for i, j in minibins:
+            roots = self.minibin(i, j, minibin_cap)
+            start = (minibin_cap + 1) * j
+            coefficients[i][start: start + minibin_cap + 1] = compute_coefficients_from_roots(roots, plain_mod)
+
+        return len(minibins)
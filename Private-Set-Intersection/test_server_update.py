@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+
+from constants import *
+from oprf import server_prf_offline_parallel
+from oprf_constants import BASE_ORDER, G, SERVER_OPRF_KEY
+from server_update import update_server_database
+from simple_hash import DuplicateItemError, ItemNotFoundError, SimpleHash
+
+class UpdateServerDatabaseTest(unittest.TestCase):
+    """
+    A server update that cannot be applied as a whole must leave the database unchanged.
+    """
+
+    server_set = list(range(1000, 1200))
+
+    def setUp(self):
+        key_gen_point = (SERVER_OPRF_KEY % BASE_ORDER) * G
+
+        self.SH = SimpleHash(HASH_SEEDS, compact=True)
+        self.SH.insert_entries(server_prf_offline_parallel(self.server_set, key_gen_point))
+        self.SH.pad_bins()
+        self.poly_coeffs = self.SH.partition(ALPHA, MINIBIN_CAP, PLAIN_MOD)
+
+    def assert_unchanged(self, hashed_data, occurrences, poly_coeffs):
+        self.assertTrue(np.array_equal(self.SH.hashed_data, hashed_data))
+        self.assertTrue(np.array_equal(self.SH.occurrences, occurrences))
+        self.assertTrue(np.array_equal(self.poly_coeffs, poly_coeffs))
+
+    def test_absent_deletion(self):
+        before = self.SH.hashed_data.copy(), self.SH.occurrences.copy(), self.poly_coeffs.copy()
+
+        # the first three deletions are in the set, the last one is not
+        with self.assertRaises(ItemNotFoundError):
+            update_server_database(self.SH, self.poly_coeffs, [5], self.server_set[:3] + [999999])
+
+        self.assert_unchanged(*before)
+
+    def test_duplicate_addition(self):
+        before = self.SH.hashed_data.copy(), self.SH.occurrences.copy(), self.poly_coeffs.copy()
+
+        with self.assertRaises(DuplicateItemError):
+            update_server_database(self.SH, self.poly_coeffs, [5, self.server_set[0]], self.server_set[1:3])
+
+        self.assert_unchanged(*before)
+
+    def test_update(self):
+        update_server_database(self.SH, self.poly_coeffs, [5, self.server_set[0]], self.server_set[:3])
+
+        # the same as building the database from the updated set
+        rebuilt = SimpleHash(HASH_SEEDS, compact=True)
+        key_gen_point = (SERVER_OPRF_KEY % BASE_ORDER) * G
+        rebuilt.insert_entries(server_prf_offline_parallel(self.server_set[3:] + [5, self.server_set[0]], key_gen_point))
+        rebuilt.pad_bins()
+
+        # the bins hold the same items, maybe in another order
+        self.assertTrue(np.array_equal(np.sort(self.SH.hashed_data, axis=1), np.sort(rebuilt.hashed_data, axis=1)))
+        # and only the changed minibins needed to be interpolated again
+        self.assertTrue(np.array_equal(self.poly_coeffs, self.SH.partition(ALPHA, MINIBIN_CAP, PLAIN_MOD)))
+
+if __name__ == "__main__":
+    unittest.main()
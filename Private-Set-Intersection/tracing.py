@@ -0,0 +1,372 @@
+import cProfile
+from collections import defaultdict
+import json
+from multiprocessing import active_children
+import os
+import resource
+import socket
+from time import perf_counter, process_time, time
+from typing import Dict, Optional
+
+from constants import *
+
+TRACE_FILE_VARIABLE = "PSI_TRACE_FILE"
+"""
+Environment variable naming a file every finished stage is appended to, as one JSON line.
+"""
+PROMETHEUS_FILE_VARIABLE = "PSI_PROMETHEUS_FILE"
+"""
+Environment variable naming a file the Prometheus text snapshot is written to by export().
+"{pid}" in the name is replaced by the process id, so that server workers do not overwrite
+each other's snapshots.
+"""
+PROFILE_STAGE_VARIABLE = "PSI_PROFILE_STAGE"
+"""
+Environment variable with the (comma separated) names of the stages to run under cProfile.
+"""
+PROFILE_DIR_VARIABLE = "PSI_PROFILE_DIR"
+"""
+Environment variable naming the directory profiles are written to (default: current directory).
+Each profiled stage writes <stage>.<pid>.prof, readable with pstats or snakeviz.
+"""
+
+MESSAGE_TYPE_NAMES = {MSG_DATA: "data",
+                      MSG_OPRF_REQUEST: "oprf_request",
+                      MSG_OPRF_RESPONSE: "oprf_response",
+                      MSG_QUERY: "query",
+                      MSG_RESPONSE: "response",
+                      MSG_SHARD_QUERY: "shard_query",
+                      MSG_SHARD_RESPONSE: "shard_response",
+                      MSG_ERROR: "error"}
+"""
+Names of the message types (see constants.py), as they appear in the exported data.
+"""
+
+
+class Stage():
+    """
+    One protocol stage, measured while its with block runs: wall time, CPU time (of this
+    process and of the child processes it waited for, e.g. worker pools), peak memory of
+    this process and the bytes sent and received per message type (see record_message).
+    The peak is reset when a stage starts (see reset_peak_rss), so it is the stage's own;
+    an enclosing stage keeps the largest peak of the stages it contains. Where the peak
+    cannot be reset, peak_rss is the process peak so far.
+
+    Attributes:
+        name (str): name of the stage
+        parent (str): name of the enclosing stage, "" for an outermost stage
+        wall_time (float): wall time in seconds
+        cpu_time (float): CPU time in seconds
+        peak_rss (int): peak resident set size (in bytes) during the stage
+        rss_growth (int): peak resident set size during the stage, over the resident set
+                          size when it started
+        bytes_sent (Dict[str, int]): bytes sent, per message type name
+        bytes_received (Dict[str, int]): bytes received, per message type name
+    """
+
+    def __init__(self, tracer: "Tracer", name: str):
+        self.tracer = tracer
+        self.name = name
+        self.parent = ""
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss = 0
+        self.rss_growth = 0
+        self.bytes_sent = defaultdict(int)
+        self.bytes_received = defaultdict(int)
+        self.profiler = None
+
+    def __enter__(self):
+        if self.tracer.open_stages:
+            self.parent = self.tracer.open_stages[-1].name
+        self.tracer.open_stages.append(self)
+
+        # only one profiler can be active at a time, so nested stages are not profiled separately
+        if self.name in self.tracer.profiled_stages and not any(s.profiler for s in self.tracer.open_stages):
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        # the outer stages keep their peak so far, since it is reset for this stage
+        peak = peak_rss()
+        for outer in self.tracer.open_stages[:-1]:
+            outer._peak = max(outer._peak, peak)
+        self._peak = 0
+        self._rss = current_rss()
+        reset_peak_rss()
+
+        self._cpu = process_time() + children_cpu_time()
+        self._wall = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time = perf_counter() - self._wall
+        self.cpu_time = process_time() + children_cpu_time() - self._cpu
+        self.peak_rss = max(self._peak, peak_rss())
+        self.rss_growth = self.peak_rss - self._rss
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(self.tracer.profile_dir, "{}.{}.prof".format(self.name, os.getpid())))
+            self.profiler = None
+
+        self.tracer.open_stages.remove(self)
+        self.tracer.finish(self)
+
+    @property
+    def total_bytes_sent(self) -> int:
+        return sum(self.bytes_sent.values())
+
+    @property
+    def total_bytes_received(self) -> int:
+        return sum(self.bytes_received.values())
+
+    def to_dict(self) -> Dict:
+        """
+        :return: the measurements of the stage, as a JSON-serializable dictionary
+        """
+
+        return {"stage": self.name, "parent": self.parent,
+                "wall_time": self.wall_time, "cpu_time": self.cpu_time,
+                "peak_rss": self.peak_rss, "rss_growth": self.rss_growth,
+                "bytes_sent": dict(self.bytes_sent), "bytes_received": dict(self.bytes_received)}
+
+
+class Tracer():
+    """
+    Collects the stages of one process. Finished stages are aggregated per stage name
+    (for the Prometheus snapshot) and appended to the JSON lines file, if one is configured.
+
+    Attributes:
+        open_stages (List[Stage]): stages currently running, outermost first
+        totals (Dict[str, Dict[str, float]]): per stage name, accumulated measurements
+        messages (Dict[Tuple[str, str], List[int]]): per (direction, message type name),
+                                                    the number of messages and of bytes
+        trace_file (str): JSON lines file ("" if disabled)
+        profiled_stages (set): names of the stages to run under cProfile
+        profile_dir (str): directory profiles are written to
+    """
+
+    def __init__(self, trace_file: str = "", profiled_stages: str = "", profile_dir: str = "."):
+        self.open_stages = []
+        self.totals = defaultdict(lambda: defaultdict(float))
+        self.messages = defaultdict(lambda: [0, 0])
+        self.trace_file = trace_file
+        self.profiled_stages = set(name.strip() for name in profiled_stages.split(",") if name.strip())
+        self.profile_dir = profile_dir
+
+    def stage(self, name: str) -> Stage:
+        """
+        :param name: name of the stage
+        :return: a Stage, to be used as a context manager around the stage
+        """
+
+        return Stage(self, name)
+
+    def record_message(self, direction: str, msg_type: int, size: int) -> None:
+        """
+        Accounts for a message sent or received, in every running stage.
+
+        :param direction: "sent" or "received"
+        :param msg_type: type of the message (see constants.py)
+        :param size: number of bytes of the message, framing included
+        """
+
+        type_name = MESSAGE_TYPE_NAMES.get(msg_type, str(msg_type))
+
+        for stage in self.open_stages:
+            if direction == "sent":
+                stage.bytes_sent[type_name] += size
+            else:
+                stage.bytes_received[type_name] += size
+
+        self.messages[(direction, type_name)][0] += 1
+        self.messages[(direction, type_name)][1] += size
+
+    def finish(self, stage: Stage) -> None:
+        """
+        Aggregates a finished stage and appends it to the JSON lines file.
+
+        :param stage: the finished stage
+        """
+
+        totals = self.totals[stage.name]
+        totals["count"] += 1
+        totals["wall_time"] += stage.wall_time
+        totals["cpu_time"] += stage.cpu_time
+        totals["peak_rss"] = max(totals["peak_rss"], stage.peak_rss)
+
+        if self.trace_file:
+            record = stage.to_dict()
+            record.update({"timestamp": time(), "host": socket.gethostname(), "pid": os.getpid()})
+
+            # a single short write in append mode, so that lines of concurrent server workers do not interleave
+            with open(self.trace_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def prometheus_snapshot(self) -> str:
+        """
+        :return: the aggregated measurements in the Prometheus text exposition format
+        """
+
+        lines = []
+
+        for metric, key, kind, help_text in (("psi_stage_runs_total", "count", "counter", "Number of times the stage ran."),
+                                             ("psi_stage_wall_seconds_total", "wall_time", "counter", "Wall time spent in the stage."),
+                                             ("psi_stage_cpu_seconds_total", "cpu_time", "counter", "CPU time spent in the stage, including waited-for child processes."),
+                                             ("psi_stage_peak_rss_bytes", "peak_rss", "gauge", "Largest peak resident set size during the stage.")):
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} {}".format(metric, kind))
+            for name, totals in sorted(self.totals.items()):
+                lines.append('{}{{stage="{}"}} {}'.format(metric, name, repr(totals[key])))
+
+        for metric, index, help_text in (("psi_messages_total", 0, "Number of messages."),
+                                         ("psi_message_bytes_total", 1, "Bytes of messages, framing included.")):
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} counter".format(metric))
+            for (direction, type_name), counts in sorted(self.messages.items()):
+                lines.append('{}{{direction="{}",type="{}"}} {}'.format(metric, direction, type_name, counts[index]))
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, filename: Optional[str] = None) -> None:
+        """
+        Writes the Prometheus snapshot, replacing the previous one, so that a scraper
+        (e.g. the node exporter textfile collector) never reads a partial file.
+
+        :param filename: file to write to; defaults to the PSI_PROMETHEUS_FILE environment
+                         variable, and nothing is written if neither is set
+        """
+
+        filename = filename or os.environ.get(PROMETHEUS_FILE_VARIABLE, "")
+        if not filename:
+            return
+
+        filename = filename.replace("{pid}", str(os.getpid()))
+        with open(filename + ".tmp", "w") as f:
+            f.write(self.prometheus_snapshot())
+        os.replace(filename + ".tmp", filename)
+
+
+def children_cpu_time() -> float:
+    """
+    :return: CPU time (user + system) of the child processes: the terminated ones that were
+             waited for, and the live multiprocessing children, e.g. the workers of the
+             persistent pools (see get_worker_pool in oprf.py), which are never waited for
+             while they serve stages
+    """
+
+    # active_children also waits for the children that have exited, so that each child is
+    # counted either as live or in RUSAGE_CHILDREN
+    live = sum(process_cpu_time(child.pid) for child in active_children())
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime + live
+
+
+def process_cpu_time(pid: int) -> float:
+    """
+    :param pid: id of a live process
+    :return: CPU time (user + system) of the process so far, read from /proc (0 where it is
+             not available)
+    """
+
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            # the fields after the command name (which may contain spaces) start at field 3
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return 0.0
+
+    # utime and stime are fields 14 and 15, in clock ticks
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def peak_rss() -> int:
+    """
+    :return: peak resident set size (in bytes) of this process since the last
+             reset_peak_rss, or since it started if the peak cannot be reset
+    """
+
+    hwm = read_status_field("VmHWM")
+    if hwm is not None:
+        return hwm
+
+    # ru_maxrss is in kilobytes on Linux
+    return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_rss() -> int:
+    """
+    :return: resident set size (in bytes) of this process (its peak where it is not available)
+    """
+
+    rss = read_status_field("VmRSS")
+
+    return peak_rss() if rss is None else rss
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak resident set size of this process to its current resident set size,
+    so that peak_rss measures from now on. Only Linux supports it (through
+    /proc/self/clear_refs); it costs no more than a system call.
+
+    :return: whether the peak was reset
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+
+    return True
+
+
+def read_status_field(field: str) -> Optional[int]:
+    """
+    :param field: name of a memory field of /proc/self/status, e.g. "VmHWM"
+    :return: its value in bytes (None where /proc is not available)
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    # e.g. "VmHWM:\t  123456 kB"
+                    return 1024 * int(line.split()[1])
+    except OSError:
+        pass
+
+    return None
+
+
+# the tracer of this process, configured from the environment; forked workers inherit it
+tracer = Tracer(os.environ.get(TRACE_FILE_VARIABLE, ""),
+                os.environ.get(PROFILE_STAGE_VARIABLE, ""),
+                os.environ.get(PROFILE_DIR_VARIABLE, "."))
+
+
+def stage(name: str) -> Stage:
+    """
+    :param name: name of the stage
+    :return: a Stage of this process' tracer, to be used as a context manager around the stage
+    """
+
+    return tracer.stage(name)
+
+
+def record_message(direction: str, msg_type: int, size: int) -> None:
+    """
+    Accounts for a message sent or received (see Tracer.record_message).
+    """
+
+    tracer.record_message(direction, msg_type, size)
+
+
+def export(filename: Optional[str] = None) -> None:
+    """
+    Writes this process' Prometheus snapshot (see Tracer.export).
+    """
+
+    tracer.export(filename)